@@ -0,0 +1,445 @@
+"""
+benchmarks for the array-based steps in reconstruct_3d. Each vectorized step is timed against the per-point loop it
+replaced. The translate and undistort references are the code from before the trajectories moved into float32
+arrays (float64 points in nested dictionaries), so the comparison includes the float32 rounding and has to agree to
+within FLOAT32_TOLERANCE pixels rather than bit for bit. Triangulation had no earlier implementation, so it is checked
+against per-point opencv triangulation.
+
+By default the points are synthetic (300 frames x 16 bodyparts x 3 views, with some points missing). To check against
+real deeplabcut output, point it at a video that has been through deeplabcut (and at the calibration folder to use
+the real camera parameters). Real points are only available as the float32 values read_dlc_trajectories stores, so
+then the comparison leaves out the rounding of the input:
+
+usage:
+    python benchmark_reconstruct_3d.py
+    python benchmark_reconstruct_3d.py --frames 300 --bodyparts 16 --repeats 20
+    python benchmark_reconstruct_3d.py --session_videos 80 --repeats 1     (triangulation for a whole session)
+    python benchmark_reconstruct_3d.py --video R0382_20201216_12-52-39_009.avi --marked_videos_parent /home/levlab/Public/DLC_DKL/videos_to_analyze/videos_to_crop_marked --calibration_parent /home/levlab/Public/mouse_SR_videos_to_analyze/mouse_SR_calibration_files
+"""
+import argparse
+import copy
+import functools
+import time
+
+import cv2
+import numpy as np
+
+import navigation_utilities
+import reconstruct_3d
+import skilled_reaching_io
+
+
+# bodyparts from the skilled reaching networks
+DEFAULT_BODYPARTS = ('leftear', 'rightear', 'lefteye', 'righteye', 'nose',
+                     'leftpaw', 'leftdig1', 'leftdig2', 'leftdig3', 'leftdig4',
+                     'rightpaw', 'rightdig1', 'rightdig2', 'rightdig3', 'rightdig4',
+                     'pellet')
+
+# crop windows are [left, right, top, bottom]
+DEFAULT_CROP_WINDOWS = {'direct': [700, 1350, 270, 935],
+                        'leftmirror': [1, 470, 270, 920],
+                        'rightmirror': [1570, 2040, 270, 920]}
+
+# float32 keeps 24 significant bits, so a point in a 2040 pixel wide frame is stored to within 2040 * 2**-24 ~ 1.2e-4
+# pixels. The translate and undistort steps add a few more roundings of that size, so anything under 1e-3 pixels is
+# float32 rounding rather than a change in the result
+FLOAT32_TOLERANCE = 1e-3
+# relative difference allowed between the batched normal-equation triangulation and opencv's per-point svd
+TRIANGULATION_TOLERANCE = 1e-6
+
+
+def mirror_camera_matrix(normal, point_on_mirror):
+    """
+    :return: 3 x 4 normalized camera matrix of the virtual camera seen in a flat mirror. The real camera is [I|0]
+    """
+    normal = np.asarray(normal, dtype=float) / np.linalg.norm(normal)
+    d = np.dot(normal, point_on_mirror)
+    # reflection across the plane normal . X = d is X' = (I - 2 n n^T) X + 2 d n
+    return np.hstack((np.eye(3) - 2 * np.outer(normal, normal), 2 * d * normal[:, np.newaxis]))
+
+
+# roughly the intrinsics and lens distortion of the skilled reaching cameras (opencv convention), and virtual cameras
+# for top, left and right mirrors in the layout of skilled_reaching_io.read_matlab_calibration
+DEFAULT_CAMERA_PARAMS = {'mtx': np.array([[1800., 0., 1020.], [0., 1800., 512.], [0., 0., 1.]]),
+                         'dist': np.array([-0.15, 0.08, 0.001, -0.001]),
+                         'Pn': np.stack((mirror_camera_matrix((0., 0.94, 0.34), (0., -60., 200.)),
+                                         mirror_camera_matrix((0.94, 0., 0.34), (-60., 0., 200.)),
+                                         mirror_camera_matrix((-0.94, 0., 0.34), (60., 0., 200.))), axis=2)}
+
+
+def translate_points_loop(dlc_data, trajectory_metadata):
+    """
+    reconstruct_3d.translate_points_to_full_frame as it was before the trajectories moved into float32 arrays - nested
+    dlc_data[view][bp] dictionaries of float64 arrays, with a coordinate of 0 for points that weren't found. Kept as
+    the reference for the vectorized version
+    """
+    view_list = tuple(trajectory_metadata.keys())
+
+    for view in view_list:
+        if trajectory_metadata[view] is None:
+            continue
+
+        if view == 'rightmirror':
+            crop_width = trajectory_metadata[view]['crop_window'][1] - trajectory_metadata[view]['crop_window'][0] + 1
+            for bp in trajectory_metadata[view]['bodyparts']:
+                for i_frame in range(trajectory_metadata[view]['num_frames']):
+                    if not np.all(dlc_data[view][bp]['coordinates'][i_frame] == 0):
+                        x = dlc_data[view][bp]['coordinates'][i_frame, 0]
+                        dlc_data[view][bp]['coordinates'][i_frame, 0] = (crop_width - x) + 1
+
+            for bp in trajectory_metadata[view]['bodyparts']:
+                if 'right' in bp:
+                    contra_bp = bp.replace('right', 'left')
+                    trajectory_placeholder = dlc_data[view][bp]['coordinates']
+                    confidence_placeholder = dlc_data[view][bp]['confidence']
+                    dlc_data[view][bp]['coordinates'] = dlc_data[view][contra_bp]['coordinates']
+                    dlc_data[view][bp]['confidence'] = dlc_data[view][contra_bp]['confidence']
+                    dlc_data[view][contra_bp]['coordinates'] = trajectory_placeholder
+                    dlc_data[view][contra_bp]['confidence'] = confidence_placeholder
+
+        for bp in trajectory_metadata[view]['bodyparts']:
+            for i_frame in range(trajectory_metadata[view]['num_frames']):
+                if not np.all(dlc_data[view][bp]['coordinates'][i_frame] == 0):
+                    dlc_data[view][bp]['coordinates'][i_frame] += [trajectory_metadata[view]['crop_window'][0], trajectory_metadata[view]['crop_window'][2]]
+                    dlc_data[view][bp]['coordinates'][i_frame] -= 1
+
+    return dlc_data
+
+
+def undistort_points_loop(dlc_data, camera_params):
+    """
+    reconstruct_3d.undistort_points as it was before the trajectories moved into float32 arrays, kept as the reference
+    for the batched version
+    """
+    for view in dlc_data.keys():
+        if dlc_data[view] is None:
+            continue
+
+        for bp in dlc_data[view].keys():
+            for i_row, row in enumerate(dlc_data[view][bp]['coordinates']):
+                if not np.all(row == 0):
+                    norm_pt_ud = cv2.undistortPoints(row, camera_params['mtx'], camera_params['dist'])
+                    homogeneous_pt = np.squeeze(cv2.convertPointsToHomogeneous(norm_pt_ud))
+                    pt_ud = np.matmul(camera_params['mtx'], homogeneous_pt)
+                    pt_ud = cv2.convertPointsFromHomogeneous(np.array([pt_ud]))
+                    dlc_data[view][bp]['coordinates'][i_row, :] = np.squeeze(pt_ud)
+
+    return dlc_data
+
+
+def triangulate_points_loop(P1, P2, pts1, pts2):
+    """
+    per-point triangulation with opencv, as the reference for reconstruct_3d.triangulate_points
+    """
+    pts_shape = np.shape(pts1)[:-1]
+    pts1 = np.reshape(pts1, (-1, 2))
+    pts2 = np.reshape(pts2, (-1, 2))
+    points3d = np.full((pts1.shape[0], 3), np.nan)
+    for i_pt in range(pts1.shape[0]):
+        if np.any(np.isnan(pts1[i_pt])) or np.any(np.isnan(pts2[i_pt])):
+            continue
+        X = cv2.triangulatePoints(P1, P2, pts1[i_pt].reshape((2, 1)), pts2[i_pt].reshape((2, 1)))
+        points3d[i_pt] = X[:3, 0] / X[3, 0]
+
+    return points3d.reshape(pts_shape + (3,))
+
+
+def make_synthetic_trajectories(num_frames=300, num_bodyparts=16, missing_fraction=0.1, seed=0):
+    """
+    :return: trajectory_data, trajectory_metadata with random points inside each view's crop window, and
+        missing_fraction of the points set to NaN. The arrays are float64, as deeplabcut writes them
+    """
+    rng = np.random.default_rng(seed)
+    if num_bodyparts <= len(DEFAULT_BODYPARTS):
+        bodyparts = list(DEFAULT_BODYPARTS[:num_bodyparts])
+    else:
+        bodyparts = list(DEFAULT_BODYPARTS) + ['bp{:02d}'.format(i_bp) for i_bp in range(num_bodyparts - len(DEFAULT_BODYPARTS))]
+    # only swap pairs that are both present
+    bodyparts = [bp for bp in bodyparts if 'right' not in bp or bp.replace('right', 'left') in bodyparts]
+
+    trajectory_metadata = {view: {'bodyparts': bodyparts,
+                                  'num_frames': num_frames,
+                                  'crop_window': crop_window,
+                                  'frame_offset': 0}
+                           for view, crop_window in DEFAULT_CROP_WINDOWS.items()}
+    trajectory_data = reconstruct_3d.create_trajectory_data(trajectory_metadata, dtype=np.float64)
+
+    for view in trajectory_data['view_list']:
+        i_view = trajectory_data['view_index'][view]
+        crop_window = trajectory_metadata[view]['crop_window']
+        crop_size = (crop_window[1] - crop_window[0] + 1, crop_window[3] - crop_window[2] + 1)
+        coordinates = rng.uniform(0, 1, (len(bodyparts), num_frames, 2)) * crop_size
+        confidence = rng.uniform(0, 1, (len(bodyparts), num_frames))
+        missing = rng.uniform(0, 1, (len(bodyparts), num_frames)) < missing_fraction
+        coordinates[missing] = np.nan
+        confidence[missing] = np.nan
+        trajectory_data['coordinates'][i_view] = coordinates
+        trajectory_data['confidence'][i_view] = confidence
+
+    return trajectory_data, trajectory_metadata
+
+
+def make_synthetic_3d_trajectories(camera_params, mirrorview, num_frames=300, num_bodyparts=16, missing_fraction=0.1, seed=0):
+    """
+    :return: trajectory_data with undistorted, full-frame points made by projecting random 3D points into the direct
+        and mirror views, and the num_bodyparts x num_frames x 3 array of the 3D points
+    """
+    rng = np.random.default_rng(seed)
+    bodyparts = ['bp{:02d}'.format(i_bp) for i_bp in range(num_bodyparts)]
+    trajectory_metadata = {view: {'bodyparts': bodyparts, 'num_frames': num_frames} for view in ('direct', mirrorview)}
+    trajectory_data = reconstruct_3d.create_trajectory_data(trajectory_metadata, dtype=np.float64)
+
+    # points in a box in front of the camera
+    points3d = rng.uniform((-30., -30., 180.), (30., 30., 220.), (num_bodyparts, num_frames, 3))
+    P_direct = np.hstack((np.eye(3), np.zeros((3, 1))))
+    P_mirror = camera_params['Pn'][:, :, reconstruct_3d.PN_VIEW_INDEX[mirrorview]]
+    for view, P in (('direct', P_direct), (mirrorview, P_mirror)):
+        coordinates = reconstruct_3d.project_points(points3d, P, camera_params['mtx'])
+        coordinates[rng.uniform(0, 1, (num_bodyparts, num_frames)) < missing_fraction] = np.nan
+        trajectory_data['coordinates'][trajectory_data['view_index'][view]] = coordinates
+
+    return trajectory_data, points3d
+
+
+def load_trajectories(video_name, marked_videos_parent):
+
+    video_metadata = navigation_utilities.parse_video_name(video_name)
+    dlc_output_pickle_names, dlc_metadata_pickle_names = navigation_utilities.find_dlc_output_pickles(video_metadata, marked_videos_parent)
+
+    return reconstruct_3d.read_dlc_trajectories(dlc_output_pickle_names, dlc_metadata_pickle_names)
+
+
+def copy_trajectory_data(trajectory_data, dtype=None):
+    """
+    :param dtype: data type of the copied arrays (e.g. np.float32 for what read_dlc_trajectories stores). Defaults to
+        the type of trajectory_data
+    """
+    trajectory_copy = dict(trajectory_data)
+    trajectory_copy['coordinates'] = np.array(trajectory_data['coordinates'], dtype=dtype)
+    trajectory_copy['confidence'] = np.array(trajectory_data['confidence'], dtype=dtype)
+
+    return trajectory_copy
+
+
+def make_dlc_data(trajectory_data, trajectory_metadata):
+    """
+    :return: the points of trajectory_data in the layout the old reconstruct_3d code used - dlc_data[view][bp] holds
+        a num_frames x 2 float64 'coordinates' array, with 0 where no point was found, and a num_frames x 1
+        'confidence' array
+    """
+    dlc_data = {view: None for view in trajectory_metadata.keys()}
+    for view in trajectory_data['view_list']:
+        i_view = trajectory_data['view_index'][view]
+        dlc_data[view] = {}
+        for bp in trajectory_metadata[view]['bodyparts']:
+            i_bp = trajectory_data['bp_index'][bp]
+            dlc_data[view][bp] = {'coordinates': np.nan_to_num(trajectory_data['coordinates'][i_view, i_bp].astype(np.float64)),
+                                  'confidence': np.nan_to_num(trajectory_data['confidence'][i_view, i_bp].astype(np.float64))[:, np.newaxis]}
+
+    return dlc_data
+
+
+def dlc_data_to_trajectory_data(dlc_data, trajectory_data):
+    """
+    :return: copy of trajectory_data (float64) holding the points of dlc_data, with NaN where the coordinates are 0
+    """
+    trajectory_copy = copy_trajectory_data(trajectory_data, dtype=np.float64)
+    for view in trajectory_copy['view_list']:
+        i_view = trajectory_copy['view_index'][view]
+        for bp, bp_data in dlc_data[view].items():
+            i_bp = trajectory_copy['bp_index'][bp]
+            missing = np.all(bp_data['coordinates'] == 0, axis=1)
+            trajectory_copy['coordinates'][i_view, i_bp] = bp_data['coordinates']
+            trajectory_copy['coordinates'][i_view, i_bp, missing] = np.nan
+            trajectory_copy['confidence'][i_view, i_bp] = bp_data['confidence'][:, 0]
+            trajectory_copy['confidence'][i_view, i_bp, missing] = np.nan
+
+    return trajectory_copy
+
+
+def max_coordinate_difference(trajectory_data_1, trajectory_data_2):
+    """
+    :return: largest difference in pixels between the points of the two trajectories, or inf if points are missing in
+        different places
+    """
+    coordinates_1 = trajectory_data_1['coordinates']
+    coordinates_2 = trajectory_data_2['coordinates']
+    if not np.array_equal(np.isnan(coordinates_1), np.isnan(coordinates_2)):
+        return np.inf
+    if np.all(np.isnan(coordinates_1)):
+        return 0.
+
+    return float(np.nanmax(np.abs(coordinates_1.astype(np.float64) - coordinates_2)))
+
+
+def time_in_place_function(func, copy_func, data, extra_args, repeats):
+    """
+    time func(copy_func(data), *extra_args) on a fresh copy of data each repeat. Making the copy isn't timed
+    :return: best time in seconds, output of the last call
+    """
+    best_time = np.inf
+    output = None
+    for _ in range(repeats):
+        trajectory_copy = copy_func(data)
+        t_start = time.perf_counter()
+        output = func(trajectory_copy, *extra_args)
+        best_time = min(best_time, time.perf_counter() - t_start)
+
+    return best_time, output
+
+
+def compare_to_reference(step, loop_time, loop_output, vector_time, vector_output, trajectory_data):
+    """
+    :param loop_output: dlc_data output of the old per-point code
+    :param vector_output: trajectory_data output of the vectorized code
+    :param trajectory_data: trajectory_data that holds the layout to put loop_output into for the comparison
+    """
+    reference = dlc_data_to_trajectory_data(loop_output, trajectory_data)
+    max_difference = max(max_coordinate_difference(reference, vector_output),
+                         float(np.nanmax(np.abs(reference['confidence'] - vector_output['confidence']), initial=0.)))
+
+    return {'step': step,
+            'loop_time': loop_time,
+            'vector_time': vector_time,
+            'within_tolerance': max_difference <= FLOAT32_TOLERANCE,
+            'tolerance': FLOAT32_TOLERANCE,
+            'max_difference': max_difference}
+
+
+def benchmark_translate(trajectory_data, trajectory_metadata, repeats):
+    """
+    :param trajectory_data: float64 points. The old code gets them in its nested dictionaries, the vectorized code as
+        float32 arrays
+    """
+    dlc_data = make_dlc_data(trajectory_data, trajectory_metadata)
+    loop_time, loop_output = time_in_place_function(translate_points_loop, copy.deepcopy, dlc_data,
+                                                    (trajectory_metadata,), repeats)
+    vector_time, vector_output = time_in_place_function(reconstruct_3d.translate_points_to_full_frame,
+                                                        functools.partial(copy_trajectory_data, dtype=np.float32),
+                                                        trajectory_data, (trajectory_metadata,), repeats)
+
+    return compare_to_reference('translate_points_to_full_frame', loop_time, loop_output, vector_time, vector_output,
+                                trajectory_data)
+
+
+def benchmark_undistort(trajectory_data, trajectory_metadata, camera_params, repeats):
+
+    dlc_data = make_dlc_data(trajectory_data, trajectory_metadata)
+    loop_time, loop_output = time_in_place_function(undistort_points_loop, copy.deepcopy, dlc_data,
+                                                    (camera_params,), repeats)
+    vector_time, vector_output = time_in_place_function(reconstruct_3d.undistort_points,
+                                                        functools.partial(copy_trajectory_data, dtype=np.float32),
+                                                        trajectory_data, (camera_params,), repeats)
+
+    return compare_to_reference('undistort_points', loop_time, loop_output, vector_time, vector_output,
+                                trajectory_data)
+
+
+def benchmark_triangulate(trajectory_data, camera_params, mirrorview, repeats, points3d_true=None):
+
+    direct_pts = trajectory_data['coordinates'][trajectory_data['view_index']['direct']].astype(np.float64)
+    mirror_pts = trajectory_data['coordinates'][trajectory_data['view_index'][mirrorview]].astype(np.float64)
+    direct_norm = reconstruct_3d.normalize_points(direct_pts, camera_params['mtx'])
+    mirror_norm = reconstruct_3d.normalize_points(mirror_pts, camera_params['mtx'])
+    P_direct = np.hstack((np.eye(3), np.zeros((3, 1))))
+    P_mirror = camera_params['Pn'][:, :, reconstruct_3d.PN_VIEW_INDEX[mirrorview]]
+
+    loop_time = np.inf
+    for _ in range(repeats):
+        t_start = time.perf_counter()
+        loop_points3d = triangulate_points_loop(P_direct, P_mirror, direct_norm, mirror_norm)
+        loop_time = min(loop_time, time.perf_counter() - t_start)
+
+    # time the whole step, including normalizing the points and the reprojection error
+    vector_time = np.inf
+    for _ in range(repeats):
+        t_start = time.perf_counter()
+        trajectory_3d = reconstruct_3d.reconstruct_trajectories(trajectory_data, camera_params, mirrorview)
+        vector_time = min(vector_time, time.perf_counter() - t_start)
+
+    points3d = trajectory_3d['points3d']
+    max_difference = float(np.nanmax(np.abs(points3d - loop_points3d)))
+    tolerance = TRIANGULATION_TOLERANCE * float(np.nanmax(np.abs(loop_points3d)))
+    result = {'step': 'reconstruct_trajectories',
+              'loop_time': loop_time,
+              'vector_time': vector_time,
+              'within_tolerance': (max_difference <= tolerance and
+                                   np.array_equal(np.isnan(points3d), np.isnan(loop_points3d))),
+              'tolerance': tolerance,
+              'max_difference': max_difference,
+              'units': 'calibration units',
+              'num_points': int(np.sum(~np.isnan(points3d[..., 0]))),
+              'median_reprojection_error': float(np.nanmedian(trajectory_3d['reprojection_error']))}
+    if points3d_true is not None:
+        result['max_error'] = float(np.nanmax(np.abs(points3d - points3d_true)))
+
+    return result
+
+
+def print_benchmark(result):
+
+    comparison = 'max difference {:.3g} {} ({} tolerance of {:.3g})'.format(
+        result['max_difference'], result.get('units', 'pixels'),
+        'within' if result['within_tolerance'] else 'OUTSIDE', result['tolerance'])
+    print('{}: loop {:.2f} ms, vectorized {:.2f} ms, {:.0f}x faster, outputs {}'.format(
+        result['step'], result['loop_time'] * 1000, result['vector_time'] * 1000,
+        result['loop_time'] / result['vector_time'], comparison))
+    if 'num_points' in result:
+        print('    {} points triangulated, median reprojection error {:.3g} pixels'.format(
+            result['num_points'], result['median_reprojection_error']))
+    if 'max_error' in result:
+        print('    largest error from the true 3D points {:.3g}'.format(result['max_error']))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='benchmark the vectorized reconstruct_3d steps against the loops they replaced')
+    parser.add_argument('--frames', type=int, default=300, help='number of frames of synthetic data')
+    parser.add_argument('--bodyparts', type=int, default=16, help='number of bodyparts of synthetic data')
+    parser.add_argument('--repeats', type=int, default=10, help='number of times to time each step (best time is reported)')
+    parser.add_argument('--session_videos', type=int, default=1,
+                        help='number of videos worth of synthetic points to triangulate (e.g. 80 for a full session)')
+    parser.add_argument('--video', default=None, help='use the deeplabcut output for this video instead of synthetic data')
+    parser.add_argument('--marked_videos_parent', default=None, help='parent folder of the _marked folders (with --video)')
+    parser.add_argument('--calibration_parent', default=None, help='parent folder of the box calibration files (with --video)')
+    args = parser.parse_args(argv)
+
+    if args.video is None:
+        trajectory_data, trajectory_metadata = make_synthetic_trajectories(args.frames, args.bodyparts)
+    else:
+        trajectory_data, trajectory_metadata = load_trajectories(args.video, args.marked_videos_parent)
+
+    camera_params = DEFAULT_CAMERA_PARAMS
+    if args.video is not None and args.calibration_parent is not None:
+        video_metadata = navigation_utilities.parse_video_name(args.video)
+        calibration_file = navigation_utilities.find_calibration_file(video_metadata, args.calibration_parent)
+        if calibration_file != '':
+            camera_params = skilled_reaching_io.read_matlab_calibration(calibration_file)
+
+    print('{} views x {} bodyparts x {} frames'.format(*trajectory_data['coordinates'].shape[:3]))
+
+    results = [benchmark_translate(trajectory_data, trajectory_metadata, args.repeats)]
+    # undistort the translated points, as in triangulate_video
+    trajectory_data = reconstruct_3d.translate_points_to_full_frame(copy_trajectory_data(trajectory_data), trajectory_metadata)
+    results.append(benchmark_undistort(trajectory_data, trajectory_metadata, camera_params, args.repeats))
+
+    if args.video is None:
+        mirrorview = 'rightmirror'
+        trajectory_data_ud, points3d_true = make_synthetic_3d_trajectories(camera_params, mirrorview,
+                                                                          num_frames=args.frames * args.session_videos,
+                                                                          num_bodyparts=args.bodyparts)
+        print('triangulating {} bodyparts x {} frames'.format(args.bodyparts, args.frames * args.session_videos))
+        results.append(benchmark_triangulate(trajectory_data_ud, camera_params, mirrorview, args.repeats,
+                                             points3d_true=points3d_true))
+    elif 'Pn' in camera_params:
+        trajectory_data_ud = reconstruct_3d.undistort_points(trajectory_data, camera_params)
+        for mirrorview in ('leftmirror', 'rightmirror'):
+            if mirrorview in trajectory_data_ud['view_list']:
+                results.append(benchmark_triangulate(trajectory_data_ud, camera_params, mirrorview, args.repeats))
+    for result in results:
+        print_benchmark(result)
+
+    return results
+
+
+if __name__ == '__main__':
+    main()
@@ -1,19 +1,44 @@
 import glob
 from moviepy.editor import *
 import subprocess
+import itertools
+import hashlib
+import json
+import tempfile
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 import cv2
+import numpy as np
 import shutil
 import skilled_reaching_calibration
 import navigation_utilities
+import video_probe
 
 
-def crop_folders(video_folder_list, cropped_vids_parent, crop_params_dict, view_list, vidtype='avi', filtertype='mjpeg2jpeg'):
+def crop_folders(video_folder_list, cropped_vids_parent, crop_params_dict, view_list, vidtype='avi', filtertype='mjpeg2jpeg',
+                 multiview=True, num_workers=1, require_manifest=False, frame_range=None, return_failures=False):
     """
     :param video_folder_list:
     :param cropped_vids_parent:
     :param crop_params_dict: 4-element list [left, right, top, bottom]
     :param vidtype:
-    :return:
+    :param filtertype: 'mjpeg2jpeg' to crop via a temporary folder of jpegs, 'mjpeg_pipe' to stream the jpegs through
+        memory without writing any frames to disk, 'mjpeg_lossless' to crop the jpegs in the compressed domain with
+        jpegtran (crop windows are expanded to jpeg block boundaries, and the expanded window is what goes into the
+        cropped video name), or '' to crop and re-encode with ffmpeg's crop filter
+    :param multiview: if True (and filtertype is 'mjpeg2jpeg', 'mjpeg_pipe', or 'mjpeg_lossless'), each raw video is
+        decoded once and all views that still need to be cropped are written in the same pass
+    :param num_workers: number of processes to crop videos in parallel. If 1, videos are cropped one at a time in this
+        process
+    :param require_manifest: if True, existing cropped videos without a crop manifest (e.g., made before manifests
+        were written) are cropped again. If False, they are assumed to be complete and skipped
+    :param frame_range: None to keep every frame, or a (first_frame, end_frame) tuple of 0-based frame numbers (end_frame
+        is exclusive) to keep only a window of frames around the reach. The frame range is added to the cropped video
+        names (see cropped_vid_name) so that frames can be mapped back to the original videos downstream
+    :param return_failures: if True, also return the crop results for the videos that failed
+    :return: cropped_video_directories
+        failed_results - list of crop_video_job result dictionaries for the videos that failed to crop (only if
+            return_failures is True)
     """
 
     cropped_video_directories = navigation_utilities.create_cropped_video_destination_list(cropped_vids_parent, video_folder_list, view_list)
@@ -21,37 +46,218 @@ def crop_folders(video_folder_list, cropped_vids_parent, crop_params_dict, view_
     if vidtype[0] != '.':
         vidtype = '.' + vidtype
 
+    # each job is one raw video along with the folders to put each of its cropped views in
+    crop_jobs = []
     for i_path, vids_path in enumerate(video_folder_list):
         # find files with extension vidtype
         vids_list = glob.glob(os.path.join(vids_path, '*' + vidtype))
 
+        dest_folders = {}
         for i_view, view_name in enumerate(view_list):
             dest_folder = cropped_video_directories[i_view][i_path]
             if not os.path.isdir(dest_folder):
                 os.makedirs(dest_folder)
+            dest_folders[view_name] = dest_folder
+
+        for full_vid_path in vids_list:
+            crop_jobs.append((full_vid_path, dest_folders))
 
-            for full_vid_path in vids_list:
-                crop_params = crop_params_dict[view_name]
-                dest_name = cropped_vid_name(full_vid_path, dest_folder, view_name, crop_params)
+    # read the frame sizes of all the videos up front (in parallel, from the folders' probe caches where possible) so
+    # the crop jobs don't each have to open their video to check the crop windows
+    video_probe.probe_folders(video_folder_list, num_workers=num_workers)
 
-                # if video was already cropped, skip it
-                if os.path.exists(dest_name):
-                    print(dest_name + ' already exists, skipping')
-                    continue
-                else:
-                    crop_video(full_vid_path, dest_name, crop_params, view_name, filtertype=filtertype)
+    crop_results = run_crop_jobs(crop_jobs, crop_params_dict, filtertype=filtertype, multiview=multiview,
+                                 num_workers=num_workers, require_manifest=require_manifest, frame_range=frame_range)
 
+    failed_results = [crop_result for crop_result in crop_results if not crop_result['success']]
+    for crop_result in failed_results:
+        print('failed to crop {}: {}'.format(crop_result['video'], crop_result['error']))
+    print('cropped {:d} of {:d} videos'.format(len(crop_results) - len(failed_results), len(crop_results)))
+
+    if return_failures:
+        return cropped_video_directories, failed_results
     return cropped_video_directories
 
 
-def cropped_vid_name(full_vid_path, dest_folder, view_name, crop_params):
+def run_crop_jobs(crop_jobs, crop_params_dict, filtertype='mjpeg2jpeg', multiview=True, num_workers=1,
+                  require_manifest=False, frame_range=None):
+    """
+    run a list of crop jobs, either serially or spread across a pool of processes
+
+    :param crop_jobs: list of (full_vid_path, dest_folders) tuples, where dest_folders is a dictionary with a key for
+        each view to crop out of the video at full_vid_path, and each value is the folder to put that cropped view in
+    :param crop_params_dict: dictionary where each key is a view name and each value is a 4-element list
+        [left, right, top, bottom]
+    :param filtertype: see crop_folders
+    :param multiview: see crop_folders
+    :param num_workers: number of processes to crop videos in parallel. If 1, videos are cropped one at a time in this
+        process
+    :param require_manifest: see crop_folders
+    :param frame_range: see crop_folders
+    :return: crop_results - list of dictionaries returned by crop_video_job, in the same order as crop_jobs
+    """
+    if num_workers <= 1:
+        return [crop_video_job(full_vid_path, dest_folders, crop_params_dict, filtertype, multiview, require_manifest,
+                               frame_range)
+                for full_vid_path, dest_folders in crop_jobs]
+
+    crop_results = []
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(crop_video_job, full_vid_path, dest_folders, crop_params_dict, filtertype, multiview,
+                                   require_manifest, frame_range)
+                   for full_vid_path, dest_folders in crop_jobs]
+        for future, (full_vid_path, dest_folders) in zip(futures, crop_jobs):
+            try:
+                crop_results.append(future.result())
+            except Exception as e:
+                # e.g., the worker process died
+                crop_results.append({'video': full_vid_path,
+                                     'views': [],
+                                     'success': False,
+                                     'error': repr(e),
+                                     'elapsed': 0.})
+
+    return crop_results
+
+
+def crop_video_job(full_vid_path, dest_folders, crop_params_dict, filtertype='mjpeg2jpeg', multiview=True,
+                   require_manifest=False, frame_range=None):
+    """
+    crop all the views that haven't been cropped yet out of a single raw video. Errors are caught and reported in the
+    return value so that one bad video doesn't stop the rest of a batch.
+
+    cropped videos are written to a hidden partial file. Once cropping succeeds, a crop manifest is written next to
+    where each one will go (see write_crop_manifest), and only then is it renamed to its final name. A crop that was
+    killed partway through therefore never shows up under the final name, or without its manifest
+
+    :param full_vid_path: full path to the raw video
+    :param dest_folders: dictionary where each key is a view name and each value is the folder to put that cropped
+        view in
+    :param crop_params_dict: dictionary where each key is a view name and each value is a 4-element list
+        [left, right, top, bottom]
+    :param filtertype: see crop_folders
+    :param multiview: see crop_folders
+    :param require_manifest: see crop_folders
+    :param frame_range: see crop_folders
+    :return: crop_result - dictionary with keys
+        video - full_vid_path
+        views - list of views that were cropped (views that were already cropped are skipped)
+        success - True if all views were cropped without errors
+        error - error message if success is False, '' otherwise
+        elapsed - time spent on this video in seconds
+    """
+    crop_result = {'video': full_vid_path,
+                   'views': [],
+                   'success': True,
+                   'error': '',
+                   'elapsed': 0.}
+    start_time = time.time()
+
+    partial_names = {}
+    try:
+        if filtertype == 'mjpeg_lossless':
+            # lossless crops can only be made on jpeg block boundaries, so expand the crop windows to match
+            jpeg_layout = probe_mjpeg_layout(full_vid_path)
+            vid_crop_params = {view_name: align_crop_window(crop_params_dict[view_name], jpeg_layout, view_name)
+                               for view_name in dest_folders}
+        else:
+            vid_crop_params = crop_params_dict
+
+        # make sure the crop windows fit in the frame before spending time decoding the video
+        video_info = video_probe.get_video_info(full_vid_path)
+        if video_info is not None:
+            check_crop_windows(full_vid_path, video_info, {view_name: vid_crop_params[view_name]
+                                                           for view_name in dest_folders}, frame_range=frame_range)
+
+        # collect the views that still need to be cropped for this video
+        dest_names = {}
+        for view_name, dest_folder in dest_folders.items():
+            crop_params = vid_crop_params[view_name]
+            dest_name = cropped_vid_name(full_vid_path, dest_folder, view_name, crop_params, frame_range=frame_range)
+
+            # if video was already cropped, skip it
+            if crop_output_is_valid(dest_name, full_vid_path, crop_params, require_manifest=require_manifest):
+                print(dest_name + ' already exists, skipping')
+                continue
+            dest_names[view_name] = dest_name
+
+        # crop into partial files, removing any left over from an earlier run that died
+        partial_names = {view_name: partial_vid_name(dest_name) for view_name, dest_name in dest_names.items()}
+        for partial_name in partial_names.values():
+            if os.path.exists(partial_name):
+                os.remove(partial_name)
+
+        if not dest_names:
+            num_frames = {}
+        elif multiview and filtertype == 'mjpeg2jpeg':
+            num_frames = crop_video_multiview(full_vid_path, partial_names, vid_crop_params, frame_range=frame_range)
+        elif multiview and filtertype == 'mjpeg_pipe':
+            num_frames = crop_video_stream(full_vid_path, partial_names, vid_crop_params, frame_range=frame_range)
+        elif multiview and filtertype == 'mjpeg_lossless':
+            num_frames = crop_video_lossless(full_vid_path, partial_names, vid_crop_params, frame_range=frame_range)
+        else:
+            num_frames = {}
+            for view_name, partial_name in partial_names.items():
+                num_frames[view_name] = crop_video(full_vid_path, partial_name, vid_crop_params[view_name], view_name,
+                                                   filtertype=filtertype, frame_range=frame_range)
+        if not isinstance(num_frames, dict):
+            num_frames = {view_name: num_frames for view_name in dest_names}
+
+        # the crop finished, so record how the cropped videos were made and then move them into place. The manifest
+        # goes first, so a crash in between leaves a manifest that doesn't match any video (which is cropped again)
+        # rather than a video with no manifest (which would be trusted)
+        for view_name, dest_name in dest_names.items():
+            write_crop_manifest(dest_name, full_vid_path, vid_crop_params[view_name], view_name, filtertype,
+                                num_frames[view_name], frame_range=frame_range,
+                                cropped_file=partial_names[view_name])
+            os.replace(partial_names[view_name], dest_name)
+
+        crop_result['views'] = list(dest_names.keys())
+    except Exception as e:
+        crop_result['success'] = False
+        crop_result['error'] = repr(e)
+        for partial_name in partial_names.values():
+            if os.path.exists(partial_name):
+                os.remove(partial_name)
+
+    crop_result['elapsed'] = time.time() - start_time
+
+    return crop_result
+
+
+def check_crop_windows(full_vid_path, video_info, crop_params_dict, frame_range=None):
+    """
+    raise an error if any of the crop windows extend past the edge of the video frame
+
+    :param full_vid_path: name of the original video, for the error message
+    :param video_info: dictionary from video_probe.get_video_info
+    :param crop_params_dict: dictionary where each key is a view name and each value is a 4-element list
+        [left, right, top, bottom]
+    :param frame_range: see crop_folders. A warning is printed if it runs past the end of the video
+    :return:
+    """
+    height, width = video_info['im_size']
+    for view_name, crop_params in crop_params_dict.items():
+        left, right, top, bottom = crop_params
+        if left < 1 or top < 1 or right > width or bottom > height:
+            raise ValueError('{} crop window {} does not fit in the {:d} x {:d} frames of {}'.format(
+                view_name, crop_params, width, height, full_vid_path))
+
+    if frame_range is not None and frame_range[1] > video_info['num_frames']:
+        print('frame range {} runs past the end of {} ({:d} frames)'.format(frame_range, full_vid_path,
+                                                                           video_info['num_frames']))
+
+
+def cropped_vid_name(full_vid_path, dest_folder, view_name, crop_params, frame_range=None):
     """
     function to return the name to be used for the cropped video
     :param full_vid_path:
     :param dest_folder: path in which to put the new folder with the cropped videos
     :param view_name: "direct", "leftmirror", or "rightmirror"
     :param crop_params: 4-element list [left, right, top, bottom]
-    :return: full_dest_name - name of output file. Is name of input file with "_cropped_left-top-width-height" appended
+    :param frame_range: None if all frames are kept, or a (first_frame, end_frame) tuple of 0-based frame numbers
+    :return: full_dest_name - name of output file. Is name of input file with "_cropped_left-top-width-height" appended,
+        followed by "_fFIRST-END" if only a range of frames was kept
     """
     vid_root, vid_ext = os.path.splitext(full_vid_path)
     vid_path, vid_name = os.path.split(vid_root)
@@ -67,71 +273,663 @@ def cropped_vid_name(full_vid_path, dest_folder, view_name, crop_params):
     if not os.path.isdir(dest_folder):
         os.makedirs(dest_folder)
 
-    dest_name = vid_name + '_' + view_name + '_' + crop_params_str + vid_ext
+    dest_name = vid_name + '_' + view_name + '_' + crop_params_str
+    if frame_range is not None:
+        dest_name += '_f{:d}-{:d}'.format(frame_range[0], frame_range[1])
+    dest_name += vid_ext
 
     full_dest_name = os.path.join(dest_folder, dest_name)
 
     return full_dest_name
 
 
-def crop_video(vid_path_in, vid_path_out, crop_params, view_name, filtertype='mjpeg2jpeg'):
+def partial_vid_name(full_dest_name):
+    """
+    name to write a cropped video to until it is complete. The leading '.' keeps partial videos out of the glob
+    patterns used to find cropped videos, and the extension is kept so ffmpeg still picks the right container
+
+    :param full_dest_name: final name of the cropped video
+    :return: full_partial_name
+    """
+    dest_folder, dest_name = os.path.split(full_dest_name)
+    dest_root, dest_ext = os.path.splitext(dest_name)
+
+    return os.path.join(dest_folder, '.' + dest_root + '.partial' + dest_ext)
+
+
+def crop_manifest_name(full_dest_name):
+    """
+    name of the crop manifest that goes with a cropped video
+
+    :param full_dest_name: name of the cropped video
+    :return: manifest_name
+    """
+    dest_root, _ = os.path.splitext(full_dest_name)
+
+    return dest_root + '.crop.json'
+
+
+def write_crop_manifest(full_dest_name, full_vid_path, crop_params, view_name, filtertype, num_frames, frame_range=None,
+                        cropped_file=None):
+    """
+    write a json file next to a cropped video recording what it was cropped from and what it should look like, so that
+    later runs can tell complete, up-to-date crops from stale or partial ones without opening the video
+
+    :param full_dest_name: name of the cropped video
+    :param full_vid_path: name of the original video it was cropped from
+    :param crop_params: 4-element list [left, right, top, bottom] actually used for the crop
+    :param view_name: "direct", "leftmirror", or "rightmirror"
+    :param filtertype: filtertype used for the crop (see crop_folders)
+    :param num_frames: number of frames in the cropped video, or None if unknown
+    :param frame_range: None if all frames were kept, or the (first_frame, end_frame) tuple of frames that were kept
+    :param cropped_file: file the cropped video is in now, if it hasn't been moved to full_dest_name yet (e.g., the
+        partial file it was cropped into). Renaming it afterwards keeps the size and modification time the manifest
+        records. Default is full_dest_name
+    :return: crop_manifest - dictionary that was written to the manifest file
+    """
+    if cropped_file is None:
+        cropped_file = full_dest_name
+    src_stat = os.stat(full_vid_path)
+    dest_stat = os.stat(cropped_file)
+    crop_manifest = {'source': full_vid_path,
+                     'source_size': src_stat.st_size,
+                     'source_mtime': src_stat.st_mtime,
+                     'crop_window': [int(cp) for cp in crop_params],
+                     'view': view_name,
+                     'filtertype': filtertype,
+                     'num_frames': num_frames,
+                     'frame_range': None if frame_range is None else [int(fr) for fr in frame_range],
+                     'frame_offset': 0 if frame_range is None else int(frame_range[0]),
+                     'size': dest_stat.st_size,
+                     'mtime': dest_stat.st_mtime,
+                     'md5': file_checksum(cropped_file)
+                     }
+
+    manifest_name = crop_manifest_name(full_dest_name)
+    partial_manifest_name = manifest_name + '.partial'
+    with open(partial_manifest_name, 'w') as f:
+        json.dump(crop_manifest, f, indent=1)
+    os.replace(partial_manifest_name, manifest_name)
+
+    return crop_manifest
+
+
+def read_crop_manifest(full_dest_name):
+    """
+    :param full_dest_name: name of the cropped video
+    :return: crop_manifest - dictionary written by write_crop_manifest, or None if there isn't a (readable) manifest
+    """
+    try:
+        with open(crop_manifest_name(full_dest_name), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def crop_output_is_valid(full_dest_name, full_vid_path, crop_params, require_manifest=False, verify_checksum=False):
+    """
+    check whether a cropped video exists and is a complete crop of the current version of the original video
+
+    :param full_dest_name: name of the cropped video
+    :param full_vid_path: name of the original video
+    :param crop_params: 4-element list [left, right, top, bottom] the video should have been cropped with
+    :param require_manifest: if False, a cropped video without a manifest is assumed to be valid (videos cropped before
+        manifests were introduced)
+    :param verify_checksum: if True, also re-compute the checksum of the cropped video. Otherwise only its size and
+        modification time are compared with the manifest
+    :return: True if the cropped video can be used as is
+    """
+    if not os.path.exists(full_dest_name):
+        return False
+
+    crop_manifest = read_crop_manifest(full_dest_name)
+    if crop_manifest is None:
+        return not require_manifest
+
+    src_stat = os.stat(full_vid_path)
+    dest_stat = os.stat(full_dest_name)
+    if crop_manifest['source_size'] != src_stat.st_size or crop_manifest['source_mtime'] != src_stat.st_mtime:
+        # original video changed since it was cropped
+        return False
+    if crop_manifest['crop_window'] != [int(cp) for cp in crop_params]:
+        return False
+    if crop_manifest['size'] != dest_stat.st_size or crop_manifest['mtime'] != dest_stat.st_mtime:
+        # cropped video was modified or replaced
+        return False
+    if verify_checksum and crop_manifest['md5'] != file_checksum(full_dest_name):
+        return False
+
+    return True
+
+
+def file_checksum(filename, chunk_size=1 << 24):
+    """
+    :param filename:
+    :param chunk_size: number of bytes to read at a time
+    :return: hex md5 digest of the file contents
+    """
+    md5 = hashlib.md5()
+    with open(filename, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+
+    return md5.hexdigest()
+
+
+def crop_video(vid_path_in, vid_path_out, crop_params, view_name, filtertype='mjpeg2jpeg', frame_range=None):
 
     # crop videos losslessly. Note that the trick of converting the video into a series of jpegs, cropping them, and
     # re-encoding is a trick that only works because our videos are encoded as mjpegs (which apparently is an old format)
 
-    x1, x2, y1, y2 = [cp for cp in crop_params]
-    w = x2 - x1 + 1
-    h = y2 - y1 + 1
-    vid_root, vid_name = os.path.split(vid_path_out)
-
-    #todo: speed this up by cropping all 3 views from the same jpegs?
     if filtertype == 'mjpeg2jpeg':
-        jpg_temp_folder = os.path.join(vid_root, 'temp')
+        return crop_video_multiview(vid_path_in, {view_name: vid_path_out}, {view_name: crop_params},
+                                    frame_range=frame_range)
+    elif filtertype == 'mjpeg_pipe':
+        return crop_video_stream(vid_path_in, {view_name: vid_path_out}, {view_name: crop_params},
+                                 frame_range=frame_range)
+    elif filtertype == 'mjpeg_lossless':
+        # crop_params must already be aligned to jpeg blocks (see align_crop_window)
+        return crop_video_lossless(vid_path_in, {view_name: vid_path_out}, {view_name: crop_params},
+                                   frame_range=frame_range)
+    elif filtertype == '':
+        if frame_range is None:
+            trim_filter = ''
+        else:
+            trim_filter = f"trim=start_frame={frame_range[0]}:end_frame={frame_range[1]},setpts=PTS-STARTPTS,"
+        command = (
+            f"ffmpeg -n -i {vid_path_in} "
+            f"-filter:v {trim_filter}{ffmpeg_crop_filter(crop_params)} "
+            f"-c:v h264 -c:a copy {vid_path_out}"
+        )
+        if subprocess.call(command, shell=True) != 0:
+            raise RuntimeError('ffmpeg failed to crop {}'.format(vid_path_in))
+        # number of frames isn't known without re-opening the video
+        return None
 
-        # if path already exists, delete the old temp folder. Either way, make a new one.
-        if os.path.isdir(jpg_temp_folder):
-            shutil.rmtree(jpg_temp_folder)
-        os.mkdir(jpg_temp_folder)
 
-        full_jpg_path = os.path.join(jpg_temp_folder,'frame_%d.jpg')
-        # full_jpg_crop_path = os.path.join(jpg_temp_folder, 'frame_crop_%d.jpg')
+def crop_video_multiview(vid_path_in, vid_paths_out, crop_params_dict, frame_range=None):
+    """
+    crop several views out of the same mjpeg video, decoding the original video to jpegs only once
+
+    :param vid_path_in: full path to the original video
+    :param vid_paths_out: dictionary where each key is a view name ('direct', 'leftmirror', 'rightmirror') and each
+        value is the full path of the cropped video to create for that view
+    :param crop_params_dict: dictionary where each key is a view name and each value is a 4-element list
+        [left, right, top, bottom]
+    :param frame_range: None to keep every frame, or a (first_frame, end_frame) tuple of 0-based frame numbers to keep
+    :return: num_frames - number of frames written to each cropped video
+    """
+    view_list = tuple(vid_paths_out.keys())
+
+    # put the decoded jpegs next to the first output video. The temp folder gets a unique name so that crops of
+    # different videos running in parallel into the same destination folder don't collide
+    vid_root, vid_name = os.path.split(vid_paths_out[view_list[0]])
+    vid_name, _ = os.path.splitext(vid_name)
+    jpg_temp_folder = tempfile.mkdtemp(prefix=vid_name + '_temp_', dir=vid_root)
+
+    try:
+        full_jpg_path = os.path.join(jpg_temp_folder, 'frame_%d.jpg')
+        # jpegs are numbered from 1, so the frames to keep are frame_{first_frame + 1} through frame_{end_frame}
+        if frame_range is None:
+            first_jpg_num = 1
+            frame_limit = ''
+        else:
+            first_jpg_num = frame_range[0] + 1
+            frame_limit = f"-frames:v {frame_range[1]} "
         command = (
             f"ffmpeg -i {vid_path_in} "
-            f"-c:v copy -bsf:v mjpeg2jpeg {full_jpg_path} "
+            f"{frame_limit}-c:v copy -bsf:v mjpeg2jpeg {full_jpg_path} "
         )
-        subprocess.call(command, shell=True)
+        if subprocess.call(command, shell=True) != 0:
+            raise RuntimeError('ffmpeg failed to extract jpegs from {}'.format(vid_path_in))
 
-        # find the list of jpg frames that were just made, crop them, and resave them
+        # each view gets its own folder of cropped jpegs with the same frame names as the decoded jpegs
+        view_jpg_folders = {view_name: os.path.join(jpg_temp_folder, view_name) for view_name in view_list}
+        for view_jpg_folder in view_jpg_folders.values():
+            os.mkdir(view_jpg_folder)
+
+        # find the list of jpg frames that were just made, crop each view out of them, and save the cropped frames
         jpg_list = glob.glob(os.path.join(jpg_temp_folder, '*.jpg'))
+        jpg_list = [jpg_name for jpg_name in jpg_list if jpg_frame_number(jpg_name) >= first_jpg_num]
         for jpg_name in jpg_list:
             img = cv2.imread(jpg_name)
-            cropped_img = img[y1-1:y2-1, x1-1:x2-1, :]
-            if view_name == 'rightmirror':
-                # flip the image left to right so it can be run through a single "side mirror" DLC network
-                cropped_img = cv2.flip(cropped_img, 1)   # 2nd argument flipCode > 0 indicates flip horizontally
-            cv2.imwrite(jpg_name, cropped_img)
-
-        # turn the cropped jpegs into a new movie
-        command = (
-            f"ffmpeg -i {full_jpg_path} "
-            f"-c:v copy {vid_path_out}"
-        )
-        subprocess.call(command, shell=True)
+            _, jpg_frame_name = os.path.split(jpg_name)
+            for view_name in view_list:
+                cropped_img = crop_frame(img, crop_params_dict[view_name], view_name)
+                cv2.imwrite(os.path.join(view_jpg_folders[view_name], jpg_frame_name), cropped_img)
 
+        # turn the cropped jpegs into a new movie for each view
+        for view_name in view_list:
+            view_jpg_path = os.path.join(view_jpg_folders[view_name], 'frame_%d.jpg')
+            command = (
+                f"ffmpeg -start_number {first_jpg_num} -i {view_jpg_path} "
+                f"-c:v copy {vid_paths_out[view_name]}"
+            )
+            if subprocess.call(command, shell=True) != 0:
+                raise RuntimeError('ffmpeg failed to write {}'.format(vid_paths_out[view_name]))
+    finally:
         # destroy the temp jpeg folder
         shutil.rmtree(jpg_temp_folder)
-    elif filtertype == '':
-        command = (
-            f"ffmpeg -n -i {vid_path_in} "
-            f"-filter:v crop={w}:{h}:{x1}:{y1} "
-            f"-c:v h264 -c:a copy {vid_path_out}"
-        )
-        subprocess.call(command, shell=True)
-        pass
+
+    return len(jpg_list)
+
+
+def jpg_frame_number(jpg_name):
+    """
+    :param jpg_name: name of a jpeg extracted by ffmpeg in the form frame_N.jpg
+    :return: N
+    """
+    _, jpg_name = os.path.split(jpg_name)
+    jpg_root, _ = os.path.splitext(jpg_name)
+
+    return int(jpg_root.split('_')[-1])
+
+
+def crop_video_stream(vid_path_in, vid_paths_out, crop_params_dict, frame_range=None):
+    """
+    crop several views out of the same mjpeg video without writing any frames to disk. ffmpeg streams the jpeg frames
+    of the original video through a pipe, each frame is cropped in memory, and the cropped jpegs are piped into one
+    ffmpeg process per view that muxes them into the output video
+
+    :param vid_path_in: full path to the original video
+    :param vid_paths_out: dictionary where each key is a view name ('direct', 'leftmirror', 'rightmirror') and each
+        value is the full path of the cropped video to create for that view
+    :param crop_params_dict: dictionary where each key is a view name and each value is a 4-element list
+        [left, right, top, bottom]
+    :param frame_range: None to keep every frame, or a (first_frame, end_frame) tuple of 0-based frame numbers to keep
+    :return: num_frames - number of frames written to each cropped video
+    """
+    decoder = start_jpeg_stream(vid_path_in, frame_range=frame_range)
+
+    encoders = {}
+    for view_name, vid_path_out in vid_paths_out.items():
+        encode_command = ['ffmpeg', '-loglevel', 'error',
+                          '-f', 'image2pipe', '-c:v', 'mjpeg', '-i', '-',
+                          '-c:v', 'copy', vid_path_out]
+        encoders[view_name] = subprocess.Popen(encode_command, stdin=subprocess.PIPE)
+
+    num_frames = 0
+    try:
+        for jpg_bytes in read_jpeg_stream(decoder.stdout, skip_frames=first_frame(frame_range)):
+            img = cv2.imdecode(np.frombuffer(jpg_bytes, dtype=np.uint8), cv2.IMREAD_COLOR)
+            for view_name, encoder in encoders.items():
+                cropped_img = crop_frame(img, crop_params_dict[view_name], view_name)
+                _, cropped_jpg = cv2.imencode('.jpg', cropped_img)
+                encoder.stdin.write(cropped_jpg.tobytes())
+            num_frames += 1
+    finally:
+        decoder.stdout.close()
+        decoder.wait()
+        for encoder in encoders.values():
+            encoder.stdin.close()
+            encoder.wait()
+
+    check_ffmpeg_returncodes(vid_path_in, decoder, encoders)
+
+    return num_frames
+
+
+def crop_video_lossless(vid_path_in, vid_paths_out, crop_params_dict, num_threads=8, frames_per_batch=64,
+                        frame_range=None):
+    """
+    crop several views out of the same mjpeg video without decoding any pixels. Each jpeg frame is cropped (and
+    flipped for the right mirror) in the compressed domain by jpegtran, so there is no generation loss and very little
+    cpu work per frame. Frames are streamed through pipes as in crop_video_stream
+
+    :param vid_path_in: full path to the original video
+    :param vid_paths_out: dictionary where each key is a view name ('direct', 'leftmirror', 'rightmirror') and each
+        value is the full path of the cropped video to create for that view
+    :param crop_params_dict: dictionary where each key is a view name and each value is a 4-element list
+        [left, right, top, bottom]. These must already be aligned to jpeg block boundaries by align_crop_window
+    :param num_threads: number of jpegtran processes to run at once
+    :param frames_per_batch: number of frames to hold in memory at a time
+    :param frame_range: None to keep every frame, or a (first_frame, end_frame) tuple of 0-based frame numbers to keep
+    :return: num_frames - number of frames written to each cropped video
+    """
+    if shutil.which('jpegtran') is None:
+        raise FileNotFoundError('jpegtran (from libjpeg-turbo) has to be on the path to crop videos losslessly')
+
+    decoder = start_jpeg_stream(vid_path_in, frame_range=frame_range)
+
+    encoders = {}
+    for view_name, vid_path_out in vid_paths_out.items():
+        encode_command = ['ffmpeg', '-loglevel', 'error',
+                          '-f', 'image2pipe', '-c:v', 'mjpeg', '-i', '-',
+                          '-c:v', 'copy', vid_path_out]
+        encoders[view_name] = subprocess.Popen(encode_command, stdin=subprocess.PIPE)
+
+    def crop_all_views(jpg_bytes, jpeg_layout):
+        return {view_name: crop_jpeg_lossless(jpg_bytes, crop_params_dict[view_name], view_name, jpeg_layout)
+                for view_name in encoders}
+
+    num_frames = 0
+    jpeg_layout = None
+    try:
+        jpg_frames = read_jpeg_stream(decoder.stdout, skip_frames=first_frame(frame_range))
+        with ThreadPoolExecutor(max_workers=num_threads) as executor:
+            while True:
+                frame_batch = list(itertools.islice(jpg_frames, frames_per_batch))
+                if not frame_batch:
+                    break
+                if jpeg_layout is None:
+                    # every frame of an mjpeg video has the same size and block layout
+                    jpeg_layout = read_jpeg_layout(frame_batch[0])
+                # executor.map returns the cropped frames in the same order they were read in
+                for cropped_jpgs in executor.map(crop_all_views, frame_batch, itertools.repeat(jpeg_layout)):
+                    for view_name, encoder in encoders.items():
+                        encoder.stdin.write(cropped_jpgs[view_name])
+                    num_frames += 1
+    finally:
+        decoder.stdout.close()
+        decoder.wait()
+        for encoder in encoders.values():
+            encoder.stdin.close()
+            encoder.wait()
+
+    check_ffmpeg_returncodes(vid_path_in, decoder, encoders)
+
+    return num_frames
+
+
+def crop_jpeg_lossless(jpg_bytes, crop_params, view_name, jpeg_layout):
+    """
+    crop a single view out of a jpeg frame in the compressed domain using jpegtran, flipping the right mirror in the
+    same jpegtran call
+
+    :param jpg_bytes: bytes of the full frame jpeg
+    :param crop_params: 4-element list [left, right, top, bottom] aligned to jpeg block boundaries
+    :param view_name: "direct", "leftmirror", or "rightmirror"
+    :param jpeg_layout: dictionary returned by read_jpeg_layout for the video's frames
+    :return: bytes of the cropped jpeg
+    """
+    crop_command = ['jpegtran', '-copy', 'none'] + jpegtran_crop_args(crop_params, view_name, jpeg_layout)
+
+    return subprocess.run(crop_command, input=jpg_bytes, stdout=subprocess.PIPE, check=True).stdout
+
+
+def jpegtran_crop_args(crop_params, view_name, jpeg_layout):
+    """
+    :param crop_params: 4-element list [left, right, top, bottom] aligned to jpeg block boundaries
+    :param view_name: "direct", "leftmirror", or "rightmirror"
+    :param jpeg_layout: dictionary returned by read_jpeg_layout for the video's frames
+    :return: list of jpegtran arguments that crop out the same pixels as crop_frame (and flip the right mirror)
+    """
+    x1, x2, y1, y2 = [cp for cp in crop_params]
+    crop_width, crop_height = crop_window_size(crop_params)
+    x_offset = x1 - 1
+    crop_args = []
+
+    if view_name == 'rightmirror':
+        # flip the image left to right so it can be run through a single "side mirror" DLC network. jpegtran crops
+        # after flipping, so the window is given in flipped coordinates: the whole blocks of the frame are mirrored
+        # in place and a partial block at the right edge is left where it is, untransformed. The window has to be
+        # block-aligned for the flip to be lossless (which -perfect used to check, but -perfect looks at the whole
+        # frame when it is combined with -crop)
+        mcu_w = jpeg_layout['mcu_width']
+        if (x1 - 1) % mcu_w != 0 or x2 % mcu_w != 0:
+            raise ValueError('crop window {} is not aligned to {:d} pixel jpeg blocks'.format(crop_params, mcu_w))
+        full_block_width = (jpeg_layout['width'] // mcu_w) * mcu_w
+        x_offset = full_block_width - x2
+        crop_args += ['-flip', 'horizontal']
+
+    crop_args += ['-crop', '{:d}x{:d}+{:d}+{:d}'.format(crop_width, crop_height, x_offset, y1 - 1)]
+
+    return crop_args
+
+
+def align_crop_window(crop_params, jpeg_layout, view_name):
+    """
+    expand a crop window outward so that its edges fall on jpeg MCU block boundaries, which is required to crop (and
+    flip) jpegs losslessly. The window is clipped to the frame. Where the clipped window ends at a partial block on the
+    right edge of the frame and has to be flipped, the partial block is dropped since it can't be flipped losslessly.
+
+    crop windows are 1-based and inclusive, as in the other crop modes (see crop_window_size)
+
+    :param crop_params: 4-element list [left, right, top, bottom]
+    :param jpeg_layout: dictionary returned by read_jpeg_layout
+    :param view_name: "direct", "leftmirror", or "rightmirror"
+    :return: aligned_crop_params - 4-element list [left, right, top, bottom] aligned to the jpeg blocks
+    """
+    x1, x2, y1, y2 = [cp for cp in crop_params]
+    mcu_w = jpeg_layout['mcu_width']
+    mcu_h = jpeg_layout['mcu_height']
+
+    # 0-based first pixel and 0-based (exclusive) last pixel of the window
+    left = ((x1 - 1) // mcu_w) * mcu_w
+    right = min(-(-x2 // mcu_w) * mcu_w, jpeg_layout['width'])
+    top = ((y1 - 1) // mcu_h) * mcu_h
+    bottom = min(-(-y2 // mcu_h) * mcu_h, jpeg_layout['height'])
+
+    if view_name == 'rightmirror' and (right - left) % mcu_w != 0:
+        right = left + ((right - left) // mcu_w) * mcu_w
+
+    return [left + 1, right, top + 1, bottom]
+
+
+def probe_mjpeg_layout(vid_path):
+    """
+    read the frame size and jpeg block size from the first frame of an mjpeg video
+
+    :param vid_path: full path to the video
+    :return: jpeg_layout - dictionary returned by read_jpeg_layout
+    """
+    probe_command = ['ffmpeg', '-loglevel', 'error',
+                     '-i', vid_path,
+                     '-frames:v', '1', '-c:v', 'copy', '-bsf:v', 'mjpeg2jpeg', '-f', 'image2pipe', '-']
+    first_frame = subprocess.run(probe_command, stdout=subprocess.PIPE, check=True).stdout
+
+    return read_jpeg_layout(first_frame)
+
+
+def read_jpeg_layout(jpg_bytes):
+    """
+    read the frame header of a jpeg to find the image size and the size of its minimum coded units (MCUs), which set
+    the block boundaries that lossless crops have to fall on
+
+    :param jpg_bytes: bytes of a jpeg
+    :return: jpeg_layout - dictionary with keys 'width', 'height', 'mcu_width', 'mcu_height'
+    """
+    pos = 2
+    while pos + 3 < len(jpg_bytes):
+        if jpg_bytes[pos] != 0xFF:
+            raise ValueError('corrupt jpeg at byte {:d}'.format(pos))
+        marker = jpg_bytes[pos + 1]
+        if marker == 0xFF:
+            pos += 1
+            continue
+        if marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            pos += 2
+            continue
+
+        if 0xC0 <= marker <= 0xCF and marker not in (0xC4, 0xC8, 0xCC):
+            # start of frame: precision, height, width, number of components, then 3 bytes per component
+            height = (jpg_bytes[pos + 5] << 8) | jpg_bytes[pos + 6]
+            width = (jpg_bytes[pos + 7] << 8) | jpg_bytes[pos + 8]
+            num_components = jpg_bytes[pos + 9]
+            sampling_factors = [jpg_bytes[pos + 11 + 3 * i_comp] for i_comp in range(num_components)]
+            if num_components == 1:
+                # single-component images are always coded in 8x8 blocks
+                max_h, max_v = 1, 1
+            else:
+                max_h = max(sf >> 4 for sf in sampling_factors)
+                max_v = max(sf & 0x0F for sf in sampling_factors)
+            jpeg_layout = {'width': width,
+                           'height': height,
+                           'mcu_width': 8 * max_h,
+                           'mcu_height': 8 * max_v
+                           }
+            return jpeg_layout
+
+        pos += 2 + ((jpg_bytes[pos + 2] << 8) | jpg_bytes[pos + 3])
+
+    raise ValueError('no frame header found in jpeg')
+
+
+def start_jpeg_stream(vid_path_in, frame_range=None):
+    """
+    start an ffmpeg process that writes the frames of an mjpeg video to its stdout as a stream of jpegs
+
+    :param vid_path_in: full path to the original video
+    :param frame_range: None to stream every frame, or a (first_frame, end_frame) tuple. ffmpeg stops after end_frame;
+        the frames before first_frame still have to be skipped by the reader (see read_jpeg_stream)
+    :return: decoder - subprocess.Popen object
+    """
+    decode_command = ['ffmpeg', '-loglevel', 'error', '-i', vid_path_in]
+    if frame_range is not None:
+        decode_command += ['-frames:v', str(frame_range[1])]
+    decode_command += ['-c:v', 'copy', '-bsf:v', 'mjpeg2jpeg', '-f', 'image2pipe', '-']
+
+    return subprocess.Popen(decode_command, stdout=subprocess.PIPE)
+
+
+def first_frame(frame_range):
+    """
+    :param frame_range: None or a (first_frame, end_frame) tuple
+    :return: number of frames to skip at the start of the video
+    """
+    if frame_range is None:
+        return 0
+    return frame_range[0]
+
+
+def check_ffmpeg_returncodes(vid_path_in, decoder, encoders):
+    """
+    raise an error if the decoding ffmpeg process or any of the encoding ffmpeg processes failed
+
+    :param vid_path_in: name of the video being cropped, for the error message
+    :param decoder: finished subprocess.Popen object for the decoding ffmpeg process
+    :param encoders: dictionary of finished subprocess.Popen objects for the encoding ffmpeg processes
+    :return:
+    """
+    if decoder.returncode != 0:
+        raise RuntimeError('ffmpeg failed to read {}'.format(vid_path_in))
+    for view_name, encoder in encoders.items():
+        if encoder.returncode != 0:
+            raise RuntimeError('ffmpeg failed to write the {} view of {}'.format(view_name, vid_path_in))
+
+
+def read_jpeg_stream(stream, chunk_size=1 << 20, skip_frames=0):
+    """
+    generator that splits a stream of concatenated jpegs (e.g., the output of ffmpeg -f image2pipe) into single jpegs
+
+    :param stream: binary file-like object
+    :param chunk_size: number of bytes to read from the stream at a time
+    :param skip_frames: number of jpegs at the start of the stream to discard
+    :return: yields the bytes of each jpeg in the stream
+    """
+    buf = bytearray()
+    eof = False
+    num_read = 0
+    while True:
+        jpg_end = find_jpeg_end(buf)
+        if jpg_end > 0:
+            if num_read >= skip_frames:
+                yield bytes(buf[:jpg_end])
+            num_read += 1
+            del buf[:jpg_end]
+            continue
+
+        if eof:
+            break
+        chunk = stream.read(chunk_size)
+        if not chunk:
+            eof = True
+        buf.extend(chunk)
+
+
+def find_jpeg_end(buf):
+    """
+    find the end of the jpeg at the start of buf by walking its marker segments. Inside entropy-coded data, a 0xFF byte
+    is always followed by a 0x00 stuffing byte or a restart marker, so the first other marker after a scan ends it
+
+    :param buf: bytes-like object that should start with a jpeg start-of-image marker
+    :return: index just past the jpeg end-of-image marker, or -1 if buf does not (yet) contain a complete jpeg
+    """
+    if len(buf) < 2:
+        return -1
+    if buf[0] != 0xFF or buf[1] != 0xD8:
+        raise ValueError('jpeg stream is not aligned on a start-of-image marker')
+
+    pos = 2
+    while pos + 1 < len(buf):
+        if buf[pos] != 0xFF:
+            raise ValueError('corrupt jpeg in stream at byte {:d}'.format(pos))
+        marker = buf[pos + 1]
+        if marker == 0xFF:
+            # fill byte
+            pos += 1
+        elif marker == 0xD9:
+            # end of image
+            return pos + 2
+        elif marker == 0x01 or 0xD0 <= marker <= 0xD7:
+            # markers without a length field
+            pos += 2
+        else:
+            if pos + 3 >= len(buf):
+                return -1
+            pos += 2 + ((buf[pos + 2] << 8) | buf[pos + 3])
+            if marker == 0xDA:
+                # start of scan - skip over the entropy-coded data to the next real marker
+                while True:
+                    pos = buf.find(b'\xff', pos)
+                    if pos < 0 or pos + 1 >= len(buf):
+                        return -1
+                    next_byte = buf[pos + 1]
+                    if next_byte == 0x00 or 0xD0 <= next_byte <= 0xD7:
+                        pos += 2
+                    else:
+                        break
+
+    return -1
+
+
+def crop_window_size(crop_params):
+    """
+    crop windows are 1-based and inclusive in every crop mode: [left, right, top, bottom] covers 0-based columns
+    left-1 through right-1 and rows top-1 through bottom-1, which is what translate_points_to_full_frame assumes
+
+    :param crop_params: 4-element list [left, right, top, bottom]
+    :return: crop_width, crop_height - size of the cropped frames in pixels
+    """
+    x1, x2, y1, y2 = [cp for cp in crop_params]
+
+    return x2 - x1 + 1, y2 - y1 + 1
+
+
+def ffmpeg_crop_filter(crop_params):
+    """
+    :param crop_params: 4-element list [left, right, top, bottom]
+    :return: ffmpeg crop filter that crops out the same pixels as crop_frame (ffmpeg offsets are 0-based)
+    """
+    x1, x2, y1, y2 = [cp for cp in crop_params]
+    crop_width, crop_height = crop_window_size(crop_params)
+
+    return 'crop={:d}:{:d}:{:d}:{:d}'.format(crop_width, crop_height, x1 - 1, y1 - 1)
+
+
+def crop_frame(img, crop_params, view_name):
+    """
+    crop a single view out of a full video frame
+
+    :param img: full frame image as read in by cv2
+    :param crop_params: 4-element list [left, right, top, bottom] (see crop_window_size)
+    :param view_name: "direct", "leftmirror", or "rightmirror"
+    :return: cropped_img
+    """
+    x1, x2, y1, y2 = [cp for cp in crop_params]
+
+    cropped_img = img[y1-1:y2, x1-1:x2, :]
+    if view_name == 'rightmirror':
+        # flip the image left to right so it can be run through a single "side mirror" DLC network
+        cropped_img = cv2.flip(cropped_img, 1)   # 2nd argument flipCode > 0 indicates flip horizontally
+
+    return cropped_img
 
 
-def preprocess_videos(vid_folder_list, cropped_vids_parent, crop_params_dict, view_list, vidtype='avi'):
+def preprocess_videos(vid_folder_list, cropped_vids_parent, crop_params_dict, view_list, vidtype='avi', num_workers=1,
+                      frame_range=None):
 
-    cropped_video_directories = crop_folders(vid_folder_list, cropped_vids_parent, crop_params_dict, view_list, vidtype='avi')
+    cropped_video_directories = crop_folders(vid_folder_list, cropped_vids_parent, crop_params_dict, view_list, vidtype='avi',
+                                             num_workers=num_workers, frame_range=frame_range)
 
     return cropped_video_directories
\ No newline at end of file
@@ -0,0 +1,253 @@
+"""
+memory-mappable copies of deeplabcut _full.pickle output: <pickle root>.dlc.npy holds a num_bodyparts x num_frames x 3
+float32 array of (x, y, confidence), and <pickle root>.dlc.json the bodyparts, crop window, etc. and the size and
+modification time of the pickle it was made from, so a cache is only rebuilt when its pickle changes
+"""
+import glob
+import json
+import os
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import navigation_utilities
+import skilled_reaching_io
+
+
+def dlc_cache_names(full_pickle_name, cache_folder=None):
+    """
+    :param full_pickle_name: full path to a deeplabcut _full.pickle file
+    :param cache_folder: folder to keep the cache files in. Default is next to the pickle
+    :return: array_name, metadata_name - full paths of the .npy and .json cache files
+    """
+    pickle_folder, pickle_name = os.path.split(full_pickle_name)
+    if cache_folder is None:
+        cache_folder = pickle_folder
+    cache_root = os.path.join(cache_folder, os.path.splitext(pickle_name)[0])
+
+    return cache_root + '.dlc.npy', cache_root + '.dlc.json'
+
+
+def meta_pickle_name(full_pickle_name):
+
+    pickle_folder, pickle_name = os.path.split(full_pickle_name)
+    return os.path.join(pickle_folder, pickle_name.replace('full', 'meta'))
+
+
+def read_dlc_cache_metadata(full_pickle_name, cache_folder=None):
+    """
+    :return: dictionary from the .json cache file, or None if it doesn't exist or can't be read
+    """
+    _, metadata_name = dlc_cache_names(full_pickle_name, cache_folder)
+    try:
+        with open(metadata_name, 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def dlc_cache_is_current(full_pickle_name, cache_folder=None):
+    """
+    :return: True if there is a cache for full_pickle_name that was made from the pickle as it is now on disk
+    """
+    cache_metadata = read_dlc_cache_metadata(full_pickle_name, cache_folder)
+    if cache_metadata is None:
+        return False
+
+    array_name, _ = dlc_cache_names(full_pickle_name, cache_folder)
+    pickle_stat = os.stat(full_pickle_name)
+
+    return (os.path.exists(array_name) and
+            cache_metadata.get('source_size') == pickle_stat.st_size and
+            cache_metadata.get('source_mtime') == pickle_stat.st_mtime)
+
+
+def convert_dlc_output(full_pickle_name, metadata_pickle_name=None, cache_folder=None, force=False):
+    """
+    convert one deeplabcut _full.pickle (and its _meta.pickle) into .npy/.json cache files, unless there is already a
+    current cache for it. The .npy is written first and the .json last, each to a partial file that is only renamed
+    once complete, so a cache file that was cut off partway through never looks current
+
+    :param full_pickle_name: full path to a deeplabcut _full.pickle file
+    :param metadata_pickle_name: full path to the matching _meta.pickle file. Default is the same name with 'full'
+        replaced by 'meta'
+    :param cache_folder: folder to keep the cache files in. Default is next to the pickle
+    :param force: if True, rebuild the cache even if it is current
+    :return: True if the cache was (re)built, False if it was already current
+    """
+    if not force and dlc_cache_is_current(full_pickle_name, cache_folder):
+        return False
+
+    if metadata_pickle_name is None:
+        metadata_pickle_name = meta_pickle_name(full_pickle_name)
+
+    # stat before reading, so a pickle rewritten while it is being converted looks out of date next time
+    pickle_stat = os.stat(full_pickle_name)
+    dlc_output = skilled_reaching_io.read_pickle(full_pickle_name)
+    dlc_metadata = skilled_reaching_io.read_pickle(metadata_pickle_name)['data']
+    name_metadata = navigation_utilities.parse_dlc_output_pickle_name(full_pickle_name)
+
+    bodyparts = list(dlc_metadata['DLC-model-config file']['all_joints_names'])
+    num_frames = dlc_metadata['nframes']
+    coordinates, confidence = extract_dlc_arrays(dlc_output, len(bodyparts), num_frames)
+    dlc_array = np.concatenate((coordinates, confidence[:, :, np.newaxis]), axis=2)
+
+    cache_metadata = {'bodyparts': bodyparts,
+                      'nframes': num_frames,
+                      'scorer': dlc_metadata.get('Scorer', name_metadata['scorername']),
+                      'view': name_metadata['view'],
+                      'crop_window': name_metadata['crop_window'],
+                      'frame_range': name_metadata['frame_range'],
+                      'fps': dlc_metadata.get('fps'),
+                      'source': full_pickle_name,
+                      'source_size': pickle_stat.st_size,
+                      'source_mtime': pickle_stat.st_mtime,
+                      'shape': list(dlc_array.shape),
+                      'dtype': str(dlc_array.dtype)}
+
+    array_name, metadata_name = dlc_cache_names(full_pickle_name, cache_folder)
+    if not os.path.isdir(os.path.dirname(array_name)):
+        os.makedirs(os.path.dirname(array_name))
+
+    # np.save adds .npy to names that don't already end in it
+    partial_array_name = array_name[:-len('.npy')] + '.partial.npy'
+    np.save(partial_array_name, dlc_array)
+    os.replace(partial_array_name, array_name)
+
+    partial_metadata_name = metadata_name + '.partial'
+    with open(partial_metadata_name, 'w') as f:
+        json.dump(cache_metadata, f, indent=4, default=lambda x: x.item() if hasattr(x, 'item') else str(x))
+    os.replace(partial_metadata_name, metadata_name)
+
+    return True
+
+
+def read_dlc_cache(full_pickle_name, cache_folder=None, bodyparts=None, frames=None, mmap_mode='r'):
+    """
+    read deeplabcut output from its cache files. Only the requested bodyparts and frames are read from disk. Nothing
+    is copied, so unless bodyparts is given (which picks rows into a new array) the arrays returned are read-only views
+    of the memory map - copy them before modifying them or holding on to them while the cache might be rebuilt
+
+    :param full_pickle_name: full path to the deeplabcut _full.pickle file the cache was made from (the pickle itself
+        isn't read)
+    :param cache_folder: folder the cache files are in. Default is next to the pickle
+    :param bodyparts: list of bodyparts to read, in the order to return them. Default is all bodyparts
+    :param frames: slice or array of frame indices to read. Default is all frames
+    :param mmap_mode: passed to np.load. None reads the whole array into memory first
+    :return: coordinates - num_bodyparts x num_frames x 2 float32 array of (x, y) points, NaN where not found
+             confidence - num_bodyparts x num_frames float32 array, NaN where not found
+             cache_metadata - dictionary from the .json cache file
+    """
+    cache_metadata = read_dlc_cache_metadata(full_pickle_name, cache_folder)
+    if cache_metadata is None:
+        raise FileNotFoundError('no deeplabcut cache for {}'.format(full_pickle_name))
+    array_name, _ = dlc_cache_names(full_pickle_name, cache_folder)
+    dlc_array = np.load(array_name, mmap_mode=mmap_mode)
+
+    if bodyparts is not None:
+        dlc_array = dlc_array[[cache_metadata['bodyparts'].index(bp) for bp in bodyparts]]
+    if frames is not None:
+        dlc_array = dlc_array[:, frames]
+
+    return dlc_array[:, :, :2], dlc_array[:, :, 2], cache_metadata
+
+
+def convert_dlc_folders(folder_list, cache_folder=None, num_workers=1, force=False):
+    """
+    convert every deeplabcut _full.pickle in a list of folders (e.g., the _marked folders for a session), skipping
+    pickles whose caches are current
+
+    :param folder_list: list of folders to look for _full.pickle files in
+    :param cache_folder: folder to keep the cache files in. Default is next to each pickle
+    :param num_workers: number of processes to convert pickles in parallel
+    :param force: if True, rebuild every cache
+    :return: conversion_results - list of dictionaries with keys 'pickle', 'converted' (True if the cache was rebuilt),
+        and 'error' ('' unless the conversion failed)
+    """
+    pickle_list = []
+    for folder in folder_list:
+        pickle_list.extend(sorted(glob.glob(os.path.join(folder, '*_full.pickle'))))
+
+    if num_workers <= 1:
+        return [convert_dlc_output_job(full_pickle_name, cache_folder, force) for full_pickle_name in pickle_list]
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+        futures = [executor.submit(convert_dlc_output_job, full_pickle_name, cache_folder, force)
+                   for full_pickle_name in pickle_list]
+        conversion_results = []
+        for future, full_pickle_name in zip(futures, pickle_list):
+            try:
+                conversion_results.append(future.result())
+            except Exception as e:
+                conversion_results.append({'pickle': full_pickle_name, 'converted': False, 'error': repr(e)})
+
+    return conversion_results
+
+
+def convert_dlc_output_job(full_pickle_name, cache_folder=None, force=False):
+
+    conversion_result = {'pickle': full_pickle_name, 'converted': False, 'error': ''}
+    try:
+        conversion_result['converted'] = convert_dlc_output(full_pickle_name, cache_folder=cache_folder, force=force)
+    except Exception as e:
+        conversion_result['error'] = repr(e)
+
+    return conversion_result
+
+
+def extract_dlc_arrays(dlc_view_output, num_bodyparts, num_frames, dtype=np.float32):
+    """
+    pull the coordinates and confidence values out of the frame dictionaries of a deeplabcut _full.pickle in a single
+    pass over the frames
+    :param dlc_view_output: dictionary loaded from a _full.pickle file. keys are 'frameNNNN' (plus 'metadata' in some
+        deeplabcut versions); each frame holds 'coordinates' and 'confidence' lists with one array per bodypart
+    :param num_bodyparts: number of bodyparts in the network
+    :param num_frames: number of frames in the video
+    :param dtype: data type of the returned arrays
+    :return: coordinates - num_bodyparts x num_frames x 2 array of (x, y) points
+             confidence - num_bodyparts x num_frames array of confidence values
+             both are NaN where deeplabcut did not find the bodypart
+    """
+    # fill frame-major so that each frame is written into one contiguous block
+    coordinates = np.full((num_frames, num_bodyparts, 2), np.nan, dtype=dtype)
+    confidence = np.full((num_frames, num_bodyparts), np.nan, dtype=dtype)
+
+    for frame_key, frame_data in dlc_view_output.items():
+        i_frame = dlc_frame_index(frame_key)
+        if i_frame is None or i_frame >= num_frames:
+            continue
+
+        frame_coordinates = frame_data['coordinates'][0]
+        frame_confidence = frame_data['confidence']
+        num_detections = [len(bp_coordinates) for bp_coordinates in frame_coordinates]
+        if all(n == 1 for n in num_detections):
+            # usual case - exactly one detection per bodypart, so the whole frame can be stacked at once
+            coordinates[i_frame] = np.concatenate(frame_coordinates)
+            confidence[i_frame] = np.concatenate(frame_confidence)[:, 0]
+        else:
+            # some 'coordinates' and 'confidence' arrays are empty - must be a peculiarity of deeplabcut. Leave those
+            # bodyparts as NaN, and take the first detection for the rest
+            for i_bp, n in enumerate(num_detections):
+                if n > 0:
+                    coordinates[i_frame, i_bp] = frame_coordinates[i_bp][0]
+                    confidence[i_frame, i_bp] = frame_confidence[i_bp][0][0]
+
+    coordinates = np.ascontiguousarray(coordinates.transpose((1, 0, 2)))
+    confidence = np.ascontiguousarray(confidence.T)
+
+    return coordinates, confidence
+
+
+def dlc_frame_index(frame_key):
+    """
+    :param frame_key: key from a deeplabcut _full.pickle dictionary, e.g. 'frame0012'
+    :return: integer frame number, or None if frame_key isn't a frame entry. The number is parsed rather than matched
+        against a formatted key because deeplabcut pads it to a width that depends on the number of frames, which
+        breaks a fixed 'frame{:04d}' lookup for videos with more than 9999 frames
+    """
+    if not frame_key.startswith('frame'):
+        return None
+    try:
+        return int(frame_key[5:])
+    except ValueError:
+        return None
@@ -0,0 +1,270 @@
+"""
+persistent SQLite catalog of the pipeline's files and the metadata parsed from their names, so that finding a video's
+files is an indexed query instead of a glob over the NAS. refresh_catalog only re-lists folders whose modification
+time has changed. Keep the catalog on a local disk - SQLite locking isn't reliable on network file systems
+"""
+import os
+import sqlite3
+import threading
+import time
+
+import filename_parser
+
+CATALOG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS folders (
+    path TEXT PRIMARY KEY,
+    parent TEXT,
+    name TEXT,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS folders_parent ON folders (parent);
+CREATE TABLE IF NOT EXISTS files (
+    path TEXT PRIMARY KEY,
+    folder TEXT,
+    name TEXT,
+    file_type TEXT,
+    ratID TEXT,
+    boxnum INTEGER,
+    triggertime TEXT,
+    video_number INTEGER,
+    view TEXT,
+    size INTEGER,
+    mtime_ns INTEGER
+);
+CREATE INDEX IF NOT EXISTS files_folder ON files (folder, name);
+CREATE INDEX IF NOT EXISTS files_video ON files (ratID, triggertime, video_number, file_type);
+"""
+
+VIDEO_TYPES = ('.avi', '.mp4')
+TRIGGERTIME_FORMAT = '%Y%m%d_%H-%M-%S'
+
+# folders modified less than this long before they are scanned are scanned again next time, in case more files were
+# added within the file system's timestamp resolution (which can be a second or two on network shares)
+RECENT_FOLDER_NS = 2 * 10**9
+
+_connections = threading.local()
+
+
+def open_catalog(catalog_name):
+    """
+    :param catalog_name: name of the catalog file. Created (with any missing folders) if it doesn't exist
+    :return: sqlite3 connection to the catalog
+    """
+    catalog_folder = os.path.dirname(os.path.abspath(catalog_name))
+    if not os.path.isdir(catalog_folder):
+        os.makedirs(catalog_folder)
+
+    connection = sqlite3.connect(catalog_name, timeout=60)
+    connection.executescript(CATALOG_SCHEMA)
+
+    return connection
+
+
+def catalog_connection(catalog):
+    """
+    :param catalog: catalog file name or an open sqlite3 connection
+    :return: connection to the catalog. Connections opened from a file name are kept for reuse, one per thread and
+        process (sqlite3 connections can't be shared between threads, or survive a fork)
+    """
+    if isinstance(catalog, sqlite3.Connection):
+        return catalog
+
+    catalog_name = os.path.abspath(catalog)
+    if getattr(_connections, 'pid', None) != os.getpid():
+        _connections.pid = os.getpid()
+        _connections.open = {}
+    if catalog_name not in _connections.open:
+        _connections.open[catalog_name] = open_catalog(catalog_name)
+
+    return _connections.open[catalog_name]
+
+
+def classify_file(file_name):
+    """
+    work out what kind of pipeline file file_name is from its name, and parse its metadata
+    :param file_name: file name (with or without the path)
+    :return: file_info - dictionary with keys file_type, ratID, boxnum, triggertime (string formatted as in file names),
+        video_number, view. None if it isn't a file the pipeline uses. Fields that aren't in the name are None
+    """
+    if file_name.endswith('_dlc-out.h5'):
+        # session trajectory stores are named after the session rather than a video
+        return {'file_type': 'trajectory_store',
+                'ratID': None,
+                'boxnum': None,
+                'triggertime': None,
+                'video_number': None,
+                'view': None}
+
+    parsed_name = filename_parser.parse_file_name(file_name)
+    if parsed_name is None:
+        return None
+
+    if parsed_name.name_type == 'dlc_output':
+        if parsed_name.pickle_type is None or parsed_name.ext != '.pickle':
+            return None
+        file_type = 'dlc_' + parsed_name.pickle_type
+    elif parsed_name.name_type in ('video', 'cropped_video'):
+        if parsed_name.ext.lower() not in VIDEO_TYPES:
+            return None
+        file_type = parsed_name.name_type
+    elif parsed_name.name_type in ('dlc_mat', 'box_calibration'):
+        file_type = parsed_name.name_type
+    else:
+        return None
+
+    file_info = {'file_type': file_type,
+                 'ratID': parsed_name.ratID,
+                 'boxnum': parsed_name.boxnum,
+                 'triggertime': parsed_name.triggertime.strftime(TRIGGERTIME_FORMAT),
+                 'video_number': parsed_name.video_number,
+                 'view': parsed_name.view}
+
+    return file_info
+
+
+def refresh_catalog(catalog, roots):
+    """
+    bring the catalog up to date with the folder trees under roots
+    :param catalog: catalog file name or sqlite3 connection
+    :param roots: list of folders to catalog (everything under them is included)
+    :return: num_scanned - number of folders that had changed and were listed again
+    """
+    connection = catalog_connection(catalog)
+
+    num_scanned = 0
+    for root in roots:
+        folders_to_check = [os.path.abspath(root)]
+        while folders_to_check:
+            folder = folders_to_check.pop()
+            try:
+                folder_mtime = os.stat(folder).st_mtime_ns
+            except OSError:
+                with connection:
+                    remove_folder(connection, folder)
+                continue
+
+            row = connection.execute('SELECT mtime_ns FROM folders WHERE path = ?', (folder,)).fetchone()
+            if row is not None and row[0] == folder_mtime:
+                # nothing has been added to or removed from this folder since it was scanned
+                folders_to_check.extend(subfolder for subfolder, in
+                                        connection.execute('SELECT path FROM folders WHERE parent = ?', (folder,)))
+                continue
+
+            with connection:
+                folders_to_check.extend(scan_folder(connection, folder, folder_mtime))
+            num_scanned += 1
+
+    return num_scanned
+
+
+def scan_folder(connection, folder, folder_mtime):
+    """
+    update the catalog entries for one folder's contents (not including its subfolders' contents)
+    :return: subfolders - list of the folder's subfolders
+    """
+    subfolders = []
+    current_files = {}
+    with os.scandir(folder) as entries:
+        for entry in entries:
+            if entry.is_dir():
+                subfolders.append(entry.path)
+            elif entry.is_file():
+                current_files[entry.path] = entry
+
+    # forget files and subfolders that are gone
+    cataloged_files = {path: (size, mtime_ns) for path, size, mtime_ns in
+                       connection.execute('SELECT path, size, mtime_ns FROM files WHERE folder = ?', (folder,))}
+    for path in set(cataloged_files) - set(current_files):
+        connection.execute('DELETE FROM files WHERE path = ?', (path,))
+    cataloged_subfolders = set(path for path, in
+                               connection.execute('SELECT path FROM folders WHERE parent = ?', (folder,)))
+    for subfolder in cataloged_subfolders - set(subfolders):
+        remove_folder(connection, subfolder)
+
+    for path, entry in current_files.items():
+        file_stat = entry.stat()
+        if cataloged_files.get(path) == (file_stat.st_size, file_stat.st_mtime_ns):
+            continue
+        file_info = classify_file(entry.name)
+        if file_info is None:
+            continue
+        connection.execute('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                           (path, folder, entry.name, file_info['file_type'], file_info['ratID'], file_info['boxnum'],
+                            file_info['triggertime'], file_info['video_number'], file_info['view'],
+                            file_stat.st_size, file_stat.st_mtime_ns))
+
+    if time.time_ns() - folder_mtime < RECENT_FOLDER_NS:
+        folder_mtime = -1
+    connection.execute('INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?)',
+                       (folder, os.path.dirname(folder), os.path.basename(folder), folder_mtime))
+
+    return subfolders
+
+
+def remove_folder(connection, folder):
+
+    folder_prefix = os.path.join(folder, '')
+    connection.execute('DELETE FROM files WHERE folder = ? OR substr(folder, 1, ?) = ?',
+                       (folder, len(folder_prefix), folder_prefix))
+    connection.execute('DELETE FROM folders WHERE path = ? OR substr(path, 1, ?) = ?',
+                       (folder, len(folder_prefix), folder_prefix))
+
+
+def folder_exists(catalog, folder):
+
+    connection = catalog_connection(catalog)
+    row = connection.execute('SELECT 1 FROM folders WHERE path = ?', (os.path.abspath(folder),)).fetchone()
+
+    return row is not None
+
+
+def file_exists(catalog, file_name):
+
+    connection = catalog_connection(catalog)
+    row = connection.execute('SELECT 1 FROM files WHERE path = ?', (os.path.abspath(file_name),)).fetchone()
+
+    return row is not None
+
+
+def find_subfolders(catalog, folder, name_pattern='*'):
+    """
+    :param catalog: catalog file name or sqlite3 connection
+    :param folder: parent folder
+    :param name_pattern: glob-style pattern the subfolder names have to match
+    :return: sorted list of full paths of the matching subfolders
+    """
+    connection = catalog_connection(catalog)
+
+    return sorted(path for path, in connection.execute('SELECT path FROM folders WHERE parent = ? AND name GLOB ?',
+                                                       (os.path.abspath(folder), name_pattern)))
+
+
+def find_files(catalog, folder=None, name_pattern=None, **file_info):
+    """
+    :param catalog: catalog file name or sqlite3 connection
+    :param folder: only return files in this folder (not its subfolders)
+    :param name_pattern: glob-style pattern the file names have to match
+    :param file_info: other columns to match (file_type, ratID, boxnum, triggertime, video_number, view). triggertime
+        can be a datetime
+    :return: sorted list of full paths of the matching files
+    """
+    conditions = []
+    values = []
+    if folder is not None:
+        conditions.append('folder = ?')
+        values.append(os.path.abspath(folder))
+    if name_pattern is not None:
+        conditions.append('name GLOB ?')
+        values.append(name_pattern)
+    for column, value in sorted(file_info.items()):
+        if column == 'triggertime' and not isinstance(value, str):
+            value = value.strftime(TRIGGERTIME_FORMAT)
+        conditions.append(column + ' = ?')
+        values.append(value)
+
+    query = 'SELECT path FROM files'
+    if conditions:
+        query += ' WHERE ' + ' AND '.join(conditions)
+
+    connection = catalog_connection(catalog)
+    return sorted(path for path, in connection.execute(query, values))
@@ -0,0 +1,209 @@
+"""
+single-pass parser for the file names the pipeline reads and writes. Every naming scheme is recognized by one compiled
+regular expression:
+
+    RXXXX[_boxNN]_yyyymmdd_HH-MM-SS_ZZZ.avi                                         original video
+    RXXXX[_boxNN]_yyyymmdd_HH-MM-SS_ZZZ_[view]_l-r-t-b[_fF-E].avi                   cropped video
+    RXXXX[_boxNN]_yyyymmdd_HH-MM-SS_ZZZ_[view]_l-r-t-b[_fF-E]DLC..._full.pickle     deeplabcut output (or _meta.pickle,
+                                                                                    .h5, .csv, ...)
+    RXXXX_boxNN_yyyymmdd_HH-MM-SS_ZZZ_dlc-out.mat                                   triangulated trajectories
+    CameraCalibration_boxNN_yyyymmdd_HH-MM-SS.avi                                   camera calibration video
+    calibration_camNN_yyyymmdd_HH-MM-SS.avi                                         Burgess calibration video
+    SR_boxCalibration_boxNN_yyyymmdd.mat                                            box calibration
+
+As with the original split-on-underscore parsers, rat IDs can have letters after the number (R0382a), and other names
+can have extra parts after the fields above if they are .avi or .mp4 videos (e.g.,
+R0382_box02_20201216_12-52-39_009_rotated.avi). Deeplabcut's own
+suffixes (_full, _meta, _labeled, _filtered, ...) are kept out of the scorername.
+
+Names are parsed into an immutable ParsedName record, and results are memoized by name, so the discovery passes that
+see the same files over and over only parse each name once. Dates are built from the matched digits directly rather
+than with datetime.strptime.
+
+The parse_* functions in navigation_utilities use this module and convert the records to their metadata dictionaries.
+"""
+import functools
+import os
+import re
+from collections import namedtuple
+from datetime import datetime
+
+FILE_NAME_PATTERN = re.compile(r"""
+    ^(?:
+        # names that start with the rat ID: videos, cropped videos, deeplabcut output, .mat output
+        (?P<ratID>R(?P<rat_digits>\d+)[A-Za-z]*)
+        (?:_box(?P<boxnum>\d+))?
+        _(?P<date>\d{8})_(?P<time>\d{2}-\d{2}-\d{2})
+        _(?P<video_number>\d+)
+        (?:_(?P<view>[A-Za-z]+)
+           _(?P<crop_window>\d+-\d+-\d+-\d+)
+           (?:_f(?P<first_frame>\d+)-(?P<end_frame>\d+))?
+        )?
+        (?:(?P<scorername>DLC[^.]*?)
+           (?:_(?P<pickle_type>full|meta)|_(?:filtered_)?labeled|_filtered|_skeleton|_assemblies|_el|_bx|_sk)?
+           |(?P<dlc_out>_dlc-out)
+           # anything else tacked on to a video name. Only videos, so that e.g. R0382_..._009_3dtrajectory.mat isn't
+           # taken for a video
+           |_[^.]*(?=\.(?i:avi|mp4)$)
+        )?
+    |
+        # calibration videos and files
+        (?P<calibration_type>CameraCalibration|calibration|SR_boxCalibration)
+        _(?:box(?P<calibration_boxnum>\d+)|cam(?P<cam_num>\d+))
+        _(?P<calibration_date>\d{8})(?:_(?P<calibration_time>\d{2}-\d{2}-\d{2}))?
+    )
+    (?P<ext>\.\w+)?$
+    """, re.VERBOSE)
+
+CALIBRATION_NAME_TYPES = {'CameraCalibration': 'camera_calibration_video',
+                          'calibration': 'calibration_video',
+                          'SR_boxCalibration': 'box_calibration'}
+
+# name_type is one of 'video', 'cropped_video', 'dlc_output', 'dlc_mat', 'camera_calibration_video',
+# 'calibration_video', 'box_calibration'. Fields that aren't part of a name type's scheme are None, except boxnum,
+# which is 99 if it isn't in the name (as in the metadata dictionaries)
+ParsedName = namedtuple('ParsedName', ['name_type',
+                                       'ratID',
+                                       'rat_num',
+                                       'boxnum',
+                                       'triggertime',
+                                       'video_number',
+                                       'view',
+                                       'crop_window',
+                                       'frame_range',
+                                       'scorername',
+                                       'pickle_type',
+                                       'cam_num',
+                                       'ext'])
+
+
+@functools.lru_cache(maxsize=1 << 14)
+def parse_datetime_string(date_string, time_string=None):
+    """
+    :param date_string: yyyymmdd
+    :param time_string: HH-MM-SS, or None for midnight
+    :return: datetime. Memoized, since all the files that go with a video (every view, the deeplabcut output, etc.)
+        share its trigger time
+    """
+    if time_string is None:
+        return datetime(int(date_string[0:4]), int(date_string[4:6]), int(date_string[6:8]))
+
+    return datetime(int(date_string[0:4]), int(date_string[4:6]), int(date_string[6:8]),
+                    int(time_string[0:2]), int(time_string[3:5]), int(time_string[6:8]))
+
+
+def parse_file_name(file_name):
+    """
+    :param file_name: file name, with or without the path
+    :return: ParsedName record, or None if the name doesn't match any of the pipeline's naming schemes (or has an
+        impossible date)
+    """
+    return parse_base_name(os.path.basename(file_name))
+
+
+@functools.lru_cache(maxsize=1 << 17)
+def parse_base_name(base_name):
+
+    name_match = FILE_NAME_PATTERN.match(base_name)
+    if name_match is None:
+        return None
+    # every group in FILE_NAME_PATTERN is named, so groups() has them in the order they appear in the pattern
+    (ratID, rat_digits, boxnum, date_string, time_string, video_number, view, crop_window, first_frame, end_frame,
+     scorername, pickle_type, dlc_out, calibration_type, calibration_boxnum, cam_num, calibration_date,
+     calibration_time, ext) = name_match.groups()
+
+    try:
+        if ratID is None:
+            triggertime = parse_datetime_string(calibration_date, calibration_time)
+        else:
+            triggertime = parse_datetime_string(date_string, time_string)
+    except ValueError:
+        return None
+
+    if ext is None:
+        ext = ''
+    if ratID is None:
+        return ParsedName(name_type=CALIBRATION_NAME_TYPES[calibration_type],
+                          ratID=None,
+                          rat_num=None,
+                          boxnum=99 if calibration_boxnum is None else int(calibration_boxnum),
+                          triggertime=triggertime,
+                          video_number=None,
+                          view=None,
+                          crop_window=None,
+                          frame_range=None,
+                          scorername=None,
+                          pickle_type=None,
+                          cam_num=None if cam_num is None else int(cam_num),
+                          ext=ext)
+
+    if scorername is not None:
+        name_type = 'dlc_output'
+    elif dlc_out is not None:
+        name_type = 'dlc_mat'
+    elif view is not None:
+        name_type = 'cropped_video'
+    else:
+        name_type = 'video'
+
+    if crop_window is not None:
+        crop_window = tuple(map(int, crop_window.split('-')))
+    frame_range = None
+    if first_frame is not None:
+        frame_range = (int(first_frame), int(end_frame))
+
+    return ParsedName(name_type=name_type,
+                      ratID=ratID,
+                      rat_num=int(rat_digits),
+                      boxnum=99 if boxnum is None else int(boxnum),
+                      triggertime=triggertime,
+                      video_number=int(video_number),
+                      view=view,
+                      crop_window=crop_window,
+                      frame_range=frame_range,
+                      scorername=scorername,
+                      pickle_type=pickle_type,
+                      cam_num=None,
+                      ext=ext)
+
+
+def parse_file_names(file_names):
+    """
+    :param file_names: iterable of file names
+    :return: dictionary of ParsedName records keyed by file name, for the names that match one of the naming schemes
+    """
+    parsed_names = {}
+    for file_name in file_names:
+        parsed_name = parse_file_name(file_name)
+        if parsed_name is not None:
+            parsed_names[file_name] = parsed_name
+
+    return parsed_names
+
+
+def parse_folder(folder, name_types=None):
+    """
+    parse every file name in a folder
+    :param folder: folder to list
+    :param name_types: if given, only return names of these types (e.g., ('dlc_output',))
+    :return: dictionary of ParsedName records keyed by full path
+    """
+    with os.scandir(folder) as entries:
+        parsed_names = parse_file_names(entry.path for entry in entries if entry.is_file())
+
+    if name_types is not None:
+        parsed_names = {file_name: parsed_name for file_name, parsed_name in parsed_names.items()
+                        if parsed_name.name_type in name_types}
+
+    return parsed_names
+
+
+def require_name_type(file_name, name_types):
+    """
+    :return: ParsedName record for file_name. Raises ValueError if it isn't one of name_types
+    """
+    parsed_name = parse_file_name(file_name)
+    if parsed_name is None or parsed_name.name_type not in name_types:
+        raise ValueError('{} is not a recognized {} name'.format(file_name, ' or '.join(name_types)))
+
+    return parsed_name
@@ -4,6 +4,11 @@ import sys
 import cv2
 import pandas as pd
 from datetime import datetime
+import file_catalog
+import filename_parser
+import skilled_reaching_io
+import trajectory_store
+import video_probe
 
 
 def get_video_folders_to_crop(video_root_folder):
@@ -73,12 +78,14 @@ def parse_session_dir_name(session_dir):
     return ratID, session_name
 
 
-def find_folders_to_analyze(cropped_videos_parent, view_list=None):
+def find_folders_to_analyze(cropped_videos_parent, view_list=None, catalog=None):
     """
     get the full list of directories containing cropped videos in the videos_to_analyze folder
     :param cropped_videos_parent: parent directory with subfolders direct_view and mirror_views, which have subfolders
         RXXXX-->RXXXXyyyymmddz[direct/leftmirror/rightmirror] (assuming default view list)
     :param view_list:
+    :param catalog: file catalog (see file_catalog) to look the folders up in instead of searching the disk. None to
+        search the disk
     :return: folders_to_analyze: dictionary containing a key for each member of view_list. Each key holds a list of
         folders to run through deeplabcut
     """
@@ -88,21 +95,16 @@ def find_folders_to_analyze(cropped_videos_parent, view_list=None):
 
     folders_to_analyze = dict(zip(view_list, ([] for _ in view_list)))
 
-    rat_folder_list = glob.glob(os.path.join(cropped_videos_parent, 'R*'))
-    for rat_folder in rat_folder_list:
-        if os.path.isdir(rat_folder):
-            # assume the rat_folder directory name is the same as ratID (i.e., form of RXXXX)
-            _, ratID = os.path.split(rat_folder)
-            session_name = ratID + '_*'
-            session_dir_list = glob.glob(rat_folder + '/' + session_name)
-            # make sure we only include directories (just in case there are some stray files with the right names)
-            session_dir_list = [session_dir for session_dir in session_dir_list if os.path.isdir(session_dir)]
-            for session_dir in session_dir_list:
-                _, cur_session = os.path.split(session_dir)
-                for view in view_list:
-                    view_folder = os.path.join(session_dir, cur_session + '_' + view)
-                    if os.path.isdir(view_folder):
-                        folders_to_analyze[view].extend([view_folder])
+    for rat_folder in find_subfolders(cropped_videos_parent, 'R*', catalog=catalog):
+        # assume the rat_folder directory name is the same as ratID (i.e., form of RXXXX)
+        _, ratID = os.path.split(rat_folder)
+        # only include directories (just in case there are some stray files with the right names)
+        for session_dir in find_subfolders(rat_folder, ratID + '_*', catalog=catalog):
+            _, cur_session = os.path.split(session_dir)
+            for view in view_list:
+                view_folder = os.path.join(session_dir, cur_session + '_' + view)
+                if folder_exists(view_folder, catalog=catalog):
+                    folders_to_analyze[view].extend([view_folder])
 
     return folders_to_analyze
 
@@ -133,9 +135,10 @@ def find_folders_to_analyze(cropped_videos_parent, view_list=None):
 def parse_cropped_video_name(cropped_video_name):
     """
     extract metadata information from the video name
-    :param cropped_video_name: video name with expected format RXXXX_yyyymmdd_HH-MM-SS_ZZZ_[view]_l-r-t-b.avi
-        where [view] is 'direct', 'leftmirror', or 'rightmirror', and l-r-t-b are left, right, top, and bottom of the
-        cropping windows from the original video
+    :param cropped_video_name: video name with expected format RXXXX_yyyymmdd_HH-MM-SS_ZZZ_[view]_l-r-t-b[_fF-E].avi
+        where [view] is 'direct', 'leftmirror', or 'rightmirror', l-r-t-b are left, right, top, and bottom of the
+        cropping windows from the original video, and the optional fF-E is the range of frames kept from the original
+        video
     :return: cropped_vid_metadata: dictionary containing the following keys
         ratID - rat ID as a string RXXXX
         boxnum - box number the session was run in. useful for making sure we used the right calibration. If unknown,
@@ -145,6 +148,7 @@ def parse_cropped_video_name(cropped_video_name):
             if it had to be restarted partway through
         video_type - video type (e.g., '.avi', '.mp4', etc)
         crop_window - 4-element list [left, right, top, bottom] in pixels
+        frame_range - None if all frames were kept, otherwise [first_frame, end_frame] (0-based, end_frame exclusive)
     """
 
     cropped_vid_metadata = {
@@ -156,34 +160,22 @@ def parse_cropped_video_name(cropped_video_name):
         'view': '',
         'video_type': '',
         'crop_window': [],
+        'frame_range': None,
         'cropped_video_name': ''
     }
-    _, vid_name = os.path.split(cropped_video_name)
-    cropped_vid_metadata['cropped_video_name'] = vid_name
-    vid_name, vid_type = os.path.splitext(vid_name)
-
-    metadata_list = vid_name.split('_')
-
-    cropped_vid_metadata['ratID'] = metadata_list[0]
-    num_string = ''.join(filter(lambda i: i.isdigit(), cropped_vid_metadata['ratID']))
-    cropped_vid_metadata['rat_num'] = int(num_string)
-
-    # if box number is stored in file name, then extract it
-    if 'box' in metadata_list[1]:
-        cropped_vid_metadata['boxnum'] = int(metadata_list[1][3:])
-        next_metadata_idx = 2
-    else:
-        next_metadata_idx = 1
-
-    datetime_str = metadata_list[next_metadata_idx] + '_' + metadata_list[1+next_metadata_idx]
-    cropped_vid_metadata['triggertime'] = datetime.strptime(datetime_str, '%Y%m%d_%H-%M-%S')
-
-    cropped_vid_metadata['video_number'] = int(metadata_list[next_metadata_idx + 2])
-    cropped_vid_metadata['video_type'] = vid_type
-    cropped_vid_metadata['view'] = metadata_list[next_metadata_idx + 3]
-
-    left, right, top, bottom = list(map(int, metadata_list[next_metadata_idx + 4].split('-')))
-    cropped_vid_metadata['crop_window'].extend(left, right, top, bottom)
+    parsed_name = filename_parser.require_name_type(cropped_video_name, ('cropped_video',))
+
+    cropped_vid_metadata['cropped_video_name'] = os.path.basename(cropped_video_name)
+    cropped_vid_metadata['ratID'] = parsed_name.ratID
+    cropped_vid_metadata['rat_num'] = parsed_name.rat_num
+    cropped_vid_metadata['boxnum'] = parsed_name.boxnum
+    cropped_vid_metadata['triggertime'] = parsed_name.triggertime
+    cropped_vid_metadata['video_number'] = parsed_name.video_number
+    cropped_vid_metadata['video_type'] = parsed_name.ext
+    cropped_vid_metadata['view'] = parsed_name.view
+    cropped_vid_metadata['crop_window'].extend(parsed_name.crop_window)
+    if parsed_name.frame_range is not None:
+        cropped_vid_metadata['frame_range'] = list(parsed_name.frame_range)
 
     return cropped_vid_metadata
 
@@ -216,35 +208,24 @@ def parse_video_name(video_name):
         'im_size': (1024, 2040)
     }
 
-    if os.path.exists(video_name):
-        video_object = cv2.VideoCapture(video_name)
-        video_metadata['im_size'] = (int(video_object.get(cv2.CAP_PROP_FRAME_HEIGHT)),
-                   int(video_object.get(cv2.CAP_PROP_FRAME_WIDTH)))
+    parsed_name = filename_parser.require_name_type(video_name, ('video', 'cropped_video', 'dlc_output', 'dlc_mat'))
+
+    # frame size comes from the folder's video probe cache, so the video is only opened the first time it's seen
+    video_info = video_probe.get_video_info(video_name)
+    if video_info is not None:
+        video_metadata['im_size'] = video_info['im_size']
 
     vid_path, vid_name = os.path.split(video_name)
     video_metadata['video_name'] = vid_name
     # the last folder in the tree should have the session name
     _, video_metadata['session_name'] = os.path.split(vid_path)
-    vid_name, vid_type = os.path.splitext(vid_name)
-
-    metadata_list = vid_name.split('_')
-
-    video_metadata['ratID'] = metadata_list[0]
-    num_string = ''.join(filter(lambda i: i.isdigit(), video_metadata['ratID']))
-    video_metadata['rat_num'] = int(num_string)
-
-    # if box number is stored in file name, then extract it
-    if 'box' in metadata_list[1]:
-        video_metadata['boxnum'] = int(metadata_list[1][3:])
-        next_metadata_idx = 2
-    else:
-        next_metadata_idx = 1
 
-    datetime_str = metadata_list[next_metadata_idx] + '_' + metadata_list[1+next_metadata_idx]
-    video_metadata['triggertime'] = datetime.strptime(datetime_str, '%Y%m%d_%H-%M-%S')
-
-    video_metadata['video_number'] = int(metadata_list[next_metadata_idx + 2])
-    video_metadata['video_type'] = vid_type
+    video_metadata['ratID'] = parsed_name.ratID
+    video_metadata['rat_num'] = parsed_name.rat_num
+    video_metadata['boxnum'] = parsed_name.boxnum
+    video_metadata['triggertime'] = parsed_name.triggertime
+    video_metadata['video_number'] = parsed_name.video_number
+    video_metadata['video_type'] = parsed_name.ext
 
     return video_metadata
 
@@ -274,6 +255,7 @@ def parse_dlc_output_pickle_name(dlc_output_pickle_name):
             if it had to be restarted partway through
         video_type - video type (e.g., '.avi', '.mp4', etc)
         crop_window - 4-element list [left, right, top, bottom] in pixels
+        frame_range - None if all frames were kept, otherwise [first_frame, end_frame] (0-based, end_frame exclusive)
     """
 
     pickle_metadata = {
@@ -284,44 +266,26 @@ def parse_dlc_output_pickle_name(dlc_output_pickle_name):
         'video_number': 0,
         'view': '',
         'crop_window': [],
+        'frame_range': None,
         'scorername': '',
         'pickle_name': ''
     }
-    _, pickle_name = os.path.split(dlc_output_pickle_name)
-    pickle_metadata['pickle_name'] = pickle_name
-    pickle_name, vid_type = os.path.splitext(pickle_name)
-
-    metadata_list = pickle_name.split('_')
-
-    pickle_metadata['ratID'] = metadata_list[0]
-    num_string = ''.join(filter(lambda i: i.isdigit(), pickle_metadata['ratID']))
-    pickle_metadata['rat_num'] = int(num_string)
-
-    # if box number is stored in file name, then extract it
-    if 'box' in metadata_list[1]:
-        pickle_metadata['boxnum'] = int(metadata_list[1][3:])
-        next_metadata_idx = 2
-    else:
-        next_metadata_idx = 1
-
-    datetime_str = metadata_list[next_metadata_idx] + '_' + metadata_list[1+next_metadata_idx]
-    pickle_metadata['triggertime'] = datetime.strptime(datetime_str, '%Y%m%d_%H-%M-%S')
-
-    pickle_metadata['video_number'] = int(metadata_list[next_metadata_idx + 2])
-    pickle_metadata['view'] = metadata_list[next_metadata_idx + 3]
-
-    # 'DLC' gets appended to the last cropping parameter in the filename by deeplabcut
-    crop_window_strings = metadata_list[next_metadata_idx + 4].split('-')
-    left, right, top = list(map(int, crop_window_strings[:-1]))
-
-    # find where 'DLC' starts in the last crop_window_string
-    dlc_location = crop_window_strings[-1].find('DLC')
-    bottom = int(crop_window_strings[-1][:dlc_location])
-
-    pickle_metadata['crop_window'].extend((left, right, top, bottom))
-
-    #todo: write the scorername into the pickle metadata dictionary. It's also in the metadata pickle file
-    pickle_metadata['scorername']
+    parsed_name = filename_parser.require_name_type(dlc_output_pickle_name, ('dlc_output',))
+    if parsed_name.crop_window is None:
+        raise ValueError('{} does not have a crop window in its name'.format(dlc_output_pickle_name))
+
+    pickle_metadata['pickle_name'] = os.path.basename(dlc_output_pickle_name)
+    pickle_metadata['ratID'] = parsed_name.ratID
+    pickle_metadata['rat_num'] = parsed_name.rat_num
+    pickle_metadata['boxnum'] = parsed_name.boxnum
+    pickle_metadata['triggertime'] = parsed_name.triggertime
+    pickle_metadata['video_number'] = parsed_name.video_number
+    pickle_metadata['view'] = parsed_name.view
+    pickle_metadata['crop_window'].extend(parsed_name.crop_window)
+    if parsed_name.frame_range is not None:
+        pickle_metadata['frame_range'] = list(parsed_name.frame_range)
+    # 'DLC' and the rest of the scorer name get appended to the cropped video name by deeplabcut
+    pickle_metadata['scorername'] = parsed_name.scorername
 
     return pickle_metadata
 
@@ -371,12 +335,14 @@ def create_calibration_file_tree(calibration_parent, vid_metadata):
     return calibration_file_tree
 
 
-def find_dlc_output_pickles(video_metadata, marked_videos_parent, view_list=None):
+def find_dlc_output_pickles(video_metadata, marked_videos_parent, view_list=None, catalog=None):
     """
 
     :param video_metadata:
     :param marked_videos_parent:
     :param view_list:
+    :param catalog: file catalog (see file_catalog) to look the pickles up in instead of searching the disk. None to
+        search the disk
     :return:
     """
     if view_list is None:
@@ -390,20 +356,28 @@ def find_dlc_output_pickles(video_metadata, marked_videos_parent, view_list=None
     dlc_metadata_pickle_names = {view: None for view in view_list}
     for view in view_list:
         pickle_folder = os.path.join(session_pickle_folder, session_name + '_' + view + '_marked')
-        test_string_full, test_string_meta = construct_dlc_output_pickle_names(video_metadata, view)
-        test_string_full = os.path.join(pickle_folder, test_string_full)
-        test_string_meta = os.path.join(pickle_folder, test_string_meta)
-
-        pickle_full_list = glob.glob(test_string_full)
-        pickle_meta_list = glob.glob(test_string_meta)
+        if catalog is None:
+            test_string_full, test_string_meta = construct_dlc_output_pickle_names(video_metadata, view)
+            pickle_full_list = glob.glob(os.path.join(pickle_folder, test_string_full))
+            pickle_meta_list = glob.glob(os.path.join(pickle_folder, test_string_meta))
+        else:
+            video_pickles = file_catalog.find_files(catalog,
+                                                    folder=pickle_folder,
+                                                    ratID=video_metadata['ratID'],
+                                                    boxnum=video_metadata['boxnum'],
+                                                    triggertime=video_metadata['triggertime'],
+                                                    video_number=video_metadata['video_number'],
+                                                    view=view)
+            pickle_full_list = [pickle_name for pickle_name in video_pickles if pickle_name.endswith('_full.pickle')]
+            pickle_meta_list = [pickle_name for pickle_name in video_pickles if pickle_name.endswith('_meta.pickle')]
 
         if len(pickle_full_list) > 1:
             # ambiguity in which pickle file goes with this video
-            sys.exit('Ambiguous dlc output file name for {}'.format(video_metadata['video_name']))
+            raise ValueError('Ambiguous dlc output file name for {}'.format(video_metadata['video_name']))
 
         if len(pickle_meta_list) > 1:
             # ambiguity in which pickle file goes with this video
-            sys.exit('Ambiguous dlc output metadata file name for {}'.format(video_metadata['video_name']))
+            raise ValueError('Ambiguous dlc output metadata file name for {}'.format(video_metadata['video_name']))
 
         if len(pickle_full_list) == 0:
             # no pickle file for this view
@@ -454,8 +428,27 @@ def construct_dlc_output_pickle_names(video_metadata, view):
     return pickle_name_full, pickle_name_meta
 
 
-def find_calibration_file(video_metadata, calibration_parent):
+def find_calibration_file(video_metadata, calibration_parent, catalog=None):
+    """
+
+    :param video_metadata:
+    :param calibration_parent:
+    :param catalog: file catalog (see file_catalog) to check for the calibration file instead of the disk. None to
+        check the disk
+    :return:
+    """
+    test_name = calibration_file_name(video_metadata, calibration_parent)
+
+    if file_exists(test_name, catalog=catalog):
+        return test_name
+    else:
+        return ''
+        # sys.exit('No calibration file found for ' + video_metadata['video_name'])
+
+
+def calibration_file_name(video_metadata, calibration_parent):
     """
+    name the box calibration file for a video should have, whether or not it exists
 
     :param video_metadata:
     :param calibration_parent:
@@ -466,14 +459,10 @@ def find_calibration_file(video_metadata, calibration_parent):
     month_folder = os.path.join(year_folder, date_string[0:6] + '_calibration')
     calibration_folder = os.path.join(month_folder, date_string[0:6] + '_calibration_files')
 
-    test_name = 'SR_boxCalibration_box{:02d}_{}.mat'.format(video_metadata['boxnum'], date_string)
-    test_name = os.path.join(calibration_folder, test_name)
+    calibration_name = 'SR_boxCalibration_box{:02d}_{}.mat'.format(video_metadata['boxnum'], date_string)
+    calibration_name = os.path.join(calibration_folder, calibration_name)
 
-    if os.path.exists(test_name):
-        return test_name
-    else:
-        return ''
-        # sys.exit('No calibration file found for ' + video_metadata['video_name'])
+    return calibration_name
 
 
 def create_trajectory_filename(video_metadata):
@@ -533,15 +522,10 @@ def parse_camera_calibration_video_name(calibration_video_name):
         'boxnum': 99,
         'time': datetime(1, 1, 1)
     }
-    _, cal_vid_name = os.path.split(calibration_video_name)
-    cal_vid_name, _ = os.path.splitext(cal_vid_name)
-
-    cal_vid_name_parts = cal_vid_name.split('_')
-
-    camera_calibration_metadata['boxnum'] = int(cal_vid_name_parts[1][3:])
+    parsed_name = filename_parser.require_name_type(calibration_video_name, ('camera_calibration_video',))
 
-    datetime_str = cal_vid_name_parts[2] + '_' + cal_vid_name_parts[3]
-    camera_calibration_metadata['time'] = datetime.strptime(datetime_str, '%Y%m%d_%H-%M-%S')
+    camera_calibration_metadata['boxnum'] = parsed_name.boxnum
+    camera_calibration_metadata['time'] = parsed_name.triggertime
 
     return camera_calibration_metadata
 
@@ -582,47 +566,130 @@ def create_mat_fname_dlc_output(video_metadata, dlc_mat_output_parent):
     return mat_name
 
 
-def find_marked_vids_for_3d_reconstruction(marked_vids_parent, dlc_mat_output_parent, rat_df):
+def create_trajectory_store_name(video_metadata, dlc_mat_output_parent):
+    """
+    :return: full path of the session trajectory store (see trajectory_store) for a video. It goes in the same folder
+        as the session's _dlc-out.mat files would
+    """
+    store_path = os.path.join(dlc_mat_output_parent,
+                              video_metadata['ratID'],
+                              video_metadata['session_name'])
+
+    if not os.path.isdir(store_path):
+        os.makedirs(store_path)
+
+    return os.path.join(store_path, video_metadata['session_name'] + '_dlc-out.h5')
+
+
+def find_subfolders(folder, name_pattern, catalog=None):
+    """
+    :param folder: parent folder
+    :param name_pattern: glob-style pattern the subfolder names have to match
+    :param catalog: file catalog (see file_catalog) to look in. None to search the disk
+    :return: list of the matching subfolders of folder
+    """
+    if catalog is None:
+        return [subfolder for subfolder in glob.glob(os.path.join(folder, name_pattern)) if os.path.isdir(subfolder)]
+
+    return file_catalog.find_subfolders(catalog, folder, name_pattern)
+
+
+def find_files(folder, name_pattern, catalog=None):
+    """
+    :param folder: folder to look in
+    :param name_pattern: glob-style pattern the file names have to match
+    :param catalog: file catalog (see file_catalog) to look in. None to search the disk
+    :return: list of the matching files in folder. With a catalog, only the file types it keeps track of are found
+    """
+    if catalog is None:
+        return glob.glob(os.path.join(folder, name_pattern))
+
+    return file_catalog.find_files(catalog, folder=folder, name_pattern=name_pattern)
+
+
+def folder_exists(folder, catalog=None):
+
+    if catalog is None:
+        return os.path.isdir(folder)
+
+    return file_catalog.folder_exists(catalog, folder)
+
+
+def file_exists(file_name, catalog=None):
+
+    if catalog is None:
+        return os.path.exists(file_name)
+
+    return file_catalog.file_exists(catalog, file_name)
+
+
+def find_marked_vids_for_3d_reconstruction(marked_vids_parent, dlc_mat_output_parent, rat_db, session_names=None,
+                                           catalog=None):
+    """
+
+    :param marked_vids_parent:
+    :param dlc_mat_output_parent:
+    :param rat_db: rat registry from skilled_reaching_io.read_rat_registry
+    :param session_names: if given, only look in these session folders (e.g., ['R0382_20201216c'])
+    :param catalog: file catalog (see file_catalog) to look the files up in instead of searching the disk. None to
+        search the disk
+    :return: metadata_list - list of video_metadata dictionaries for videos that have dlc output for the direct view
+        and the relevant mirror view, but haven't been written out to a .mat file or a session trajectory store yet
+    """
 
     # find marked vids for which we have both relevant views (eventually, need all 3 views)
-    marked_rat_folders = glob.glob(os.path.join(marked_vids_parent, 'R*'))
+    if session_names is None:
+        marked_rat_folders = find_subfolders(marked_vids_parent, 'R*', catalog=catalog)
+    else:
+        rat_ids = set(parse_session_dir_name(session_name)[0] for session_name in session_names)
+        marked_rat_folders = [os.path.join(marked_vids_parent, ratID) for ratID in sorted(rat_ids)]
 
     # return a list of video_metadata dictionaries
     metadata_list = []
     for rat_folder in marked_rat_folders:
-        if os.path.isdir(rat_folder):
+        if folder_exists(rat_folder, catalog=catalog):
             _, ratID = os.path.split(rat_folder)
             rat_num = int(ratID[1:])
-            paw_pref = rat_df[rat_df['ratID'] == rat_num]['pawPref'].values[0]
+            paw_pref = skilled_reaching_io.get_paw_preference(rat_db, rat_num)
             if paw_pref == 'right':
                 mirrorview = 'leftmirror'
             else:
                 mirrorview = 'rightmirror'
             # find the paw preference for this rat
 
-            session_folders = glob.glob(os.path.join(rat_folder, ratID + '_*'))
+            session_folders = find_subfolders(rat_folder, ratID + '_*', catalog=catalog)
 
             for session_folder in session_folders:
-                if os.path.isdir(session_folder):
+                if folder_exists(session_folder, catalog=catalog):
                     _, session_name = os.path.split(session_folder)
+                    if session_names is not None and session_name not in session_names:
+                        continue
 
                     # check that there is a direct_marked folder for this session
                     direct_marked_folder = os.path.join(session_folder, session_name + '_direct_marked')
                     mirror_marked_folder = os.path.join(session_folder, session_name + '_' + mirrorview + '_marked')
 
-                    if not os.path.isdir(mirror_marked_folder):
+                    if not folder_exists(mirror_marked_folder, catalog=catalog):
                         continue
 
-                    if os.path.isdir(direct_marked_folder):
+                    # videos already in the session's trajectory store don't need to be triangulated again
+                    store_name = os.path.join(dlc_mat_output_parent, ratID, session_name, session_name + '_dlc-out.h5')
+                    stored_keys = trajectory_store.stored_video_keys(store_name)
+
+                    if folder_exists(direct_marked_folder, catalog=catalog):
                         # find all the full_pickle and metadata_pickle files in the folder, and look to see if there are
                         # matching files in the appropriate mirror view folder
                         test_name = ratID + '_*_full.pickle'
-                        full_pickle_list = glob.glob(os.path.join(direct_marked_folder, test_name))
+                        full_pickle_list = find_files(direct_marked_folder, test_name, catalog=catalog)
 
                         for full_pickle_file in full_pickle_list:
                             # is there a matching metadata file, as well as matching metadata files in the mirror folder?
                             _, pickle_name = os.path.split(full_pickle_file)
-                            pickle_metadata = parse_dlc_output_pickle_name(pickle_name)
+                            try:
+                                pickle_metadata = parse_dlc_output_pickle_name(pickle_name)
+                            except ValueError:
+                                print('skipping {}, not a deeplabcut output name'.format(full_pickle_file))
+                                continue
                             # crop_window_string = '{:d}-{:d}-{:d}-{:d}'.format(pickle_metadata['crop_window'][0],
                             #                                                   pickle_metadata['crop_window'][1],
                             #                                                   pickle_metadata['crop_window'][2],
@@ -631,12 +698,13 @@ def find_marked_vids_for_3d_reconstruction(marked_vids_parent, dlc_mat_output_pa
                             meta_direct_file = os.path.join(direct_marked_folder, pickle_name.replace('full', 'meta'))
                             vid_prefix = pickle_name[:pickle_name.find('direct')]
                             test_mirror_name = vid_prefix + '*_full.pickle'
-                            full_mirror_name_list = glob.glob(os.path.join(mirror_marked_folder, test_mirror_name))
+                            full_mirror_name_list = find_files(mirror_marked_folder, test_mirror_name, catalog=catalog)
                             if len(full_mirror_name_list) == 1:
                                 full_mirror_file = full_mirror_name_list[0]
                                 _, full_mirror_name = os.path.split(full_mirror_file)
                                 meta_mirror_file = os.path.join(mirror_marked_folder, full_mirror_name.replace('full', 'meta'))
-                                if os.path.exists(meta_direct_file) and os.path.exists(meta_mirror_file):
+                                if file_exists(meta_direct_file, catalog=catalog) and \
+                                        file_exists(meta_mirror_file, catalog=catalog):
 
                                     video_name = '{}_box{:02d}_{}_{:03d}.avi'.format(ratID,
                                                                                      pickle_metadata['boxnum'],
@@ -655,7 +723,8 @@ def find_marked_vids_for_3d_reconstruction(marked_vids_parent, dlc_mat_output_pa
                                     }
                                     mat_output_name = create_mat_fname_dlc_output(video_metadata, dlc_mat_output_parent)
                                     # check if these files have already been processed
-                                    if not os.path.exists(mat_output_name):
+                                    if not file_exists(mat_output_name, catalog=catalog) and \
+                                            trajectory_store.video_key(video_metadata) not in stored_keys:
                                         # .mat file doesn't already exist
                                         metadata_list.append(video_metadata)
 
@@ -695,14 +764,11 @@ def find_Burgess_calibration_vids(cal_vid_parent, session_datetime, cam_list=(1,
 
 def parse_Burgess_calibration_vid_name(cal_vid_name):
 
-    _, cal_vid_name = os.path.split(cal_vid_name)
-    bare_name, _ = os.path.splitext(cal_vid_name)
-
-    name_parts_list = bare_name.split('_')
+    parsed_name = filename_parser.require_name_type(cal_vid_name, ('calibration_video',))
 
     cal_name_parts = {
-        'cam_num': int(name_parts_list[1][3:]),
-        'session_datetime': fname_string_to_datetime(name_parts_list[2] + '_' + name_parts_list[3])
+        'cam_num': parsed_name.cam_num,
+        'session_datetime': parsed_name.triggertime
     }
 
     return cal_name_parts
@@ -0,0 +1,538 @@
+"""
+resumable runner for the skilled reaching pipeline (crop --> analyze --> label --> calibrate --> triangulate). A stage
+only re-runs for a session if its outputs are missing or its inputs have changed since its checkpoint, and each stage
+has its own worker limit, so different sessions can be in different stages at the same time.
+
+usage:
+    python pipeline_runner.py --config pipeline_config.json
+    python pipeline_runner.py --config pipeline_config.json --stages crop analyze --sessions R0382_20201216c --dry-run
+"""
+import argparse
+import glob
+import hashlib
+import json
+import collections
+import os
+import time
+import traceback
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+import crop_videos
+import file_catalog
+import navigation_utilities
+import reconstruct_3d
+import skilled_reaching_io
+import skilled_reaching_workflow
+
+
+STAGE_NAMES = ('crop', 'analyze', 'label', 'calibrate', 'triangulate')
+
+# settings that aren't machine-specific. Anything here can be overridden in the config file; videos_parent,
+# rat_database, and view_config_paths have to be given in the config file
+DEFAULT_CONFIG = {
+    'view_list': ['direct', 'leftmirror', 'rightmirror'],
+    'crop_params': {
+        'direct': [700, 1350, 270, 935],
+        'leftmirror': [1, 470, 270, 920],
+        'rightmirror': [1570, 2040, 270, 920]
+    },
+    'crop_filtertype': 'mjpeg2jpeg',
+    'crop_workers': 1,
+    'triangulate_workers': 1,
+    'frame_range': None,
+    'raw_vid_type': '.avi',
+    'cropped_vid_type': '.avi',
+    'gputouse': 0,
+    'min_confidence': 0.95,
+    'max_velocity': None,
+    'max_gap': 0,
+    'max_epipolar_distance': None,
+    'use_dlc_cache': True,
+    'trajectory_output_format': 'mat',
+    'file_catalog': None,
+    'label_videos': True,
+    'stage_workers': {'crop': 1, 'analyze': 1, 'label': 1, 'calibrate': 1, 'triangulate': 1},
+    'checkpoint_folder': None
+}
+
+
+def load_config(config_name):
+    """
+    read a pipeline config file (.json, or .yaml/.yml if pyyaml is installed) and fill in defaults
+
+    :param config_name: name of the config file
+    :return: config - dictionary of pipeline settings, including the derived folder names
+    """
+    with open(config_name, 'r') as f:
+        if os.path.splitext(config_name)[1] in ('.yaml', '.yml'):
+            import yaml
+            user_config = yaml.safe_load(f)
+        else:
+            user_config = json.load(f)
+
+    config = dict(DEFAULT_CONFIG)
+    config['stage_workers'] = dict(DEFAULT_CONFIG['stage_workers'])
+    config['stage_workers'].update(user_config.pop('stage_workers', {}))
+    config.update(user_config)
+
+    for required_key in ('videos_parent', 'rat_database', 'view_config_paths'):
+        if required_key not in config:
+            raise ValueError('pipeline config file must set ' + required_key)
+
+    # folder layout under videos_parent, unless overridden in the config file
+    videos_parent = config['videos_parent']
+    default_folders = {'video_root_folder': 'videos_to_crop',
+                       'cropped_videos_parent': 'cropped_videos',
+                       'marked_videos_parent': 'marked_videos',
+                       'calibration_parent': 'calibration_files',
+                       'dlc_mat_output_parent': 'matlab_readable_dlc'}
+    for folder_key, folder_name in default_folders.items():
+        if config.get(folder_key) is None:
+            config[folder_key] = os.path.join(videos_parent, folder_name)
+    if config['checkpoint_folder'] is None:
+        config['checkpoint_folder'] = os.path.join(videos_parent, 'pipeline_checkpoints')
+
+    config['view_list'] = tuple(config['view_list'])
+
+    return config
+
+
+def find_sessions(config):
+    """
+    :param config: pipeline config dictionary
+    :return: sessions - list of dictionaries with keys 'ratID', 'session_name', 'raw_folder', one for each lowest-level
+        folder of raw videos
+    """
+    sessions = []
+    for raw_folder in sorted(navigation_utilities.get_video_folders_to_crop(config['video_root_folder'])):
+        _, session_name = os.path.split(raw_folder)
+        ratID, _ = navigation_utilities.parse_session_dir_name(session_name)
+        sessions.append({'ratID': ratID, 'session_name': session_name, 'raw_folder': raw_folder})
+
+    return sessions
+
+
+def cropped_view_folders(config, session):
+    """
+    :return: dictionary with the cropped video folder for each view of a session
+    """
+    cropped_folders = navigation_utilities.create_cropped_video_destination_list(config['cropped_videos_parent'],
+                                                                                 [session['raw_folder']],
+                                                                                 config['view_list'])
+    return {view: cropped_folders[i_view][0] for i_view, view in enumerate(config['view_list'])}
+
+
+def marked_view_folders(config, session):
+    """
+    :return: dictionary with the _marked folder for each view of a session
+    """
+    session_folder = os.path.join(config['marked_videos_parent'], session['ratID'], session['session_name'])
+    return {view: os.path.join(session_folder, session['session_name'] + '_' + view + '_marked')
+            for view in config['view_list']}
+
+
+def raw_videos(config, session):
+    return sorted(glob.glob(os.path.join(session['raw_folder'], '*' + config['raw_vid_type'])))
+
+
+def cropped_videos(config, session):
+    return sorted(cropped_video for cropped_folder in cropped_view_folders(config, session).values()
+                  for cropped_video in glob.glob(os.path.join(cropped_folder, '*' + config['cropped_vid_type'])))
+
+
+def dlc_pickles(config, session):
+    return sorted(pickle_file for marked_folder in marked_view_folders(config, session).values()
+                  for pickle_file in glob.glob(os.path.join(marked_folder, '*.pickle')))
+
+
+def calibration_files(config, session):
+    """
+    :return: list of the box calibration files needed to triangulate the videos in a session (whether or not they
+        exist yet)
+    """
+    calibration_names = set()
+    for raw_video in raw_videos(config, session):
+        _, vid_name = os.path.split(raw_video)
+        try:
+            video_metadata = navigation_utilities.parse_video_name(vid_name)
+        except ValueError:
+            # stray files in the session folder that aren't reaching videos
+            print('skipping {}, not a reaching video name'.format(raw_video))
+            continue
+        calibration_names.add(navigation_utilities.calibration_file_name(video_metadata, config['calibration_parent']))
+
+    return sorted(calibration_names)
+
+
+def mat_output_folder(config, session):
+    return os.path.join(config['dlc_mat_output_parent'], session['ratID'], session['session_name'])
+
+
+def run_crop(config, session):
+    _, failed_results = crop_videos.crop_folders([session['raw_folder']],
+                                                 config['cropped_videos_parent'],
+                                                 config['crop_params'],
+                                                 config['view_list'],
+                                                 vidtype=config['raw_vid_type'],
+                                                 filtertype=config['crop_filtertype'],
+                                                 num_workers=config['crop_workers'],
+                                                 frame_range=config['frame_range'],
+                                                 return_failures=True)
+
+    # the declared outputs are the cropped view folders, which exist even if some videos failed, so fail the stage to
+    # keep it from being checkpointed with videos missing
+    if failed_results:
+        raise RuntimeError('{:d} videos failed to crop: {}'.format(
+            len(failed_results), ', '.join(crop_result['video'] for crop_result in failed_results)))
+
+
+def run_analyze(config, session):
+    run_analyze_batch(config, [session])
+
+
+def run_analyze_batch(config, sessions):
+    # all the sessions' folders go to deeplabcut in one call, which groups the videos by network, so each network is
+    # only loaded once however many sessions are waiting to be analyzed
+    folders_to_analyze = {view: [] for view in config['view_list']}
+    for session in sessions:
+        for view, cropped_folder in cropped_view_folders(config, session).items():
+            if os.path.isdir(cropped_folder):
+                folders_to_analyze[view].append(cropped_folder)
+    folders_to_analyze = {view: view_folders for view, view_folders in folders_to_analyze.items() if view_folders}
+
+    skilled_reaching_workflow.analyze_cropped_videos(folders_to_analyze,
+                                                     config['view_config_paths'],
+                                                     config['marked_videos_parent'],
+                                                     cropped_vid_type=config['cropped_vid_type'],
+                                                     gputouse=config['gputouse'],
+                                                     save_as_csv=True,
+                                                     cropped_videos_parent=config['cropped_videos_parent'])
+
+
+def run_label(config, session):
+    if not config['label_videos']:
+        return
+
+    marked_folders = marked_view_folders(config, session)
+    for view, cropped_folder in cropped_view_folders(config, session).items():
+        # the scorer for each view is recorded in the analysis manifest written by analyze_cropped_videos
+        analysis_manifest = skilled_reaching_workflow.read_analysis_manifest(marked_folders[view])
+        scorers = set(entry['scorername'] for entry in analysis_manifest.values())
+        if not scorers:
+            continue
+        dlc_network = 'direct' if 'direct' in view else 'mirror'
+        for scorername in scorers:
+            skilled_reaching_workflow.create_labeled_videos({view: [cropped_folder]},
+                                                            config['marked_videos_parent'],
+                                                            config['view_config_paths'],
+                                                            {dlc_network: scorername},
+                                                            cropped_vid_type=config['cropped_vid_type'],
+                                                            view_list=(view,),
+                                                            cropped_videos_parent=config['cropped_videos_parent'])
+
+
+def run_calibrate(config, session):
+    # box calibrations are computed in matlab, so all this stage can do is make sure they are there before
+    # triangulating. Once a missing calibration file shows up, the stage's inputs change and it runs again
+    missing_files = [calibration_file for calibration_file in calibration_files(config, session)
+                     if not os.path.exists(calibration_file)]
+    if missing_files:
+        raise FileNotFoundError('missing calibration files: ' + ', '.join(missing_files))
+
+
+def run_triangulate(config, session):
+    catalog = config['file_catalog']
+    if catalog is not None:
+        # pick up the deeplabcut output, calibration files, and .mat files written since the catalog was last refreshed
+        calibration_folders = set(os.path.dirname(calibration_file)
+                                  for calibration_file in calibration_files(config, session))
+        file_catalog.refresh_catalog(catalog, [os.path.join(config['marked_videos_parent'], session['ratID']),
+                                               os.path.join(config['dlc_mat_output_parent'], session['ratID'])] +
+                                     sorted(calibration_folders))
+
+    rat_db = skilled_reaching_io.read_rat_registry(config['rat_database'])
+    metadata_list = navigation_utilities.find_marked_vids_for_3d_reconstruction(config['marked_videos_parent'],
+                                                                                config['dlc_mat_output_parent'],
+                                                                                rat_db,
+                                                                                session_names=[session['session_name']],
+                                                                                catalog=catalog)
+    triangulation_results = reconstruct_3d.triangulate_videos(metadata_list,
+                                                              config['videos_parent'],
+                                                              config['marked_videos_parent'],
+                                                              config['calibration_parent'],
+                                                              config['dlc_mat_output_parent'],
+                                                              rat_db,
+                                                              num_workers=config['triangulate_workers'],
+                                                              view_list=config['view_list'],
+                                                              min_confidence=config['min_confidence'],
+                                                              max_velocity=config['max_velocity'],
+                                                              max_gap=config['max_gap'],
+                                                              max_epipolar_distance=config['max_epipolar_distance'],
+                                                              use_dlc_cache=config['use_dlc_cache'],
+                                                              output_format=config['trajectory_output_format'],
+                                                              catalog=catalog)
+    reconstruct_3d.print_triangulation_summary(triangulation_results)
+
+    # the only declared output is the session's .mat folder, so fail the stage (after every video has been tried) to
+    # keep it from being checkpointed with videos missing
+    num_failed = sum(not triangulation_result['success'] for triangulation_result in triangulation_results)
+    if num_failed > 0:
+        raise RuntimeError('{:d} of {:d} videos failed to triangulate'.format(num_failed, len(triangulation_results)))
+
+
+# for each stage: the function that runs it on a session, the files it reads, and the paths that have to exist once it
+# is done. Stages with a 'run_batch' function are given every session that is waiting for them at once
+STAGES = {
+    'crop': {'run': run_crop,
+             'inputs': raw_videos,
+             'outputs': lambda config, session: list(cropped_view_folders(config, session).values())},
+    'analyze': {'run': run_analyze,
+                'run_batch': run_analyze_batch,
+                'inputs': cropped_videos,
+                'outputs': lambda config, session: list(marked_view_folders(config, session).values())},
+    'label': {'run': run_label,
+              'inputs': dlc_pickles,
+              'outputs': lambda config, session: []},
+    'calibrate': {'run': run_calibrate,
+                  'inputs': calibration_files,
+                  'outputs': calibration_files},
+    'triangulate': {'run': run_triangulate,
+                    'inputs': lambda config, session: dlc_pickles(config, session) + calibration_files(config, session),
+                    'outputs': lambda config, session: [mat_output_folder(config, session)]}
+}
+
+
+def input_fingerprint(input_files):
+    """
+    :param input_files: list of file names
+    :return: hex digest summarizing the names, sizes, and modification times of the files. Missing files are included
+        so that a file appearing changes the fingerprint
+    """
+    file_stats = []
+    for input_file in input_files:
+        try:
+            file_stat = os.stat(input_file)
+            file_stats.append([input_file, file_stat.st_size, file_stat.st_mtime])
+        except OSError:
+            file_stats.append([input_file, -1, -1])
+
+    return hashlib.md5(json.dumps(file_stats).encode()).hexdigest()
+
+
+def checkpoint_name(config, stage_name, session):
+    return os.path.join(config['checkpoint_folder'], stage_name, session['session_name'] + '.json')
+
+
+def read_checkpoint(config, stage_name, session):
+    try:
+        with open(checkpoint_name(config, stage_name, session), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+
+def write_checkpoint(config, stage_name, session, fingerprint, elapsed):
+    checkpoint = {'fingerprint': fingerprint,
+                  'finished': time.strftime('%Y-%m-%d %H:%M:%S'),
+                  'elapsed': elapsed}
+
+    full_checkpoint_name = checkpoint_name(config, stage_name, session)
+    checkpoint_folder, _ = os.path.split(full_checkpoint_name)
+    if not os.path.isdir(checkpoint_folder):
+        os.makedirs(checkpoint_folder)
+    with open(full_checkpoint_name + '.partial', 'w') as f:
+        json.dump(checkpoint, f, indent=1)
+    os.replace(full_checkpoint_name + '.partial', full_checkpoint_name)
+
+
+def stage_is_stale(config, stage_name, session):
+    """
+    :return: is_stale - True if the stage has to be run for this session
+        fingerprint - fingerprint of the stage's current inputs
+    """
+    stage = STAGES[stage_name]
+    fingerprint = input_fingerprint(stage['inputs'](config, session))
+
+    checkpoint = read_checkpoint(config, stage_name, session)
+    if checkpoint is None or checkpoint['fingerprint'] != fingerprint:
+        return True, fingerprint
+    if not all(os.path.exists(output) for output in stage['outputs'](config, session)):
+        return True, fingerprint
+
+    return False, fingerprint
+
+
+def run_stage(config, stage_name, sessions, force=False, dry_run=False):
+    """
+    run one stage for a group of sessions, skipping sessions for which it is up to date. Stages with a 'run_batch'
+    function run all the stale sessions in one call; otherwise they are run one at a time
+
+    :param config: pipeline config dictionary
+    :param stage_name: name of the stage
+    :param sessions: list of session dictionaries from find_sessions
+    :param force: if True, run the stage whether or not it is up to date
+    :param dry_run: if True, only report whether the stage would run
+    :return: stage_results - list of dictionaries (one per session, in the same order) with keys 'session', 'stage',
+        'status' ('done', 'skipped', 'stale', or 'failed'), 'elapsed', 'error'
+    """
+    stage = STAGES[stage_name]
+    stage_results = [{'session': session['session_name'], 'stage': stage_name, 'status': 'skipped',
+                      'elapsed': 0., 'error': ''} for session in sessions]
+
+    # inputs are checked once the sessions' turn in the stage comes up, after earlier stages have finished
+    stale_sessions = []
+    for session, stage_result in zip(sessions, stage_results):
+        try:
+            is_stale, _ = stage_is_stale(config, stage_name, session)
+        except Exception:
+            stage_result['status'] = 'failed'
+            stage_result['error'] = traceback.format_exc()
+            continue
+        if not (is_stale or force):
+            continue
+        if dry_run:
+            stage_result['status'] = 'stale'
+            continue
+        stale_sessions.append((session, stage_result))
+
+    if stale_sessions and 'run_batch' in stage:
+        start_time = time.time()
+        error = ''
+        try:
+            stage['run_batch'](config, [session for session, _ in stale_sessions])
+        except Exception:
+            error = traceback.format_exc()
+        for _, stage_result in stale_sessions:
+            stage_result['elapsed'] = time.time() - start_time
+            if error:
+                stage_result['status'] = 'failed'
+                stage_result['error'] = error
+    else:
+        for session, stage_result in stale_sessions:
+            start_time = time.time()
+            try:
+                stage['run'](config, session)
+            except Exception:
+                stage_result['status'] = 'failed'
+                stage_result['error'] = traceback.format_exc()
+            stage_result['elapsed'] = time.time() - start_time
+
+    for session, stage_result in zip(sessions, stage_results):
+        if stage_result['status'] == 'failed':
+            print('{} failed for {}:\n{}'.format(stage_name, session['session_name'], stage_result['error']))
+    for session, stage_result in stale_sessions:
+        if stage_result['status'] == 'failed':
+            continue
+        # the stage may have created some of its own inputs (e.g., calibration files), so fingerprint them again
+        write_checkpoint(config, stage_name, session, input_fingerprint(stage['inputs'](config, session)),
+                         stage_result['elapsed'])
+        stage_result['status'] = 'done'
+        print('{} finished for {} in {:.1f} s'.format(stage_name, session['session_name'], stage_result['elapsed']))
+
+    return stage_results
+
+
+def run_pipeline(config, stage_names=STAGE_NAMES, session_filter=None, force=False, dry_run=False):
+    """
+    run every session through the pipeline. Each session goes through the requested stages in order, skipping stages
+    that are up to date, and stops at the first stage that fails, since later stages depend on it
+
+    :param config: pipeline config dictionary (see load_config)
+    :param stage_names: stages to run. They are always run in pipeline order
+    :param session_filter: if given, only sessions whose names contain one of these strings are run
+    :param force: if True, run every stage whether or not it is up to date
+    :param dry_run: if True, only report which stages would run
+    :return: pipeline_results - list of stage result dictionaries (see run_stage), in session and stage order
+    """
+    stage_names = [stage_name for stage_name in STAGE_NAMES if stage_name in stage_names]
+    stage_limits = {stage_name: max(1, config['stage_workers'].get(stage_name, 1)) for stage_name in stage_names}
+
+    if config['file_catalog'] is not None:
+        t_start = time.time()
+        num_scanned = file_catalog.refresh_catalog(config['file_catalog'],
+                                                   [config[folder_key] for folder_key in ('cropped_videos_parent',
+                                                                                          'marked_videos_parent',
+                                                                                          'calibration_parent',
+                                                                                          'dlc_mat_output_parent')])
+        print('refreshed file catalog ({:d} changed folders) in {:.1f} s'.format(num_scanned, time.time() - t_start))
+
+    sessions = find_sessions(config)
+    if session_filter:
+        sessions = [session for session in sessions
+                    if any(session_text in session['session_name'] for session_text in session_filter)]
+    if not sessions:
+        print('no sessions to run')
+        return []
+
+    # sessions wait in a queue for each stage, and a session is only handed to a worker thread when a slot in its
+    # next stage is free, so the pool never needs more threads than there are stage slots. Batched stages (analyze)
+    # take every session in their queue at once, so sessions that pile up while deeplabcut is busy with earlier ones
+    # are analyzed together
+    stage_queues = {stage_name: collections.deque() for stage_name in stage_names}
+    stage_queues[stage_names[0]].extend(range(len(sessions)))
+    num_running = dict.fromkeys(stage_names, 0)
+    running = {}
+    session_results = [[] for _ in sessions]
+    with ThreadPoolExecutor(max_workers=min(sum(stage_limits.values()), len(sessions))) as executor:
+        while True:
+            # later stages first, so sessions that are already under way finish before new ones start
+            for stage_name in reversed(stage_names):
+                while stage_queues[stage_name] and num_running[stage_name] < stage_limits[stage_name]:
+                    if 'run_batch' in STAGES[stage_name]:
+                        session_indices = list(stage_queues[stage_name])
+                        stage_queues[stage_name].clear()
+                    else:
+                        session_indices = [stage_queues[stage_name].popleft()]
+                    future = executor.submit(run_stage, config, stage_name,
+                                             [sessions[i_session] for i_session in session_indices], force, dry_run)
+                    running[future] = (stage_name, session_indices)
+                    num_running[stage_name] += 1
+            if not running:
+                break
+
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                stage_name, session_indices = running.pop(future)
+                num_running[stage_name] -= 1
+                i_stage = stage_names.index(stage_name)
+                for i_session, stage_result in zip(session_indices, future.result()):
+                    session_results[i_session].append(stage_result)
+                    if stage_result['status'] != 'failed' and i_stage + 1 < len(stage_names):
+                        stage_queues[stage_names[i_stage + 1]].append(i_session)
+
+    return [stage_result for session_result in session_results for stage_result in session_result]
+
+
+def print_summary(pipeline_results):
+    for status in ('stale', 'done', 'failed'):
+        status_results = [stage_result for stage_result in pipeline_results if stage_result['status'] == status]
+        for stage_result in status_results:
+            print('{:<12s}{:<12s}{}'.format(status, stage_result['stage'], stage_result['session']))
+    num_failed = sum(stage_result['status'] == 'failed' for stage_result in pipeline_results)
+    print('{:d} stage runs, {:d} failed'.format(len(pipeline_results), num_failed))
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='run the skilled reaching pipeline on any sessions that need it')
+    parser.add_argument('--config', required=True, help='pipeline config file (.json or .yaml)')
+    parser.add_argument('--stages', nargs='+', choices=STAGE_NAMES, default=list(STAGE_NAMES),
+                        help='stages to run (always run in pipeline order)')
+    parser.add_argument('--sessions', nargs='+', default=None,
+                        help='only run sessions whose names contain one of these strings')
+    parser.add_argument('--force', action='store_true', help='run stages even if they are up to date')
+    parser.add_argument('--dry-run', action='store_true', help='list the stages that would run without running them')
+    args = parser.parse_args(argv)
+
+    config = load_config(args.config)
+    pipeline_results = run_pipeline(config,
+                                    stage_names=args.stages,
+                                    session_filter=args.sessions,
+                                    force=args.force,
+                                    dry_run=args.dry_run)
+    print_summary(pipeline_results)
+
+    return pipeline_results
+
+
+if __name__ == '__main__':
+    main()
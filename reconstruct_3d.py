@@ -1,77 +1,535 @@
 import numpy as np
 import cv2
 import os
+import time
+import functools
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from concurrent.futures.process import BrokenProcessPool
 import navigation_utilities
 import skilled_reaching_io
+import dlc_output_cache
+import trajectory_store
+import video_probe
 import pandas as pd
 import scipy.io as sio
 
-def triangulate_video(video_id, videos_parent, marked_videos_parent, calibration_parent, dlc_mat_output_parent, rat_df,
-                      view_list=None,
-                      min_confidence=0.95):
+# the box calibration stores one camera matrix and fundamental matrix per mirror, in this order
+PN_VIEW_INDEX = {'topmirror': 0, 'leftmirror': 1, 'rightmirror': 2}
+
 
+def triangulate_video(video_id, videos_parent, marked_videos_parent, calibration_parent, dlc_mat_output_parent, rat_db,
+                      view_list=None,
+                      min_confidence=0.95,
+                      max_velocity=None,
+                      max_gap=0,
+                      max_epipolar_distance=None,
+                      use_dlc_cache=True,
+                      output_format='mat',
+                      catalog=None):
+    """
+    find the deeplabcut output and box calibration for a video, clean up and undistort the 2D points, triangulate them,
+    and save the result
+    :param video_id: video name or video_metadata dictionary
+    :param videos_parent: parent folder of the raw videos
+    :param marked_videos_parent: parent folder of the _marked folders with deeplabcut output
+    :param calibration_parent: parent folder of the box calibration files
+    :param dlc_mat_output_parent: parent folder for the .mat files (or session trajectory stores)
+    :param rat_db: rat registry from skilled_reaching_io.read_rat_registry
+    :param view_list: views to read deeplabcut output for
+    :param min_confidence: see preprocess_trajectories
+    :param max_velocity: see preprocess_trajectories
+    :param max_gap: see preprocess_trajectories
+    :param max_epipolar_distance: direct/mirror pairs further than this many pixels from their epipolar lines are
+        removed before triangulating. None to keep them (the distances are saved either way)
+    :param use_dlc_cache: see read_dlc_trajectories
+    :param output_format: 'mat' to write a _dlc-out.mat file for the video, 'hdf5' to add it to the session's trajectory
+        store (see trajectory_store), or None to only return the data
+    :param catalog: file catalog (see file_catalog) to find the deeplabcut output and calibration file in. None to
+        search the disk
+    :return: mat_data dictionary from package_data_into_mat, or None if there is no calibration file for the video
+    """
     if view_list is None:
         view_list = ('direct', 'leftmirror', 'rightmirror')
 
-    if isinstance(video_id, str):
-        video_metadata = navigation_utilities.parse_video_name(video_id)
-    else:
-        video_metadata = video_id
+    video_metadata = triangulation_video_metadata(video_id)
 
-    video_metadata['paw_pref'] = rat_df[rat_df['ratID'] == video_metadata['rat_num']]['pawPref'].values[0]
-    dlc_output_pickle_names, dlc_metadata_pickle_names = navigation_utilities.find_dlc_output_pickles(video_metadata, marked_videos_parent, view_list=view_list)
+    video_metadata['paw_pref'] = skilled_reaching_io.get_paw_preference(rat_db, video_metadata['rat_num'])
+    dlc_output_pickle_names, dlc_metadata_pickle_names = navigation_utilities.find_dlc_output_pickles(video_metadata, marked_videos_parent, view_list=view_list, catalog=catalog)
     # above line will not complete if all pickle files with DLC output data are not found
 
     # find the calibration files
-    calibration_file = navigation_utilities.find_calibration_file(video_metadata, calibration_parent)
+    calibration_file = navigation_utilities.find_calibration_file(video_metadata, calibration_parent, catalog=catalog)
     if calibration_file == '':
         return
 
-    camera_params = skilled_reaching_io.read_matlab_calibration(calibration_file)
+    camera_params = skilled_reaching_io.read_matlab_calibration_cached(calibration_file)
     # above lines will not complete if a calibration file is not found
 
-    # read in the pickle files
-    dlc_output = {view: None for view in view_list}
-    dlc_metadata = {view: None for view in view_list}
-    pickle_name_metadata = {view: None for view in view_list}
-    for view in view_list:
-        if not dlc_output_pickle_names[view] is None:
-            dlc_output[view] = skilled_reaching_io.read_pickle(dlc_output_pickle_names[view])
-            dlc_metadata[view] = skilled_reaching_io.read_pickle(dlc_metadata_pickle_names[view])
-            pickle_name_metadata[view] = navigation_utilities.parse_dlc_output_pickle_name(dlc_output_pickle_names[view])
-
     trajectory_filename = navigation_utilities.create_trajectory_filename(video_metadata)
 
-    trajectory_metadata = extract_trajectory_metadata(dlc_metadata, pickle_name_metadata)
+    trajectory_data, trajectory_metadata = read_dlc_trajectories(dlc_output_pickle_names, dlc_metadata_pickle_names,
+                                                                 use_cache=use_dlc_cache)
 
-    dlc_data = extract_data_from_dlc_output(dlc_output, trajectory_metadata)
-    #todo: preprocessing to get rid of "invalid" points
+    # get rid of "invalid" points before they are undistorted and triangulated
+    trajectory_data = preprocess_trajectories(trajectory_data,
+                                              min_confidence=min_confidence,
+                                              max_velocity=max_velocity,
+                                              max_gap=max_gap)
 
-    # translate and undistort points
-    dlc_data = translate_points_to_full_frame(dlc_data, trajectory_metadata)
-    dlc_data = undistort_points(dlc_data, camera_params)
+    # translate and undistort points (both modify trajectory_data in place)
+    trajectory_data = translate_points_to_full_frame(trajectory_data, trajectory_metadata)
+    trajectory_data = undistort_points(trajectory_data, camera_params)
 
-    mat_data = package_data_into_mat(dlc_data, video_metadata, trajectory_metadata)
-    mat_name = navigation_utilities.create_mat_fname_dlc_output(video_metadata, dlc_mat_output_parent)
+    # check that the direct and mirror points are consistent with the box geometry, which catches deeplabcut
+    # mislabels before they are triangulated
+    mirrorview = get_mirrorview(video_metadata['paw_pref'])
+    epipolar_distance = epipolar_distances(trajectory_data, camera_params, mirrorview)
+    if max_epipolar_distance is not None:
+        trajectory_data = mask_epipolar_outliers(trajectory_data, mirrorview, epipolar_distance, max_epipolar_distance)
+
+    # reconstruct 3D points
+    trajectory_3d = reconstruct_trajectories(trajectory_data, camera_params, mirrorview)
+    trajectory_3d['epipolar_distance'] = epipolar_distance
 
+    # use the actual frame size of the original video if it can be found
     video_name = navigation_utilities.build_video_name(video_metadata, videos_parent)
-    # test_pt_alignment(video_name, dlc_data)
+    video_info = video_probe.get_video_info(video_name)
+    if video_info is not None:
+        video_metadata['im_size'] = video_info['im_size']
 
-    sio.savemat(mat_name, mat_data)
+    mat_data = package_data_into_mat(trajectory_data, video_metadata, trajectory_metadata, trajectory_3d=trajectory_3d)
 
-    # reconstruct 3D points
-    # reconstruct_trajectories(dlc_data, camera_params)
-    pass
+    # test_pt_alignment(video_name, trajectory_data)
+
+    if output_format == 'mat':
+        mat_name = navigation_utilities.create_mat_fname_dlc_output(video_metadata, dlc_mat_output_parent)
+        sio.savemat(mat_name, mat_data)
+    elif output_format == 'hdf5':
+        store_name = navigation_utilities.create_trajectory_store_name(video_metadata, dlc_mat_output_parent)
+        trajectory_store.write_trajectory(store_name, video_metadata, mat_data)
+
+    return mat_data
+
+
+def triangulate_videos(metadata_list, videos_parent, marked_videos_parent, calibration_parent, dlc_mat_output_parent,
+                       rat_db, num_workers=1, chunksize=None, output_format='mat', max_retries=2,
+                       **triangulate_kwargs):
+    """
+    run triangulate_video on a list of videos, either serially or spread across a pool of processes. Each video is
+    independent, and errors are caught per video so that one bad video doesn't stop the rest of the batch
+
+    :param metadata_list: list of video_metadata dictionaries (e.g., from
+        navigation_utilities.find_marked_vids_for_3d_reconstruction) or video names
+    :param videos_parent: see triangulate_video
+    :param marked_videos_parent: see triangulate_video
+    :param calibration_parent: see triangulate_video
+    :param dlc_mat_output_parent: see triangulate_video
+    :param rat_db: see triangulate_video
+    :param num_workers: number of processes to triangulate videos in parallel. If 1, videos are triangulated one at a
+        time in this process
+    :param chunksize: number of videos sent to a worker at a time. Default splits the list into about 4 chunks per
+        worker, which keeps the workers busy without paying the inter-process overhead for every video
+    :param output_format: see triangulate_video. With 'hdf5', the workers send their results back and only this
+        process writes to the session stores, since an HDF5 file can't be written from several processes at once
+    :param max_retries: number of times videos that were lost when a worker process died (e.g., ran out of memory) are
+        retried, one video per task, on a fresh pool. Videos still lost after that are counted as failed
+    :param triangulate_kwargs: other keyword arguments for triangulate_video (view_list, min_confidence, etc.)
+    :return: triangulation_results - list of dictionaries returned by triangulate_video_job, in the same order as
+        metadata_list
+    """
+    store_results = output_format == 'hdf5'
+    job = functools.partial(triangulate_video_job,
+                            videos_parent=videos_parent,
+                            marked_videos_parent=marked_videos_parent,
+                            calibration_parent=calibration_parent,
+                            dlc_mat_output_parent=dlc_mat_output_parent,
+                            rat_db=rat_db,
+                            output_format=None if store_results else output_format,
+                            return_mat_data=store_results,
+                            **triangulate_kwargs)
+
+    if num_workers <= 1:
+        triangulation_results = []
+        for video_id in metadata_list:
+            triangulation_results.append(job(video_id))
+            if store_results:
+                store_triangulation_result(video_id, triangulation_results[-1], dlc_mat_output_parent)
+        return triangulation_results
+
+    if chunksize is None:
+        chunksize = max(1, len(metadata_list) // (num_workers * 4))
+
+    # parse each calibration file once here and hand the results to every worker, instead of each worker parsing it
+    calibration_files = []
+    video_folders = set()
+    for video_id in metadata_list:
+        try:
+            video_metadata = triangulation_video_metadata(video_id)
+            calibration_files.append(navigation_utilities.calibration_file_name(video_metadata, calibration_parent))
+            video_folders.add(os.path.dirname(navigation_utilities.build_video_name(video_metadata, videos_parent)))
+        except Exception:
+            # bad video names are reported by triangulate_video_job
+            pass
+    calibration_entries = skilled_reaching_io.preload_calibrations(calibration_files)
+    # likewise probe the original videos for their frame sizes here, so the workers all read the same probe caches
+    video_probe.probe_folders(sorted(video_folders), num_workers=num_workers)
+
+    triangulation_results = [None] * len(metadata_list)
+    chunks = [list(range(i_start, min(i_start + chunksize, len(metadata_list))))
+              for i_start in range(0, len(metadata_list), chunksize)]
+    for i_attempt in range(max_retries + 1):
+        lost_chunks = []
+        with ProcessPoolExecutor(max_workers=num_workers,
+                                 initializer=skilled_reaching_io.seed_calibration_cache,
+                                 initargs=(calibration_entries,)) as executor:
+            futures = {}
+            for chunk in chunks:
+                chunk_ids = [metadata_list[i_video] for i_video in chunk]
+                futures[executor.submit(triangulate_video_chunk, job, chunk_ids)] = chunk
+            for future in as_completed(futures):
+                chunk = futures[future]
+                try:
+                    chunk_results = future.result()
+                except BrokenProcessPool:
+                    lost_chunks.append(chunk)
+                    continue
+                except Exception as e:
+                    chunk_results = [failed_triangulation_result(metadata_list[i_video], e) for i_video in chunk]
+
+                for i_video, triangulation_result in zip(chunk, chunk_results):
+                    if store_results:
+                        store_triangulation_result(metadata_list[i_video], triangulation_result, dlc_mat_output_parent)
+                    triangulation_results[i_video] = triangulation_result
+
+        if not lost_chunks:
+            break
+        # a dead worker takes every unfinished task in the pool down with it, and there's no telling which video it
+        # died on, so retry the lost videos one per task so a video that keeps killing workers only fails itself
+        chunks = [[i_video] for chunk in lost_chunks for i_video in chunk]
+        if i_attempt < max_retries:
+            print('a triangulation worker died, retrying {:d} videos'.format(len(chunks)))
+
+    for chunk in lost_chunks:
+        for i_video in chunk:
+            triangulation_results[i_video] = failed_triangulation_result(
+                metadata_list[i_video], BrokenProcessPool('worker process died while triangulating this video'))
+
+    return triangulation_results
+
+
+def triangulate_video_chunk(job, video_ids):
+    """
+    :param job: triangulate_video_job with the batch's arguments filled in
+    :param video_ids: list of videos to triangulate
+    :return: list of triangulation results, in the same order as video_ids
+    """
+    return [job(video_id) for video_id in video_ids]
+
+
+def failed_triangulation_result(video_id, error):
+
+    return {'video': triangulation_video_name(video_id),
+            'success': False,
+            'error': repr(error),
+            'elapsed': 0.,
+            'calibration_cache_hit': False}
+
+
+def store_triangulation_result(video_id, triangulation_result, dlc_mat_output_parent):
+    """
+    write the mat_data returned with a triangulation result into its session's trajectory store, and drop it from the
+    result so a batch doesn't hold every video's data in memory
+    """
+    mat_data = triangulation_result.pop('mat_data', None)
+    if not triangulation_result['success'] or mat_data is None:
+        return
+
+    try:
+        video_metadata = triangulation_video_metadata(video_id)
+        store_name = navigation_utilities.create_trajectory_store_name(video_metadata, dlc_mat_output_parent)
+        trajectory_store.write_trajectory(store_name, video_metadata, mat_data)
+    except Exception as e:
+        triangulation_result['success'] = False
+        triangulation_result['error'] = repr(e)
+
+
+def triangulate_video_job(video_id, videos_parent, marked_videos_parent, calibration_parent, dlc_mat_output_parent,
+                          rat_db, return_mat_data=False, **triangulate_kwargs):
+    """
+    triangulate a single video, catching any error so it can be reported with the rest of a batch
+
+    :return: triangulation_result - dictionary with keys
+        video - name of the video
+        success - True if the video was triangulated and its .mat file written
+        error - error message if success is False, '' otherwise
+        elapsed - time spent on this video in seconds
+        calibration_cache_hit - True if the calibration had already been parsed in this process
+        mat_data - the video's mat_data (only if return_mat_data is True and the video succeeded)
+    """
+    triangulation_result = {'video': triangulation_video_name(video_id),
+                            'success': True,
+                            'error': '',
+                            'elapsed': 0.,
+                            'calibration_cache_hit': False}
+    start_time = time.time()
+    cache_hits = skilled_reaching_io.calibration_cache_info()['hits']
+
+    try:
+        mat_data = triangulate_video(video_id, videos_parent, marked_videos_parent, calibration_parent,
+                                     dlc_mat_output_parent, rat_db, **triangulate_kwargs)
+        if mat_data is None:
+            triangulation_result['success'] = False
+            triangulation_result['error'] = 'no calibration file found'
+        elif return_mat_data:
+            triangulation_result['mat_data'] = mat_data
+    except Exception as e:
+        triangulation_result['success'] = False
+        triangulation_result['error'] = repr(e)
+
+    triangulation_result['elapsed'] = time.time() - start_time
+    # counters are per process (and other threads can also use the cache), so this is a best guess
+    triangulation_result['calibration_cache_hit'] = skilled_reaching_io.calibration_cache_info()['hits'] > cache_hits
+
+    return triangulation_result
+
+
+def triangulation_video_metadata(video_id):
+
+    if isinstance(video_id, str):
+        return navigation_utilities.parse_video_name(video_id)
+    else:
+        return video_id
+
+
+def triangulation_video_name(video_id):
+
+    if isinstance(video_id, str):
+        return video_id
+    else:
+        return video_id['video_name']
+
+
+def print_triangulation_summary(triangulation_results):
+
+    failed_results = [triangulation_result for triangulation_result in triangulation_results
+                      if not triangulation_result['success']]
+    for triangulation_result in failed_results:
+        print('failed to triangulate {}: {}'.format(triangulation_result['video'], triangulation_result['error']))
+    total_time = sum(triangulation_result['elapsed'] for triangulation_result in triangulation_results)
+    print('triangulated {:d} of {:d} videos ({:.1f} s of processing)'.format(
+        len(triangulation_results) - len(failed_results), len(triangulation_results), total_time))
+    # worker processes keep their own cache counters, so count the hits reported with each video
+    num_hits = sum(triangulation_result['calibration_cache_hit'] for triangulation_result in triangulation_results)
+    print('calibration cache: {:d} hits, {:d} misses'.format(num_hits, len(triangulation_results) - num_hits))
+
+
+def read_dlc_trajectories(dlc_output_pickle_names, dlc_metadata_pickle_names, use_cache=True):
+    """
+    read the deeplabcut output for all views of a video into a single trajectory_data dictionary
+    :param dlc_output_pickle_names: dictionary of _full.pickle file names for each view (None if a view wasn't found)
+    :param dlc_metadata_pickle_names: dictionary of _meta.pickle file names for each view
+    :param use_cache: if True, read the points from the compact cache files next to each pickle (see
+        dlc_output_cache), converting any pickle that doesn't have a current cache yet. If False, read the pickles
+    :return: trajectory_data - dictionary created by create_trajectory_data, filled with the deeplabcut points
+             trajectory_metadata - dictionary created by extract_trajectory_metadata
+    """
+    if not use_cache:
+        return read_dlc_trajectories_from_pickles(dlc_output_pickle_names, dlc_metadata_pickle_names)
+
+    view_list = dlc_output_pickle_names.keys()
+
+    view_points = {view: None for view in view_list}
+    trajectory_metadata = {view: None for view in view_list}
+    for view in view_list:
+        if dlc_output_pickle_names[view] is None:
+            continue
+        dlc_output_cache.convert_dlc_output(dlc_output_pickle_names[view], dlc_metadata_pickle_names[view])
+        coordinates, confidence, cache_metadata = dlc_output_cache.read_dlc_cache(dlc_output_pickle_names[view])
+        view_points[view] = (coordinates, confidence)
+        trajectory_metadata[view] = trajectory_view_metadata(cache_metadata['bodyparts'],
+                                                             cache_metadata['nframes'],
+                                                             cache_metadata['crop_window'],
+                                                             cache_metadata['frame_range'])
+    check_frame_offsets(trajectory_metadata)
+
+    # the cached points are views of the memory-mapped cache files, so this is the only copy made of them
+    trajectory_data = create_trajectory_data(trajectory_metadata)
+    for view in trajectory_data['view_list']:
+        i_view = trajectory_data['view_index'][view]
+        bp_idx = [trajectory_data['bp_index'][bp] for bp in trajectory_metadata[view]['bodyparts']]
+        num_frames = trajectory_metadata[view]['num_frames']
+        trajectory_data['coordinates'][i_view, bp_idx, :num_frames] = view_points[view][0]
+        trajectory_data['confidence'][i_view, bp_idx, :num_frames] = view_points[view][1]
 
+    return trajectory_data, trajectory_metadata
 
-def reconstruct_trajectories(dlc_data_ud, camera_params):
 
-    view_list = tuple(dlc_data_ud.keys())
-    bodyparts = dlc_data_ud[view_list[0]].keys()   # should be bodyparts from the direct view
+def read_dlc_trajectories_from_pickles(dlc_output_pickle_names, dlc_metadata_pickle_names):
 
-    for bp in bodyparts:
+    view_list = dlc_output_pickle_names.keys()
+
+    # read in the pickle files
+    dlc_output = {view: None for view in view_list}
+    dlc_metadata = {view: None for view in view_list}
+    pickle_name_metadata = {view: None for view in view_list}
+    for view in view_list:
+        if not dlc_output_pickle_names[view] is None:
+            dlc_output[view] = skilled_reaching_io.read_pickle(dlc_output_pickle_names[view])
+            dlc_metadata[view] = skilled_reaching_io.read_pickle(dlc_metadata_pickle_names[view])
+            pickle_name_metadata[view] = navigation_utilities.parse_dlc_output_pickle_name(dlc_output_pickle_names[view])
 
-        pass
+    trajectory_metadata = extract_trajectory_metadata(dlc_metadata, pickle_name_metadata)
+    trajectory_data = extract_data_from_dlc_output(dlc_output, trajectory_metadata)
+
+    return trajectory_data, trajectory_metadata
+
+
+def reconstruct_trajectories(trajectory_data_ud, camera_params, mirrorview):
+    """
+    triangulate every bodypart in every frame from the direct view and one mirror view. The direct camera is taken as
+    [I|0] and the mirror is a virtual camera with matrix Pn from the box calibration, both in normalized coordinates,
+    so the 3D points are in the units of the calibration (the matlab code applies the scale factor afterwards)
+    :param trajectory_data_ud: trajectory_data dictionary with undistorted, full-frame points
+    :param camera_params: dictionary from skilled_reaching_io.read_matlab_calibration
+    :param mirrorview: 'leftmirror' or 'rightmirror' - the mirror that sees the reaching paw
+    :return: trajectory_3d dictionary with keys:
+        'bodyparts' - same bodyparts as trajectory_data_ud
+        'mirrorview' - the mirror view used
+        'points3d' - num_bodyparts x num_frames x 3 array of 3D points. NaN where a point is missing from either view
+        'reprojection_error' - 2 x num_bodyparts x num_frames array of the distance in pixels between each 3D point
+            projected back into the direct (row 0) and mirror (row 1) views and the measured point
+    """
+    direct_pts = trajectory_data_ud['coordinates'][trajectory_data_ud['view_index']['direct']].astype(np.float64)
+    mirror_pts = trajectory_data_ud['coordinates'][trajectory_data_ud['view_index'][mirrorview]].astype(np.float64)
+
+    P_direct = np.hstack((np.eye(3), np.zeros((3, 1))))
+    P_mirror = camera_params['Pn'][:, :, PN_VIEW_INDEX[mirrorview]]
+
+    direct_norm = normalize_points(direct_pts, camera_params['mtx'])
+    mirror_norm = normalize_points(mirror_pts, camera_params['mtx'])
+    points3d = triangulate_points(P_direct, P_mirror, direct_norm, mirror_norm)
+
+    reprojection_error = np.stack((reprojection_distance(points3d, P_direct, camera_params['mtx'], direct_pts),
+                                   reprojection_distance(points3d, P_mirror, camera_params['mtx'], mirror_pts)))
+
+    trajectory_3d = {'bodyparts': trajectory_data_ud['bodyparts'],
+                     'mirrorview': mirrorview,
+                     'points3d': points3d,
+                     'reprojection_error': reprojection_error
+                     }
+
+    return trajectory_3d
+
+
+def triangulate_points(P1, P2, pts1, pts2):
+    """
+    linear (DLT) triangulation of matched points from two cameras, solved for all points at once
+    :param P1: 3 x 4 camera matrix for the first camera
+    :param P2: 3 x 4 camera matrix for the second camera
+    :param pts1: array of shape (..., 2) of points in the first camera (same coordinates as P1, e.g. normalized)
+    :param pts2: array of the same shape as pts1 of matching points in the second camera
+    :return: array of shape (..., 3) of 3D points. NaN wherever either point is NaN
+    """
+    pts_shape = np.shape(pts1)[:-1]
+    pts1 = np.reshape(pts1, (-1, 2))
+    pts2 = np.reshape(pts2, (-1, 2))
+    points3d = np.full((pts1.shape[0], 3), np.nan)
+
+    valid_points = ~(np.any(np.isnan(pts1), axis=1) | np.any(np.isnan(pts2), axis=1))
+    if np.any(valid_points):
+        pts1 = pts1[valid_points]
+        pts2 = pts2[valid_points]
+        # each view gives two rows of the system A [X; 1] = 0: x * P[2] - P[0] and y * P[2] - P[1]
+        A = np.stack((pts1[:, [0]] * P1[2] - P1[0],
+                      pts1[:, [1]] * P1[2] - P1[1],
+                      pts2[:, [0]] * P2[2] - P2[0],
+                      pts2[:, [1]] * P2[2] - P2[1]), axis=1)
+        # every point is a finite distance in front of the cameras, so the homogeneous coordinate can be fixed at 1
+        # and X is the least squares solution of A[:, :3] X = -A[:, 3]. The 3 x 3 normal equations for all points are
+        # solved in one batched call, which is much faster than an svd of each 4 x 4 system
+        M = A[:, :, :3]
+        Mt = np.transpose(M, (0, 2, 1))
+        points3d[valid_points] = np.linalg.solve(np.matmul(Mt, M), -np.matmul(Mt, A[:, :, 3:]))[:, :, 0]
+
+    return points3d.reshape(pts_shape + (3,))
+
+
+def project_points(points3d, P, mtx):
+    """
+    :param points3d: array of shape (..., 3) of 3D points
+    :param P: 3 x 4 camera matrix (normalized coordinates)
+    :param mtx: camera intrinsic matrix (opencv convention)
+    :return: array of shape (..., 2) of the points projected into the image, in pixels
+    """
+    pts_shape = np.shape(points3d)[:-1]
+    homogeneous_pts = np.hstack((np.reshape(points3d, (-1, 3)), np.ones((int(np.prod(pts_shape)), 1))))
+    projected_pts = np.matmul(homogeneous_pts, np.transpose(np.matmul(mtx, P)))
+    projected_pts = projected_pts[:, :2] / projected_pts[:, 2:]
+
+    return projected_pts.reshape(pts_shape + (2,))
+
+
+def reprojection_distance(points3d, P, mtx, measured_pts):
+
+    projected_pts = project_points(points3d, P, mtx)
+
+    return np.linalg.norm(projected_pts - measured_pts, axis=-1)
+
+
+def epipolar_distances(trajectory_data_ud, camera_params, mirrorview):
+    """
+    distance of each direct/mirror point pair from satisfying the epipolar constraint, for all bodyparts and frames
+    :param trajectory_data_ud: trajectory_data dictionary with undistorted, full-frame points
+    :param camera_params: dictionary from skilled_reaching_io.read_matlab_calibration
+    :param mirrorview: 'leftmirror' or 'rightmirror'
+    :return: num_bodyparts x num_frames array of the larger of (distance of the mirror point from the epipolar line of
+        the direct point, distance of the direct point from the epipolar line of the mirror point) in pixels. NaN
+        where either point is missing. For a mirror F is skew-symmetric, so which view F maps from only changes the
+        sign of the lines
+    """
+    F = camera_params['F'][:, :, PN_VIEW_INDEX[mirrorview]]
+    direct_pts = trajectory_data_ud['coordinates'][trajectory_data_ud['view_index']['direct']].astype(np.float64)
+    mirror_pts = trajectory_data_ud['coordinates'][trajectory_data_ud['view_index'][mirrorview]].astype(np.float64)
+
+    ones = np.ones(direct_pts.shape[:-1] + (1,))
+    direct_pts = np.concatenate((direct_pts, ones), axis=-1)
+    mirror_pts = np.concatenate((mirror_pts, ones), axis=-1)
+
+    mirror_lines = np.matmul(direct_pts, np.transpose(F))    # F x_direct for every point
+    direct_lines = np.matmul(mirror_pts, F)                   # F' x_mirror for every point
+    residual = np.abs(np.sum(mirror_pts * mirror_lines, axis=-1))
+
+    mirror_distance = residual / np.linalg.norm(mirror_lines[..., :2], axis=-1)
+    direct_distance = residual / np.linalg.norm(direct_lines[..., :2], axis=-1)
+
+    return np.maximum(mirror_distance, direct_distance)
+
+
+def mask_epipolar_outliers(trajectory_data_ud, mirrorview, epipolar_distance, max_epipolar_distance):
+    """
+    remove (set to NaN) both points of every direct/mirror pair that is further than max_epipolar_distance pixels from
+    its epipolar lines. There's no way to tell which of the two is mislabeled, so neither is kept
+    :param trajectory_data_ud: trajectory_data dictionary with undistorted, full-frame points
+    :param mirrorview: 'leftmirror' or 'rightmirror'
+    :param epipolar_distance: num_bodyparts x num_frames array from epipolar_distances
+    :param max_epipolar_distance: largest allowed distance in pixels
+    :return: trajectory_data_ud
+    """
+    with np.errstate(invalid='ignore'):
+        outliers = epipolar_distance > max_epipolar_distance
+
+    for view in ('direct', mirrorview):
+        trajectory_data_ud['coordinates'][trajectory_data_ud['view_index'][view]][outliers] = np.nan
+
+    return trajectory_data_ud
+
+
+def get_mirrorview(paw_pref):
+    # the reaching paw is best seen in the mirror on the opposite side
+    if paw_pref == 'right':
+        return 'leftmirror'
+    else:
+        return 'rightmirror'
 
 
 def extract_trajectory_metadata(dlc_metadata, name_metadata):
@@ -82,130 +540,282 @@ def extract_trajectory_metadata(dlc_metadata, name_metadata):
     for view in view_list:
         if name_metadata[view] is None:
             continue
-        trajectory_metadata[view] = {'bodyparts': dlc_metadata[view]['data']['DLC-model-config file']['all_joints_names'],
-                                     'num_frames': dlc_metadata[view]['data']['nframes'],
-                                     'crop_window': name_metadata[view]['crop_window']
-                                     }
-    # todo:check that number of frames and bodyparts are the same in each view
+        trajectory_metadata[view] = trajectory_view_metadata(dlc_metadata[view]['data']['DLC-model-config file']['all_joints_names'],
+                                                             dlc_metadata[view]['data']['nframes'],
+                                                             name_metadata[view]['crop_window'],
+                                                             name_metadata[view].get('frame_range'))
+    check_frame_offsets(trajectory_metadata)
 
     return trajectory_metadata
 
 
-def translate_points_to_full_frame(dlc_data, trajectory_metadata):
+def trajectory_view_metadata(bodyparts, num_frames, crop_window, frame_range):
 
-    view_list = tuple(trajectory_metadata.keys())
+    # if only a window of frames was cropped out of the original video, frame i in the dlc output is frame
+    # i + frame_offset in the original video
+    return {'bodyparts': bodyparts,
+            'num_frames': num_frames,
+            'crop_window': crop_window,
+            'frame_offset': 0 if frame_range is None else frame_range[0]
+            }
 
-    for view in view_list:
-        if trajectory_metadata[view] is None:
-            continue
 
+def check_frame_offsets(trajectory_metadata):
+
+    # todo:check that number of frames and bodyparts are the same in each view
+    frame_offsets = set(trajectory_metadata[view]['frame_offset'] for view in trajectory_metadata.keys()
+                        if trajectory_metadata[view] is not None)
+    if len(frame_offsets) > 1:
+        raise ValueError('views were cropped with different frame ranges')
+
+
+def preprocess_trajectories(trajectory_data, min_confidence=0.95, max_velocity=None, max_gap=0):
+    """
+    remove unreliable points from trajectory_data (in place), and optionally fill short gaps. Each step works on all
+    views, bodyparts and frames at once
+    :param trajectory_data: dictionary created by create_trajectory_data
+    :param min_confidence: points with a deeplabcut confidence below this are removed (set to NaN)
+    :param max_velocity: points that jump more than this many pixels from the previous frame and back again in the
+        next frame (or from/to a missing neighbor) are removed. None to skip this check
+    :param max_gap: runs of at most this many missing frames between two found points are filled by linear
+        interpolation. Filled points keep a NaN confidence so they can be told apart from deeplabcut points
+    :return: trajectory_data
+    """
+    coordinates = trajectory_data['coordinates']
+
+    if min_confidence is not None:
+        # NaN confidence means the point is already missing
+        coordinates[trajectory_data['confidence'] < min_confidence] = np.nan
+
+    if max_velocity is not None:
+        coordinates[find_trajectory_jumps(coordinates, max_velocity)] = np.nan
+
+    if max_gap > 0:
+        fill_trajectory_gaps(coordinates, max_gap)
+
+    return trajectory_data
+
+
+def find_trajectory_jumps(coordinates, max_velocity):
+    """
+    :param coordinates: array of shape (..., num_frames, 2)
+    :param max_velocity: largest allowed frame-to-frame movement in pixels
+    :return: boolean array of shape (..., num_frames), True for points that are isolated jumps - the movement into the
+        point and the movement out of it are both over max_velocity (or one is over and the other neighbor is missing)
+    """
+    step_size = np.linalg.norm(np.diff(coordinates, axis=-2), axis=-1)    # (..., num_frames - 1), NaN next to a gap
+    pad = np.full(step_size.shape[:-1] + (1,), np.nan)
+    step_in = np.concatenate((pad, step_size), axis=-1)
+    step_out = np.concatenate((step_size, pad), axis=-1)
+
+    with np.errstate(invalid='ignore'):
+        jump_in = step_in > max_velocity
+        jump_out = step_out > max_velocity
+
+    return (jump_in & (jump_out | np.isnan(step_out))) | (jump_out & np.isnan(step_in))
+
+
+def fill_trajectory_gaps(coordinates, max_gap):
+    """
+    fill runs of missing points by linear interpolation between the found points on either side (in place). Gaps at
+    the start or end of a trajectory, and gaps longer than max_gap frames, are left missing
+    :param coordinates: array of shape (..., num_frames, 2)
+    :param max_gap: longest run of missing frames to fill
+    :return: coordinates
+    """
+    num_frames = coordinates.shape[-2]
+    series = coordinates.reshape((-1, num_frames, 2))    # one row per view/bodypart
+    valid_points = ~np.any(np.isnan(series), axis=-1)
+
+    # index of the last found point at or before each frame, and the first found point at or after it
+    frame_idx = np.arange(num_frames)
+    prev_idx = np.maximum.accumulate(np.where(valid_points, frame_idx, -1), axis=-1)
+    next_idx = np.minimum.accumulate(np.where(valid_points, frame_idx, num_frames)[:, ::-1], axis=-1)[:, ::-1]
+
+    to_fill = ~valid_points & (prev_idx >= 0) & (next_idx < num_frames) & (next_idx - prev_idx - 1 <= max_gap)
+    if not np.any(to_fill):
+        return coordinates
+
+    i_series, i_frame = np.nonzero(to_fill)
+    prev_pts = series[i_series, prev_idx[i_series, i_frame]]
+    next_pts = series[i_series, next_idx[i_series, i_frame]]
+    weight = (i_frame - prev_idx[i_series, i_frame]) / (next_idx[i_series, i_frame] - prev_idx[i_series, i_frame])
+    series[i_series, i_frame] = prev_pts + weight[:, np.newaxis] * (next_pts - prev_pts)
+
+    if not np.shares_memory(series, coordinates):
+        coordinates[...] = series.reshape(coordinates.shape)
+
+    return coordinates
+
+
+def translate_points_to_full_frame(trajectory_data, trajectory_metadata):
+
+    for view in trajectory_data['view_list']:
+        i_view = trajectory_data['view_index'][view]
+        coordinates = trajectory_data['coordinates'][i_view]    # num_bodyparts x num_frames x 2 view into the array
+        confidence = trajectory_data['confidence'][i_view]
+        crop_window = trajectory_metadata[view]['crop_window']
+
+        # points that weren't found are NaN and stay NaN through the arithmetic below, so whole-view operations only
+        # change the points that were found
         if view == 'rightmirror':
-            crop_width = trajectory_metadata[view]['crop_window'][1] - trajectory_metadata[view]['crop_window'][0] + 1
-            # images were reversed after cropping, so need to reverse back before undistorting. Also, left and right
-            # labels were swapped in the right mirror view
-            for bp in trajectory_metadata[view]['bodyparts']:
-                for i_frame in range(trajectory_metadata[view]['num_frames']):
-                    if not np.all(dlc_data[view][bp]['coordinates'][i_frame] == 0):
-                        # a point was found in this frame (coordinate == 0 if no point found)
-                        # x-values should be reflected across the midline of the cropped field
-                        x = dlc_data[view][bp]['coordinates'][i_frame, 0]
-                        dlc_data[view][bp]['coordinates'][i_frame, 0] = (crop_width - x) + 1
-
-            for bp in trajectory_metadata[view]['bodyparts']:
-                # if the right mirror view, need to swap left-sided bodyparts for right-sided
-                if 'right' in bp:
-                    contra_bp = bp.replace('right', 'left')
-                    trajectory_placeholder = dlc_data[view][bp]['coordinates']
-                    confidence_placeholder = dlc_data[view][bp]['confidence']
-                    dlc_data[view][bp]['coordinates'] = dlc_data[view][contra_bp]['coordinates']
-                    dlc_data[view][bp]['confidence'] = dlc_data[view][contra_bp]['confidence']
-                    dlc_data[view][contra_bp]['coordinates'] = trajectory_placeholder
-                    dlc_data[view][contra_bp]['confidence'] = confidence_placeholder
-                    # don't also swap left for right or we'll just swap them back to where they started
-
-        for bp in trajectory_metadata[view]['bodyparts']:
-            # translate point
-            for i_frame in range(trajectory_metadata[view]['num_frames']):
-                if not np.all(dlc_data[view][bp]['coordinates'][i_frame] == 0):
-                    # a point was found in this frame (coordinate == 0 if no point found)
-                    dlc_data[view][bp]['coordinates'][i_frame] += [trajectory_metadata[view]['crop_window'][0], trajectory_metadata[view]['crop_window'][2]]
-                    dlc_data[view][bp]['coordinates'][i_frame] -= 1
-
-    return dlc_data
+            crop_width = crop_window[1] - crop_window[0] + 1
+            # images were reversed after cropping, so need to reverse back before undistorting. x-values should be
+            # reflected across the midline of the cropped field
+            coordinates[:, :, 0] = (crop_width - coordinates[:, :, 0]) + 1
+
+            # left and right labels were swapped in the right mirror view
+            bp_order = mirror_bodypart_order(trajectory_data, trajectory_metadata[view]['bodyparts'])
+            coordinates[:] = coordinates[bp_order]
+            confidence[:] = confidence[bp_order]
+
+        # translate points
+        coordinates += np.array([crop_window[0], crop_window[2]])
+        coordinates -= 1
+
+    return trajectory_data
+
+
+def mirror_bodypart_order(trajectory_data, view_bodyparts):
+    """
+    :param trajectory_data: dictionary created by create_trajectory_data
+    :param view_bodyparts: bodyparts labeled in the mirror view
+    :return: index array that reorders the bodypart axis of trajectory_data so that each right-sided bodypart trades
+        places with its left-sided counterpart
+    """
+    bp_index = trajectory_data['bp_index']
+    bp_order = np.arange(len(trajectory_data['bodyparts']))
+    for bp in view_bodyparts:
+        if 'right' in bp:
+            contra_bp = bp.replace('right', 'left')
+            # don't also swap left for right or we'll just swap them back to where they started
+            bp_order[bp_index[bp]] = bp_index[contra_bp]
+            bp_order[bp_index[contra_bp]] = bp_index[bp]
+
+    return bp_order
 
 
 def extract_data_from_dlc_output(dlc_output, trajectory_metadata):
 
-    view_list = dlc_output.keys()
+    trajectory_data = create_trajectory_data(trajectory_metadata)
 
-    dlc_data = {view: None for view in view_list}
-    for view in view_list:
-        # initialize dictionaries for each bodypart
-        if trajectory_metadata[view] is None:
-            continue
+    for view in trajectory_data['view_list']:
+        i_view = trajectory_data['view_index'][view]
+        # frame i_frame of each array holds frame i_frame + trajectory_metadata[view]['frame_offset'] of the original video
         num_frames = trajectory_metadata[view]['num_frames']
-        dlc_data[view] = {bp: None for bp in trajectory_metadata[view]['bodyparts']}
-        for i_bp, bp in enumerate(trajectory_metadata[view]['bodyparts']):
+        bodyparts = trajectory_metadata[view]['bodyparts']
+        bp_idx = [trajectory_data['bp_index'][bp] for bp in bodyparts]
+
+        coordinates, confidence = dlc_output_cache.extract_dlc_arrays(dlc_output[view], len(bodyparts), num_frames,
+                                                                      dtype=trajectory_data['coordinates'].dtype)
+        trajectory_data['coordinates'][i_view, bp_idx, :num_frames] = coordinates
+        trajectory_data['confidence'][i_view, bp_idx, :num_frames] = confidence
+
+    return trajectory_data
+
+
+def create_trajectory_data(trajectory_metadata, dtype=np.float32):
+    """
+    allocate the arrays that hold the 2D points from all views of a single video
+    :param trajectory_metadata: dictionary with one entry per view, created by extract_trajectory_metadata. Views
+        without dlc output (entry is None) are left out
+    :param dtype: data type of the coordinate and confidence arrays
+    :return: trajectory_data dictionary with the following keys:
+        'view_list' - tuple of views with dlc output
+        'bodyparts' - tuple of all bodyparts found in any view, in the direct view order first
+        'view_index', 'bp_index' - dictionaries mapping view and bodypart names to indices into the arrays below
+        'coordinates' - num_views x num_bodyparts x num_frames x 2 array of (x, y) points. NaN where no point was found
+        'confidence' - num_views x num_bodyparts x num_frames array of deeplabcut confidence values. NaN where no point
+            was found
+    """
+    view_list = tuple(view for view in trajectory_metadata.keys() if trajectory_metadata[view] is not None)
+    if 'direct' in view_list:
+        view_list = ('direct',) + tuple(view for view in view_list if view != 'direct')
+
+    bodyparts = []
+    for view in view_list:
+        bodyparts.extend(bp for bp in trajectory_metadata[view]['bodyparts'] if bp not in bodyparts)
+    bodyparts = tuple(bodyparts)
 
-            dlc_data[view][bp] = {'coordinates': np.zeros((num_frames, 2)),
-                                  'confidence': np.zeros((num_frames, 1)),
-                                  }
+    num_frames = max([trajectory_metadata[view]['num_frames'] for view in view_list], default=0)
 
-            for i_frame in range(num_frames):
-                frame_key = 'frame{:04d}'.format(i_frame)
+    trajectory_data = {'view_list': view_list,
+                       'bodyparts': bodyparts,
+                       'view_index': {view: i_view for i_view, view in enumerate(view_list)},
+                       'bp_index': {bp: i_bp for i_bp, bp in enumerate(bodyparts)},
+                       'coordinates': np.full((len(view_list), len(bodyparts), num_frames, 2), np.nan, dtype=dtype),
+                       'confidence': np.full((len(view_list), len(bodyparts), num_frames), np.nan, dtype=dtype)
+                       }
 
-                try:
-                    dlc_data[view][bp]['coordinates'][i_frame, :] = dlc_output[view][frame_key]['coordinates'][0][i_bp][0]
-                    dlc_data[view][bp]['confidence'][i_frame] = dlc_output[view][frame_key]['confidence'][i_bp][0][0]
-                except:
-                    # 'coordinates' array and 'confidence' array at this frame are empty - must be a peculiarity of deeplabcut
-                    # just leave the dlc_data arrays as empty
-                    pass
+    return trajectory_data
 
-    return dlc_data
 
+def view_bodypart_data(trajectory_data, view, bodyparts):
+    """
+    :param trajectory_data: dictionary created by create_trajectory_data
+    :param view: name of the view
+    :param bodyparts: list of bodyparts, in the order they should be returned
+    :return: coordinates - num_bodyparts x num_frames x 2 array of points for the listed bodyparts in view
+             confidence - num_bodyparts x num_frames array of confidence values
+    """
+    i_view = trajectory_data['view_index'][view]
+    bp_idx = [trajectory_data['bp_index'][bp] for bp in bodyparts]
 
-def undistort_points(dlc_data, camera_params):
+    return trajectory_data['coordinates'][i_view, bp_idx], trajectory_data['confidence'][i_view, bp_idx]
 
-    view_list = dlc_data.keys()
 
-    for view in view_list:
+def undistort_points(trajectory_data, camera_params):
 
-        if dlc_data[view] is None:
-            continue
+    # all views are seen through the same lens, so every point that was found (coordinate == NaN if no point found)
+    # goes through opencv in a single call
+    coordinates = trajectory_data['coordinates']
+    valid_points = ~np.any(np.isnan(coordinates), axis=-1)
+    if not np.any(valid_points):
+        return trajectory_data
 
-        bodyparts = dlc_data[view].keys()
-        for bp in bodyparts:
-            for i_row, row in enumerate(dlc_data[view][bp]['coordinates']):
-                if not np.all(row == 0):
-                    # a point was found in this frame (coordinate == 0 if no point found)
-                    norm_pt_ud = cv2.undistortPoints(row, camera_params['mtx'], camera_params['dist'])  # todo: account for distortion coefficients
-                    pt_ud = unnormalize_points(norm_pt_ud, camera_params['mtx'])
-                    dlc_data[view][bp]['coordinates'][i_row, :] = np.squeeze(pt_ud)
+    pts = coordinates[valid_points].reshape((-1, 1, 2))
+    norm_pts_ud = cv2.undistortPoints(pts, camera_params['mtx'], camera_params['dist'])
+    pts_ud = unnormalize_points(norm_pts_ud, camera_params['mtx'])
+    coordinates[valid_points] = pts_ud.reshape((-1, 2))
 
-    return dlc_data
+    return trajectory_data
 
 
 def normalize_points(pts, mtx):
+    """
+    :param pts: points in pixel coordinates as an array of shape (..., 2)
+    :param mtx: camera intrinsic matrix (opencv convention)
+    :return: normalized points, same shape as pts
+    """
+    pts = np.asarray(pts)
+    homogeneous_pts = np.hstack((pts.reshape((-1, 2)), np.ones((pts.size // 2, 1))))
+    normalized_pts = np.matmul(homogeneous_pts, np.transpose(np.linalg.inv(mtx)))
+    normalized_pts = normalized_pts[:, :2] / normalized_pts[:, 2:]
 
-    pass
+    return normalized_pts.reshape(pts.shape)
 
-def unnormalize_points(pts, mtx):
 
-    homogeneous_pts = np.squeeze(cv2.convertPointsToHomogeneous(pts))
-    unnormalized_pts = np.matmul(mtx, homogeneous_pts)
-    unnormalized_pts = cv2.convertPointsFromHomogeneous(np.array([unnormalized_pts]))    # np.array needed to make dimensions work for the function call
+def unnormalize_points(pts, mtx):
+    """
+    :param pts: normalized points as an array of shape (..., 2), e.g. the n x 1 x 2 output of cv2.undistortPoints
+    :param mtx: camera intrinsic matrix (opencv convention)
+    :return: points in pixel coordinates, same shape as pts
+    """
+    pts = np.asarray(pts)
+    homogeneous_pts = np.hstack((pts.reshape((-1, 2)), np.ones((pts.size // 2, 1))))
+    unnormalized_pts = np.matmul(homogeneous_pts, np.transpose(mtx))
+    unnormalized_pts = unnormalized_pts[:, :2] / unnormalized_pts[:, 2:]
 
-    return unnormalized_pts
+    return unnormalized_pts.reshape(pts.shape)
 
 
-def test_pt_alignment(video_name, dlc_data):
+def test_pt_alignment(video_name, trajectory_data):
 
     circ_r = 4
     circ_t = 1
 
-    view_list = tuple(dlc_data.keys())
-    bodyparts = tuple(dlc_data[view_list[0]].keys())
+    view_list = trajectory_data['view_list']
+    bodyparts = trajectory_data['bodyparts']
 
     video_object = cv2.VideoCapture(video_name)
 
@@ -223,7 +833,8 @@ def test_pt_alignment(video_name, dlc_data):
                     circ_color = (0, 255, 0)
                 else:
                     circ_color = (255, 0, 0)
-                x, y = dlc_data[view][bp]['coordinates'][frame_counter]
+                i_view = trajectory_data['view_index'][view]
+                x, y = trajectory_data['coordinates'][i_view, trajectory_data['bp_index'][bp], frame_counter]
                 try:
                     x = int(round(x))
                     y = int(round(y))
@@ -237,26 +848,18 @@ def test_pt_alignment(video_name, dlc_data):
     video_object.release()
 
 
-def package_data_into_mat(dlc_data, video_metadata, trajectory_metadata):
+def package_data_into_mat(trajectory_data, video_metadata, trajectory_metadata, trajectory_3d=None):
 
-    if video_metadata['paw_pref'] == 'right':
-        mirrorview = 'leftmirror'
-    else:
-        mirrorview = 'rightmirror'
-
-    bodyparts = trajectory_metadata['direct']['bodyparts']
-    num_bp = len(bodyparts)
-    num_frames = len(dlc_data['direct'][bodyparts[0]]['confidence'])
-
-    direct_pts_ud = np.zeros((num_bp, num_frames, 2))
-    mirror_pts_ud = np.zeros((num_bp, num_frames, 2))
-    direct_p = np.zeros((num_bp, num_frames))
-    mirror_p = np.zeros((num_bp, num_frames))
-    for i_bp, bp in enumerate(bodyparts):
-        direct_pts_ud[i_bp, :, :] = dlc_data['direct'][bp]['coordinates']
-        mirror_pts_ud[i_bp, :, :] = dlc_data[mirrorview][bp]['coordinates']
-        direct_p[i_bp, :] = dlc_data['direct'][bp]['confidence'].T
-        mirror_p[i_bp, :] = dlc_data[mirrorview][bp]['confidence'].T
+    mirrorview = get_mirrorview(video_metadata['paw_pref'])
+
+    direct_pts_ud, direct_p = view_bodypart_data(trajectory_data, 'direct', trajectory_metadata['direct']['bodyparts'])
+    mirror_pts_ud, mirror_p = view_bodypart_data(trajectory_data, mirrorview, trajectory_metadata[mirrorview]['bodyparts'])
+
+    # the matlab code expects doubles, with 0 wherever no point was found
+    direct_pts_ud = np.nan_to_num(direct_pts_ud.astype(np.float64))
+    mirror_pts_ud = np.nan_to_num(mirror_pts_ud.astype(np.float64))
+    direct_p = np.nan_to_num(direct_p.astype(np.float64))
+    mirror_p = np.nan_to_num(mirror_p.astype(np.float64))
 
     # crop_window is [left, right, top, bottom]
     # ROIs are [left, top, width, height]
@@ -264,6 +867,10 @@ def package_data_into_mat(dlc_data, video_metadata, trajectory_metadata):
     ROI_mirror = convert_lrtb_to_ltwh(trajectory_metadata[mirrorview]['crop_window'])
     ROIs = np.vstack((ROI_direct, ROI_mirror))
 
+    # frame_offset is the number of frames of the original video that were skipped before the first frame of the
+    # points arrays (0 unless only a window of frames was cropped)
+    frame_offset = trajectory_metadata['direct']['frame_offset']
+
     mat_data = {'direct_pts_ud': direct_pts_ud,
                 'mirror_pts_ud': mirror_pts_ud,
                 'direct_bp': trajectory_metadata['direct']['bodyparts'],
@@ -273,9 +880,18 @@ def package_data_into_mat(dlc_data, video_metadata, trajectory_metadata):
                 'paw_pref': video_metadata['paw_pref'],
                 'im_size': video_metadata['im_size'],
                 'video_number': video_metadata['video_number'],
-                'ROIs': ROIs
+                'ROIs': ROIs,
+                'frame_offset': frame_offset
                 }
 
+    if trajectory_3d is not None:
+        # NaN marks points that couldn't be triangulated, since (0, 0, 0) is a real 3D location
+        mat_data['points3d'] = trajectory_3d['points3d']
+        mat_data['reprojection_error'] = trajectory_3d['reprojection_error']
+        mat_data['bodyparts3d'] = trajectory_3d['bodyparts']
+        if 'epipolar_distance' in trajectory_3d:
+            mat_data['epipolar_distance'] = trajectory_3d['epipolar_distance']
+
     return mat_data
 
 
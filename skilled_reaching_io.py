@@ -1,7 +1,30 @@
+import os
 import pickle
+import shutil
+import threading
+from collections import OrderedDict
 import pandas as pd
 import numpy as np
 import scipy.io as sio
+try:
+    import fcntl
+except ImportError:
+    # not available on Windows; reflinks are only attempted where it is
+    fcntl = None
+
+# ioctl request code to clone (reflink) one file into another on filesystems that support it (btrfs, xfs, ...)
+FICLONE = 0x40049409
+
+# parsed box calibrations, keyed by (file name, modification time) and kept in least-recently-used order. Shared by
+# all threads in a process; worker processes can be seeded with a parent's entries (see seed_calibration_cache)
+CALIBRATION_CACHE_SIZE = 64
+_calibration_cache = OrderedDict()
+_calibration_cache_stats = {'hits': 0, 'misses': 0}
+_calibration_cache_lock = threading.Lock()
+
+# parsed rat databases, keyed by csv file name, along with the modification time they were parsed at
+_rat_database_cache = {}
+_rat_database_cache_lock = threading.Lock()
 
 
 def read_pickle(filename):
@@ -16,6 +39,81 @@ def write_pickle(filename, data):
         pickle.dump(data, handle, protocol=pickle.HIGHEST_PROTOCOL)
 
 
+def place_files(file_list, dest_folder, move=False, overwrite=False):
+    """
+    put files into dest_folder without duplicating their contents where possible. Files that are already in dest_folder
+    (by name) are left alone unless overwrite is True; dest_folder is listed once up front rather than checking for each
+    file separately.
+    If the source file is on the same filesystem as dest_folder, moves are plain renames and copies are hard links (or
+    reflinks if hard links aren't allowed). Across filesystems, files are actually copied/moved
+
+    :param file_list: list of full paths to the files to place
+    :param dest_folder: folder to put the files in
+    :param move: if True, the files are moved into dest_folder. If False, the original files stay where they are
+    :param overwrite: if True, files already in dest_folder with the same names are replaced (atomically, so a reader
+        sees either the old or the new file)
+    :return: placed_files - list of full paths to the files that were placed in dest_folder
+    """
+    existing_names = set(entry.name for entry in os.scandir(dest_folder))
+    dest_device = os.stat(dest_folder).st_dev
+
+    placed_files = []
+    for src_file in file_list:
+        _, file_name = os.path.split(src_file)
+        dest_file = os.path.join(dest_folder, file_name)
+        if file_name in existing_names:
+            if not overwrite or os.path.samefile(src_file, dest_file):
+                continue
+            # place the file under a temporary name, then swap it in
+            target_file = dest_file + '.partial'
+            if os.path.exists(target_file):
+                os.remove(target_file)
+        else:
+            target_file = dest_file
+
+        same_device = os.stat(src_file).st_dev == dest_device
+        if move:
+            if same_device:
+                os.rename(src_file, target_file)
+            else:
+                shutil.move(src_file, target_file)
+        elif not (same_device and link_file(src_file, target_file)):
+            shutil.copy2(src_file, target_file)
+        if target_file != dest_file:
+            os.replace(target_file, dest_file)
+
+        existing_names.add(file_name)
+        placed_files.append(dest_file)
+
+    return placed_files
+
+
+def link_file(src_file, dest_file):
+    """
+    make dest_file share the contents of src_file without copying them, first as a hard link, then as a reflink
+
+    :param src_file:
+    :param dest_file:
+    :return: True if dest_file was created, False if neither kind of link is supported
+    """
+    try:
+        os.link(src_file, dest_file)
+        return True
+    except OSError:
+        pass
+
+    if fcntl is None:
+        return False
+    try:
+        with open(src_file, 'rb') as f_src, open(dest_file, 'wb') as f_dest:
+            fcntl.ioctl(f_dest.fileno(), FICLONE, f_src.fileno())
+        return True
+    except OSError:
+        if os.path.exists(dest_file):
+            os.remove(dest_file)
+        return False
+
+
 def read_matlab_calibration(mat_calibration_name):
     """
     read in matlab calibration file and translate all matrices into opencv versions. For example, Matlab assumes
@@ -52,25 +150,167 @@ def read_matlab_calibration(mat_calibration_name):
     return camera_params
 
 
+def read_matlab_calibration_cached(mat_calibration_name, max_size=CALIBRATION_CACHE_SIZE):
+    """
+    read_matlab_calibration, but each calibration file is only parsed once per process as long as it hasn't changed
+    on disk. Videos from the same box and day share a calibration file, so most calls in a batch are cache hits
+
+    :param mat_calibration_name: full path to the box calibration .mat file
+    :param max_size: largest number of calibrations to keep; the least recently used one is dropped beyond that
+    :return: camera_params dictionary (see read_matlab_calibration). The same dictionary is returned on every hit, so
+        it shouldn't be modified
+    """
+    cache_key = (os.path.abspath(mat_calibration_name), os.path.getmtime(mat_calibration_name))
+
+    with _calibration_cache_lock:
+        if cache_key in _calibration_cache:
+            _calibration_cache.move_to_end(cache_key)
+            _calibration_cache_stats['hits'] += 1
+            return _calibration_cache[cache_key]
+        _calibration_cache_stats['misses'] += 1
+
+    # parse outside the lock so other threads aren't held up by file i/o
+    camera_params = read_matlab_calibration(mat_calibration_name)
+
+    with _calibration_cache_lock:
+        _calibration_cache[cache_key] = camera_params
+        _calibration_cache.move_to_end(cache_key)
+        while len(_calibration_cache) > max_size:
+            _calibration_cache.popitem(last=False)
+
+    return camera_params
+
+
+def preload_calibrations(calibration_files):
+    """
+    parse a list of calibration files into the cache, skipping any that don't exist
+    :param calibration_files: list of full paths to box calibration .mat files (duplicates are fine)
+    :return: calibration_entries - list of ((file name, modification time), camera_params) for the files that were
+        loaded, to pass to seed_calibration_cache in worker processes
+    """
+    calibration_entries = []
+    for calibration_file in sorted(set(calibration_files)):
+        if not os.path.exists(calibration_file):
+            continue
+        camera_params = read_matlab_calibration_cached(calibration_file)
+        calibration_entries.append(((os.path.abspath(calibration_file), os.path.getmtime(calibration_file)),
+                                    camera_params))
+
+    return calibration_entries
+
+
+def seed_calibration_cache(calibration_entries, max_size=CALIBRATION_CACHE_SIZE):
+    """
+    add calibrations parsed in another process to this process's cache. Meant to be used as a process pool
+    initializer, so that workers don't each re-parse the same files
+    :param calibration_entries: list returned by preload_calibrations
+    :param max_size: largest number of calibrations to keep. If there are more entries than that, the ones at the end
+        of calibration_entries are kept
+    """
+    with _calibration_cache_lock:
+        for cache_key, camera_params in calibration_entries:
+            _calibration_cache[cache_key] = camera_params
+            _calibration_cache.move_to_end(cache_key)
+        while len(_calibration_cache) > max_size:
+            _calibration_cache.popitem(last=False)
+
+
+def calibration_cache_info():
+    """
+    :return: dictionary with the number of cache 'hits' and 'misses' and the current 'size' of the calibration cache
+        in this process
+    """
+    with _calibration_cache_lock:
+        return {'hits': _calibration_cache_stats['hits'],
+                'misses': _calibration_cache_stats['misses'],
+                'size': len(_calibration_cache)}
+
+
+def clear_calibration_cache():
+
+    with _calibration_cache_lock:
+        _calibration_cache.clear()
+        _calibration_cache_stats['hits'] = 0
+        _calibration_cache_stats['misses'] = 0
+
+
 def read_rat_csv_database(csv_name):
 
-    rat_db = pd.read_csv(csv_name)
+    rat_df = pd.read_csv(csv_name)
+
+    return rat_df
+
+
+def read_rat_registry(csv_name):
+    """
+    read the rat database .csv file into a registry indexed by rat number. The parsed registry is cached, and only
+    re-read if the file has changed since it was parsed
+
+    :param csv_name: full path to the rat database .csv file (e.g., SR_rat_database.csv). Must have a 'ratID' column
+    :return: rat_db - dictionary with keys:
+        'csv_name' - csv_name
+        'table' - the database as a pandas DataFrame indexed by rat number. ratID is an integer (e.g., 382 for R0382)
+            and pawPref is lower case with whitespace stripped
+        'rats' - dictionary mapping rat number to a dictionary of that rat's attributes (one entry per column), for
+            constant-time lookups. Use get_rat_info/get_paw_preference rather than indexing this directly
+        the same rat_db is returned on every call while the file is unchanged, so it shouldn't be modified
+    """
+    cache_key = os.path.abspath(csv_name)
+    csv_mtime = os.path.getmtime(csv_name)
+    with _rat_database_cache_lock:
+        if cache_key in _rat_database_cache and _rat_database_cache[cache_key][0] == csv_mtime:
+            return _rat_database_cache[cache_key][1]
+
+    rat_table = read_rat_csv_database(csv_name)
+    rat_table['ratID'] = [rat_number(ratID) for ratID in rat_table['ratID']]
+    if 'pawPref' in rat_table.columns:
+        rat_table['pawPref'] = rat_table['pawPref'].astype(str).str.strip().str.lower()
+
+    duplicated = rat_table['ratID'].duplicated()
+    if duplicated.any():
+        print('{}: rats {} are listed more than once, using the first entry'.format(
+            csv_name, sorted(set(rat_table['ratID'][duplicated]))))
+        rat_table = rat_table[~duplicated]
+
+    rat_table = rat_table.set_index('ratID', drop=False)
+    rat_db = {'csv_name': csv_name,
+              'table': rat_table,
+              'rats': {ratID: rat_info for ratID, rat_info in zip(rat_table['ratID'], rat_table.to_dict('records'))}
+              }
+
+    with _rat_database_cache_lock:
+        _rat_database_cache[cache_key] = (csv_mtime, rat_db)
 
     return rat_db
-    # # determine how many lines are in the .csv file
-    # with open(csv_name, newline='\n') as csv_file:
-    #     num_lines = sum(1 for row in csv_file)
-    #
-    # with open(csv_name, newline='\n') as csv_file:
-    #     csv_reader = csv.reader(csv_file, delimiter=',')
-    #     cb_points = np.zeros((num_lines-1, 2))
-    #     for i_row, row in enumerate(csv_reader):
-    #         if i_row == 0:
-    #             # check to make sure the header was read in properly
-    #             print(f'Column names are {", ".join(row)}')
-    #         else:
-    #             # read in the rows of checkerboard points
-    #             print('testing')
-    #             pass
-    #
-    # return cb_points
\ No newline at end of file
+
+
+def rat_number(ratID):
+    """
+    :param ratID: rat number (382) or rat ID string ('R0382')
+    :return: rat number as an int
+    """
+    if isinstance(ratID, str):
+        return int(''.join(filter(lambda i: i.isdigit(), ratID)))
+    else:
+        return int(ratID)
+
+
+def get_rat_info(rat_db, ratID):
+    """
+    :param rat_db: rat registry from read_rat_registry
+    :param ratID: rat number (382) or rat ID string ('R0382')
+    :return: dictionary of the rat's attributes from the database (one entry per column)
+    """
+    try:
+        return rat_db['rats'][rat_number(ratID)]
+    except KeyError:
+        raise KeyError('rat {} is not in the rat database {}'.format(ratID, rat_db['csv_name']))
+
+
+def get_paw_preference(rat_db, ratID):
+    """
+    :param rat_db: rat registry from read_rat_registry
+    :param ratID: rat number (382) or rat ID string ('R0382')
+    :return: the rat's preferred paw ('left' or 'right')
+    """
+    return get_rat_info(rat_db, ratID)['pawPref']
@@ -1,29 +1,47 @@
 from crop_videos import preprocess_videos
 from datetime import datetime
+import crop_videos
 import navigation_utilities
 import reconstruct_3d
 import skilled_reaching_calibration
 import skilled_reaching_io
 import glob
+import json
 import os
-import shutil
 import pandas as pd
-import deeplabcut
 
 
-def analyze_cropped_videos(folders_to_analyze, view_config_paths, marked_vids_parent, cropped_vid_type='.avi', gputouse=0, save_as_csv=True):
+def analyze_cropped_videos(folders_to_analyze, view_config_paths, marked_vids_parent, cropped_vid_type='.avi', gputouse=0, save_as_csv=True,
+                           cropped_videos_parent=None, batched=True, max_videos_per_batch=None, dlc=None):
     '''
 
     :param folders_to_analyze:
     :param view_config_paths:
     :param cropped_vid_type:
     :param gputouse:
+    :param cropped_videos_parent: parent of the cropped video tree. If None, it is assumed to be 3 levels up from each
+        folder in folders_to_analyze (cropped_videos_parent/RXXXX/session/session_view)
+    :param batched: if True, all the videos that need to be analyzed by the same network (across all folders and, for
+        the mirror network, both mirror views) are submitted to deeplabcut together so the network is only loaded once
+        per batch. If False, each folder is submitted separately
+    :param max_videos_per_batch: maximum number of videos per call to deeplabcut.analyze_videos when batched is True
+        (at least 1). None for no limit
+    :param dlc: module to use in place of deeplabcut (e.g., a stand-in for testing, which only needs an
+        analyze_videos(config_path, videos, videotype, gputouse, save_as_csv) function that returns the scorername).
+        None to use deeplabcut, which is only imported then, so a stand-in works without deeplabcut installed
     :return: scorernames - dictionary with keys 'direct' and 'mirror' containing the scorername strings returned by
         deeplabcut.analyze_videos
     '''
+    if max_videos_per_batch is not None and max_videos_per_batch < 1:
+        raise ValueError('max_videos_per_batch must be at least 1, or None for no limit')
+    if dlc is None:
+        import deeplabcut as dlc
 
     view_list = folders_to_analyze.keys()
     scorernames = {'direct': '', 'mirror': ''}
+
+    # find the videos that still need to be analyzed in each folder, grouped by the network that will analyze them
+    pending_folders = {'direct': [], 'mirror': []}
     for view in view_list:
         if 'direct' in view:
             dlc_network = 'direct'
@@ -37,45 +55,280 @@ def analyze_cropped_videos(folders_to_analyze, view_config_paths, marked_vids_pa
         current_view_folders = folders_to_analyze[view]
 
         for current_folder in current_view_folders:
+            if cropped_videos_parent is None:
+                folder_cropped_videos_parent = os.path.dirname(os.path.dirname(os.path.dirname(current_folder)))
+            else:
+                folder_cropped_videos_parent = cropped_videos_parent
+            new_dir = navigation_utilities.create_marked_vids_folder(current_folder, folder_cropped_videos_parent,
+                                                                     marked_vids_parent)
+
             cropped_video_list = glob.glob(current_folder + '/*' + cropped_vid_type)
-            #todo: skip if analysis already done and stored in the _marked folder
-            scorername = deeplabcut.analyze_videos(config_path,
-                                      cropped_video_list,
-                                      videotype=cropped_vid_type,
-                                      gputouse=gputouse,
-                                      save_as_csv=save_as_csv)
+            # skip videos that were already analyzed with this network and whose output is in the _marked folder
+            analysis_manifest = read_analysis_manifest(new_dir)
+            videos_to_analyze, prev_scorername = find_unanalyzed_videos(cropped_video_list, new_dir, config_path,
+                                                                        analysis_manifest)
+            if prev_scorername:
+                scorernames[dlc_network] = prev_scorername
+            if not videos_to_analyze:
+                print('all videos in ' + current_folder + ' already analyzed, skipping')
+                write_analysis_manifest(new_dir, analysis_manifest)
+                continue
+
+            pending_folders[dlc_network].append({'folder': current_folder,
+                                                 'marked_folder': new_dir,
+                                                 'videos': videos_to_analyze,
+                                                 'analysis_manifest': analysis_manifest})
+
+    for dlc_network, network_folders in pending_folders.items():
+        if not network_folders:
+            continue
+        config_path = view_config_paths[dlc_network]
+
+        if batched:
+            network_videos = [cropped_video for pending in network_folders for cropped_video in pending['videos']]
+            video_batches = split_into_batches(network_videos, max_videos_per_batch)
+        else:
+            video_batches = [pending['videos'] for pending in network_folders]
+
+        for video_batch in video_batches:
+            scorername = dlc.analyze_videos(config_path,
+                                            video_batch,
+                                            videotype=cropped_vid_type,
+                                            gputouse=gputouse,
+                                            save_as_csv=save_as_csv)
             scorernames[dlc_network] = scorername
 
-            new_dir = navigation_utilities.create_marked_vids_folder(current_folder, cropped_videos_parent,
-                                                                     marked_vids_parent)
-            pickle_list = glob.glob(os.path.join(current_folder, '*.pickle'))
-            for pickle_file in pickle_list:
-                # if the file already exists in the marked_vid directory, don't move it
-                _, pickle_name = os.path.split(pickle_file)
-                if not os.path.isfile(os.path.join(new_dir, pickle_name)):
-                    shutil.copy(pickle_file, new_dir)
+        # deeplabcut writes its output next to each video, so copy the output into the right _marked folders
+        for pending in network_folders:
+            place_dlc_output(pending['folder'], pending['marked_folder'], pending['videos'])
+
+            for cropped_video in pending['videos']:
+                record_video_analysis(pending['analysis_manifest'], cropped_video, config_path, scorernames[dlc_network])
+            write_analysis_manifest(pending['marked_folder'], pending['analysis_manifest'])
 
     return scorernames
 
 
+def split_into_batches(item_list, max_batch_size=None):
+    """
+    :param item_list:
+    :param max_batch_size: maximum number of items per batch (at least 1). None to put everything in one batch
+    :return: list of lists containing the items in item_list, in order
+    """
+    if max_batch_size is None:
+        return [item_list]
+    if max_batch_size < 1:
+        raise ValueError('max_batch_size must be at least 1, or None for no limit')
+
+    return [item_list[i_start:i_start + max_batch_size] for i_start in range(0, len(item_list), max_batch_size)]
+
+
+def place_dlc_output(cropped_vid_folder, marked_folder, cropped_video_list=None):
+    """
+    copy the deeplabcut output pickles from a folder of cropped videos into its _marked folder. On the same filesystem
+    the "copies" are links rather than duplicates
+
+    :param cropped_vid_folder: folder containing cropped videos that were run through deeplabcut
+    :param marked_folder: _marked folder for cropped_vid_folder
+    :param cropped_video_list: videos that were just analyzed. Their pickles replace any already in the _marked folder.
+        If None, every pickle in cropped_vid_folder is placed, skipping pickles already in the _marked folder
+    :return:
+    """
+    pickle_list = glob.glob(os.path.join(cropped_vid_folder, '*.pickle'))
+    if cropped_video_list is None:
+        skilled_reaching_io.place_files(pickle_list, marked_folder)
+        return
+
+    vid_prefixes = tuple(os.path.splitext(os.path.basename(cropped_video))[0] + 'DLC'
+                         for cropped_video in cropped_video_list)
+    new_pickles = [pickle_file for pickle_file in pickle_list if os.path.basename(pickle_file).startswith(vid_prefixes)]
+    skilled_reaching_io.place_files(new_pickles, marked_folder, overwrite=True)
+
+
+def remove_dlc_output(cropped_video, marked_folder):
+    """
+    delete the deeplabcut output (pickles, .h5, .csv, labeled videos) for a cropped video, both next to the video and in
+    its _marked folder. deeplabcut skips videos whose output already exists, so this has to be done before a video that
+    has changed is analyzed again
+
+    :param cropped_video: full path to the cropped video
+    :param marked_folder: _marked folder for the video's folder
+    :return: removed_files - list of the files that were deleted
+    """
+    cropped_vid_folder, vid_name = os.path.split(cropped_video)
+    vid_prefix = os.path.splitext(vid_name)[0] + 'DLC'
+
+    removed_files = []
+    for output_folder in (cropped_vid_folder, marked_folder):
+        for entry in os.scandir(output_folder):
+            if entry.is_file() and entry.name.startswith(vid_prefix):
+                os.remove(entry.path)
+                removed_files.append(entry.path)
+
+    return removed_files
+
+
+def analysis_manifest_name(marked_folder):
+    """
+    :param marked_folder: _marked folder where the deeplabcut output for a folder of cropped videos is stored
+    :return: name of the json file recording which videos have been analyzed with which network
+    """
+    return os.path.join(marked_folder, 'dlc_analysis_manifest.json')
+
+
+def read_analysis_manifest(marked_folder):
+    """
+    :param marked_folder: _marked folder where the deeplabcut output for a folder of cropped videos is stored
+    :return: analysis_manifest - dictionary where each key is a cropped video name and each value is a dictionary with
+        keys 'config_path', 'scorername', 'md5', 'size', 'mtime'. Empty if there is no manifest yet
+    """
+    try:
+        with open(analysis_manifest_name(marked_folder), 'r') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_analysis_manifest(marked_folder, analysis_manifest):
+    """
+    :param marked_folder: _marked folder where the deeplabcut output for a folder of cropped videos is stored
+    :param analysis_manifest: dictionary as returned by read_analysis_manifest
+    :return:
+    """
+    manifest_name = analysis_manifest_name(marked_folder)
+    partial_manifest_name = manifest_name + '.partial'
+    with open(partial_manifest_name, 'w') as f:
+        json.dump(analysis_manifest, f, indent=1)
+    os.replace(partial_manifest_name, manifest_name)
+
+
+def record_video_analysis(analysis_manifest, cropped_video, config_path, scorername):
+    """
+    add (or update) the entry for a cropped video in an analysis manifest
+
+    :param analysis_manifest: dictionary as returned by read_analysis_manifest
+    :param cropped_video: full path to the cropped video
+    :param config_path: deeplabcut config file the video was analyzed with
+    :param scorername: scorername returned by deeplabcut.analyze_videos
+    :return:
+    """
+    _, vid_name = os.path.split(cropped_video)
+    vid_stat = os.stat(cropped_video)
+    analysis_manifest[vid_name] = {'config_path': config_path,
+                                   'scorername': scorername,
+                                   'md5': cropped_video_checksum(cropped_video, analysis_manifest.get(vid_name)),
+                                   'size': vid_stat.st_size,
+                                   'mtime': vid_stat.st_mtime
+                                   }
+
+
+def cropped_video_checksum(cropped_video, manifest_entry=None):
+    """
+    find the checksum of a cropped video as cheaply as possible: from a previous analysis manifest entry if the video
+    hasn't changed since, then from the crop manifest written when the video was cropped, and only then by reading the
+    whole video
+
+    :param cropped_video: full path to the cropped video
+    :param manifest_entry: analysis manifest entry for this video, or None
+    :return: hex md5 digest of the video
+    """
+    vid_stat = os.stat(cropped_video)
+    if manifest_entry is not None and \
+            manifest_entry['size'] == vid_stat.st_size and manifest_entry['mtime'] == vid_stat.st_mtime:
+        return manifest_entry['md5']
+
+    crop_manifest = crop_videos.read_crop_manifest(cropped_video)
+    if crop_manifest is not None and \
+            crop_manifest['size'] == vid_stat.st_size and crop_manifest['mtime'] == vid_stat.st_mtime:
+        return crop_manifest['md5']
+
+    return crop_videos.file_checksum(cropped_video)
+
+
+def find_unanalyzed_videos(cropped_video_list, marked_folder, config_path, analysis_manifest):
+    """
+    figure out which cropped videos still need to be run through deeplabcut. A video is considered analyzed if the
+    analysis manifest has an entry for it with the same network and checksum, and the _full.pickle for that scorer is
+    in the _marked folder. Videos analyzed before manifests were written (pickles in the _marked folder but no entry in
+    the manifest) are added to the manifest instead of being analyzed again. Videos whose checksum has changed since
+    they were analyzed have their old output deleted (see remove_dlc_output) and their manifest entry removed
+
+    :param cropped_video_list: list of full paths to cropped videos
+    :param marked_folder: _marked folder where the deeplabcut output for these videos is stored
+    :param config_path: deeplabcut config file for the network the videos will be analyzed with
+    :param analysis_manifest: dictionary as returned by read_analysis_manifest. Entries for videos analyzed before
+        manifests were written are added to it
+    :return: videos_to_analyze - list of cropped videos that need to be analyzed
+        scorername - scorername of a previous analysis of these videos with this network, '' if none
+    """
+    # list the _marked folder once instead of checking for each pickle separately
+    marked_files = set(entry.name for entry in os.scandir(marked_folder) if entry.is_file())
+    full_pickles = [fname for fname in marked_files if fname.endswith('_full.pickle')]
+
+    videos_to_analyze = []
+    scorername = ''
+    for cropped_video in cropped_video_list:
+        _, vid_name = os.path.split(cropped_video)
+        vid_root, _ = os.path.splitext(vid_name)
+        manifest_entry = analysis_manifest.get(vid_name)
+
+        if manifest_entry is not None:
+            if manifest_entry['md5'] != cropped_video_checksum(cropped_video, manifest_entry):
+                # the video was re-cropped, so none of its output is any good
+                print('{} has changed since it was analyzed, removing its old output'.format(cropped_video))
+                remove_dlc_output(cropped_video, marked_folder)
+                del analysis_manifest[vid_name]
+                videos_to_analyze.append(cropped_video)
+                continue
+            full_pickle_name = vid_root + manifest_entry['scorername'] + '_full.pickle'
+            if manifest_entry['config_path'] == config_path and full_pickle_name in marked_files:
+                scorername = manifest_entry['scorername']
+                continue
+        else:
+            # no manifest entry - check for output from before manifests were written
+            vid_pickles = [fname for fname in full_pickles if fname.startswith(vid_root + 'DLC')]
+            if len(vid_pickles) == 1:
+                prev_scorername = vid_pickles[0][len(vid_root):-len('_full.pickle')]
+                record_video_analysis(analysis_manifest, cropped_video, config_path, prev_scorername)
+                scorername = prev_scorername
+                continue
+
+        videos_to_analyze.append(cropped_video)
+
+    return videos_to_analyze, scorername
+
+
 def create_labeled_videos(folders_to_analyze, marked_vids_parent, view_config_paths, scorernames,
                           cropped_vid_type='.avi',
                           skipdirect=False,
                           skipmirror=False,
-                          view_list=('direct', 'leftmirror', 'rightmirror')
+                          view_list=('direct', 'leftmirror', 'rightmirror'),
+                          cropped_videos_parent=None,
+                          dlc=None
 ):
     '''
     
-    :param folders_to_analyze: 
+    :param folders_to_analyze: dictionary of folders to label for each view as returned by
+        navigation_utilities.find_folders_to_analyze, or the parent of the cropped video tree, in which case every
+        folder in the tree is labeled
     :param view_config_paths: 
     :param scorernames: dictionary with keys 'direct' and 'mirror'
     :param cropped_vid_type:
     :param move_to_new_folder: if True, create a new folder in which the marked videos and analysis files are stored
         to make it easier to move them to another computer without taking the original videos with them
+    :param cropped_videos_parent: parent of the cropped video tree. If None, it is assumed to be 3 levels up from each
+        folder in folders_to_analyze (cropped_videos_parent/RXXXX/session/session_view)
+    :param dlc: module to use in place of deeplabcut (e.g., a stand-in for testing, which only needs a
+        create_video_with_all_detections function). None to use deeplabcut, which is only imported then
     :return: 
     '''
-    # in case there are some previously cropped videos that need to be analyzed
-    folders_to_analyze = navigation_utilities.find_folders_to_analyze(cropped_videos_parent, view_list=view_list)
+    if dlc is None:
+        import deeplabcut as dlc
+
+    if isinstance(folders_to_analyze, str):
+        # in case there are some previously cropped videos that need to be analyzed
+        cropped_videos_parent = folders_to_analyze
+        folders_to_analyze = navigation_utilities.find_folders_to_analyze(cropped_videos_parent, view_list=view_list)
     # view_list = folders_to_analyze.keys()
 
     for view in view_list:
@@ -92,106 +345,36 @@ def create_labeled_videos(folders_to_analyze, marked_vids_parent, view_config_pa
             continue
         config_path = view_config_paths[dlc_network]
         scorername = scorernames[dlc_network]
-        current_view_folders = folders_to_analyze[view]
+        current_view_folders = folders_to_analyze.get(view, [])
 
         for current_folder in current_view_folders:
             cropped_video_list = glob.glob(current_folder + '/*' + cropped_vid_type)
-            deeplabcut.create_video_with_all_detections(config_path, cropped_video_list, scorername)
+            dlc.create_video_with_all_detections(config_path, cropped_video_list, scorername)
 
+            if cropped_videos_parent is None:
+                folder_cropped_videos_parent = os.path.dirname(os.path.dirname(os.path.dirname(current_folder)))
+            else:
+                folder_cropped_videos_parent = cropped_videos_parent
             # current_basename = os.path.basename(current_folder)
-            new_dir =  navigation_utilities.create_marked_vids_folder(current_folder, cropped_videos_parent, marked_vids_parent)
+            new_dir =  navigation_utilities.create_marked_vids_folder(current_folder, folder_cropped_videos_parent, marked_vids_parent)
             #    os.path.join(marked_vids_parent, current_basename + '_marked')
 
             test_name = os.path.join(current_folder, '*' + scorername + '*.mp4')
             marked_vid_list = glob.glob(test_name)
             pickle_list = glob.glob(os.path.join(current_folder, '*.pickle'))
 
-            for marked_vid in marked_vid_list:
-                 # if the file already exists in the marked_vid directory, don't move it
-                 _, marked_vid_name = os.path.split(marked_vid)
-                 if not os.path.isfile(os.path.join(new_dir, marked_vid_name)):
-                      shutil.move(marked_vid, new_dir)
-                 for pickle_file in pickle_list:
-                      # if the file already exists in the marked_vid directory, don't move it
-                      _, pickle_name = os.path.split(pickle_file)
-                      if not os.path.isfile(os.path.join(new_dir, pickle_name)):
-                           shutil.move(pickle_file, new_dir)
+            # files that already exist in the marked_vid directory aren't moved
+            skilled_reaching_io.place_files(marked_vid_list, new_dir, move=True)
+            if marked_vid_list:
+                skilled_reaching_io.place_files(pickle_list, new_dir, move=True)
 
 
 if __name__ == '__main__':
 
-    cb_size = (6, 9)
-    # test_calibration_file = '/Volumes/Untitled/DLC_output/calibration_images/2020/202012_calibration/202012_calibration_files/SR_boxCalibration_box04_20201217.mat'
-    # test_pickle_file = '/Users/dan/Documents/deeplabcut/cropped_vids/R0382/R0382_20201216c_direct/R0382_20201216_17-23-50_005_direct_700-1350-270-935DLC_resnet50_skilled_reaching_directOct19shuffle1_200000_full.pickle'
-    # skilled_reaching_calibration.read_matlab_calibration(test_calibration_file)
-    # pickle_metadata = navigation_utilities.parse_dlc_output_pickle_name(test_pickle_file)
-    # test_video_file = '/Users/dan/Documents/deeplabcut/videos_to_analyze/videos_to_crop/R0382/R0382_20201216c/R0382_box02_20201216_17-31-47_010.avi'
-    # test_calibration_file = '/Users/dan/Documents/deeplabcut/videos_to_analyze/calibration_files/2021/202102_calibration/camera_calibration_videos_202102/CameraCalibration_box02_20210211_14-33-25.avi'
-    rat_database_name = '/Users/dan/Documents/deeplabcut/videos_to_analyze/SR_rat_database.csv'
-    label_videos = True
-
-    rat_df = skilled_reaching_io.read_rat_csv_database(rat_database_name)
-
-    # if you only want to label the direct or mirror views, set the skip flag for the other view to True
-    skipdirectlabel = False
-    skipmirrorlabel = False
-
-    gputouse = 2
-    # step 1: preprocess videos to extract left mirror, right mirror, and direct views
-
-    view_list = ('direct', 'leftmirror', 'rightmirror')
-    # parameters for cropping
-    crop_params_dict = {
-        view_list[0]: [700, 1350, 270, 935],
-        view_list[1]: [1, 470, 270, 920],
-        view_list[2]: [1570, 2040, 270, 920]
-    }
-    cropped_vid_type = '.avi'
-
-    videos_parent = '/home/levlab/Public/DLC_DKL/videos_to_analyze'   # on the lambda machine
-    videos_parent = '/Users/dan/Documents/deeplabcut/videos_to_analyze'  # on home mac
-    videos_parent = '/Volumes/Untitled/videos_to_analyze'
-    video_root_folder = os.path.join(videos_parent, 'videos_to_crop')
-    cropped_videos_parent = os.path.join(videos_parent, 'cropped_videos')
-    marked_videos_parent = os.path.join(videos_parent, 'marked_videos')
-    calibration_parent = os.path.join(videos_parent, 'calibration_files')
-    dlc_mat_output_parent = os.path.join(videos_parent, 'matlab_readable_dlc')
-
-    # skilled_reaching_calibration.calibrate_camera_from_video(test_calibration_file, calibration_parent, cb_size=cb_size)
-
-    # video_metadata = navigation_utilities.parse_video_name(test_video_file)
-
-
-    metadata_list = navigation_utilities.find_marked_vids_for_3d_reconstruction(marked_videos_parent, dlc_mat_output_parent, rat_df)
-
-    for md in metadata_list:
-        reconstruct_3d.triangulate_video(md, videos_parent, marked_videos_parent, calibration_parent, dlc_mat_output_parent, rat_df, view_list=view_list)
-
-    # vid_folder_list = ['/Users/dan/Documents/deeplabcut/R0382_20200909c','/Users/dan/Documents/deeplabcut/R0230_20181114a']
-    video_folder_list = navigation_utilities.get_video_folders_to_crop(video_root_folder)
-    # cropped_video_directories = preprocess_videos(video_folder_list, cropped_videos_parent, crop_params_dict, view_list, vidtype='avi')
-
-    # step 2: run the vids through DLC
-    # parameters for running DLC
-    # need to update these paths when moved to the lambda machine
-    view_config_paths = {
-        'direct': '/home/levlab/Public/DLC_DKL/skilled_reaching_direct-Dan_Leventhal-2020-10-19/config.yaml',
-        'mirror': '/home/levlab/Public/DLC_DKL/skilled_reaching_mirror-Dan_Leventhal-2020-10-19/config.yaml'
-    }
-    folders_to_analyze = navigation_utilities.find_folders_to_analyze(cropped_videos_parent, view_list=view_list)
-
-    scorernames = analyze_cropped_videos(folders_to_analyze, view_config_paths, marked_videos_parent, cropped_vid_type=cropped_vid_type, gputouse=gputouse, save_as_csv=True)
-
-    if label_videos:
-        create_labeled_videos(cropped_videos_parent,
-                              marked_videos_parent,
-                              view_config_paths,
-                              scorernames,
-                              cropped_vid_type=cropped_vid_type,
-                              skipdirect=skipdirectlabel,
-                              skipmirror=skipmirrorlabel,
-                              view_list=view_list)
-
-    # step 3: make sure calibration has been run for these sessions
-
-    # step 4: reconstruct the 3d trajectories
+    # the stage order, folder layout, and machine-specific paths now live in pipeline_runner and its config file
+    # (see pipeline_config_example.json), e.g.:
+    #   python skilled_reaching_workflow.py --config pipeline_config.json
+    #   python skilled_reaching_workflow.py --config pipeline_config.json --stages triangulate --dry-run
+    import pipeline_runner
+
+    pipeline_runner.main()
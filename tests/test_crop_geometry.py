@@ -0,0 +1,110 @@
+"""
+the three crop modes (decoding frames, ffmpeg's crop filter, and lossless jpegtran crops) have to cut out the same
+window for the same crop parameters, since translate_points_to_full_frame maps points back the same way for all of them
+"""
+import shutil
+import subprocess
+
+import cv2
+import numpy as np
+import pytest
+
+crop_videos = pytest.importorskip('crop_videos')
+
+JPEG_LAYOUT = {'width': 2040, 'height': 1024, 'mcu_width': 16, 'mcu_height': 8}
+CROP_PARAMS = {'direct': [700, 1350, 270, 935],
+               'leftmirror': [1, 470, 270, 920],
+               'rightmirror': [1570, 2040, 270, 920]}
+
+
+def full_frame():
+    # every pixel has a different value, so a crop that is off by one can't match
+    height, width = JPEG_LAYOUT['height'], JPEG_LAYOUT['width']
+    return np.arange(height * width * 3, dtype=np.int64).reshape((height, width, 3))
+
+
+def emulate_jpegtran(img, jpegtran_args, mcu_width):
+    # jpegtran mirrors the whole blocks of the frame in place, leaves a partial block at the right edge alone, and
+    # then crops in the flipped coordinates
+    if '-flip' in jpegtran_args:
+        full_block_width = (img.shape[1] // mcu_width) * mcu_width
+        img = img.copy()
+        img[:, :full_block_width] = img[:, full_block_width - 1::-1]
+    crop_size, x_offset, y_offset = jpegtran_args[jpegtran_args.index('-crop') + 1].split('+')
+    crop_width, crop_height = map(int, crop_size.split('x'))
+    x_offset, y_offset = int(x_offset), int(y_offset)
+
+    return img[y_offset:y_offset + crop_height, x_offset:x_offset + crop_width]
+
+
+def emulate_ffmpeg_crop(img, crop_filter):
+    crop_width, crop_height, x_offset, y_offset = map(int, crop_filter[len('crop='):].split(':'))
+
+    return img[y_offset:y_offset + crop_height, x_offset:x_offset + crop_width]
+
+
+@pytest.mark.parametrize('view_name', sorted(CROP_PARAMS))
+def test_crop_frame_size(view_name):
+    crop_params = CROP_PARAMS[view_name]
+    cropped_img = crop_videos.crop_frame(full_frame(), crop_params, view_name)
+
+    crop_width, crop_height = crop_videos.crop_window_size(crop_params)
+    assert cropped_img.shape[:2] == (crop_height, crop_width)
+    assert (crop_width, crop_height) == (crop_params[1] - crop_params[0] + 1, crop_params[3] - crop_params[2] + 1)
+
+
+@pytest.mark.parametrize('view_name', sorted(CROP_PARAMS))
+def test_ffmpeg_crop_matches_crop_frame(view_name):
+    img = full_frame()
+    crop_params = CROP_PARAMS[view_name]
+    ffmpeg_img = emulate_ffmpeg_crop(img, crop_videos.ffmpeg_crop_filter(crop_params))
+    # the ffmpeg crop filter doesn't flip, so compare against the unflipped view
+    np.testing.assert_array_equal(ffmpeg_img, crop_videos.crop_frame(img, crop_params, 'direct'))
+
+
+@pytest.mark.parametrize('view_name', sorted(CROP_PARAMS))
+def test_lossless_crop_matches_crop_frame(view_name):
+    img = full_frame()
+    aligned_params = crop_videos.align_crop_window(CROP_PARAMS[view_name], JPEG_LAYOUT, view_name)
+    jpegtran_args = crop_videos.jpegtran_crop_args(aligned_params, view_name, JPEG_LAYOUT)
+
+    lossless_img = emulate_jpegtran(img, jpegtran_args, JPEG_LAYOUT['mcu_width'])
+    np.testing.assert_array_equal(lossless_img, crop_videos.crop_frame(img, aligned_params, view_name))
+
+
+def test_align_crop_window_contains_window():
+    for view_name, crop_params in CROP_PARAMS.items():
+        x1, x2, y1, y2 = crop_videos.align_crop_window(crop_params, JPEG_LAYOUT, view_name)
+        assert (x1 - 1) % JPEG_LAYOUT['mcu_width'] == 0 and (y1 - 1) % JPEG_LAYOUT['mcu_height'] == 0
+        assert x1 <= crop_params[0] and y1 <= crop_params[2] and y2 >= crop_params[3]
+        assert x2 <= JPEG_LAYOUT['width'] and y2 <= JPEG_LAYOUT['height']
+        if view_name != 'rightmirror':
+            assert x2 >= crop_params[1]
+
+
+def test_misaligned_flip_is_rejected():
+    with pytest.raises(ValueError):
+        crop_videos.jpegtran_crop_args([1571, 2032, 265, 920], 'rightmirror', JPEG_LAYOUT)
+
+
+@pytest.mark.skipif(shutil.which('ffmpeg') is None, reason='needs ffmpeg')
+def test_crop_modes_write_the_same_frame_size(tmp_path):
+    vid_path = str(tmp_path / 'R0382_box02_20201216_12-52-39_009.avi')
+    subprocess.run(['ffmpeg', '-loglevel', 'error', '-f', 'lavfi', '-i', 'testsrc=size=640x480:rate=30',
+                    '-frames:v', '5', '-c:v', 'mjpeg', vid_path], check=True)
+    jpeg_layout = crop_videos.probe_mjpeg_layout(vid_path)
+    crop_params = crop_videos.align_crop_window([101, 300, 41, 200], jpeg_layout, 'rightmirror')
+
+    filtertypes = ['', 'mjpeg2jpeg', 'mjpeg_pipe']
+    if shutil.which('jpegtran') is not None:
+        filtertypes.append('mjpeg_lossless')
+    frame_sizes = {}
+    for filtertype in filtertypes:
+        cropped_path = str(tmp_path / 'cropped_{}.avi'.format(filtertype or 'ffmpeg'))
+        crop_videos.crop_video(vid_path, cropped_path, crop_params, 'rightmirror', filtertype=filtertype)
+        video_object = cv2.VideoCapture(cropped_path)
+        frame_sizes[filtertype] = (int(video_object.get(cv2.CAP_PROP_FRAME_WIDTH)),
+                                   int(video_object.get(cv2.CAP_PROP_FRAME_HEIGHT)))
+        video_object.release()
+
+    assert set(frame_sizes.values()) == {crop_videos.crop_window_size(crop_params)}
@@ -0,0 +1,99 @@
+from datetime import datetime
+
+import pytest
+
+import filename_parser
+
+TRIGGERTIME = datetime(2020, 12, 16, 12, 52, 39)
+SCORERNAME = 'DLC_resnet50_skilledreachingJan1shuffle1_1030000'
+
+
+@pytest.mark.parametrize('file_name, name_type', [
+    ('R0382_box02_20201216_12-52-39_009.avi', 'video'),
+    ('R0382_box02_20201216_12-52-39_009_direct_700-1350-270-935.avi', 'cropped_video'),
+    ('R0382_box02_20201216_12-52-39_009_direct_700-1350-270-935' + SCORERNAME + '_full.pickle', 'dlc_output'),
+    ('R0382_box02_20201216_12-52-39_009_dlc-out.mat', 'dlc_mat'),
+    ('CameraCalibration_box02_20201216_12-52-39.avi', 'camera_calibration_video'),
+    ('calibration_cam01_20201216_12-52-39.avi', 'calibration_video'),
+    ('SR_boxCalibration_box02_20201216.mat', 'box_calibration'),
+])
+def test_name_types(file_name, name_type):
+    parsed_name = filename_parser.parse_file_name('/some/folder/' + file_name)
+    assert parsed_name.name_type == name_type
+
+
+def test_video_fields():
+    parsed_name = filename_parser.parse_file_name('R0382_box02_20201216_12-52-39_009.avi')
+    assert parsed_name.ratID == 'R0382'
+    assert parsed_name.rat_num == 382
+    assert parsed_name.boxnum == 2
+    assert parsed_name.triggertime == TRIGGERTIME
+    assert parsed_name.video_number == 9
+    assert parsed_name.ext == '.avi'
+
+    # boxnum is 99 if it isn't in the name
+    assert filename_parser.parse_file_name('R0382_20201216_12-52-39_009.avi').boxnum == 99
+
+
+def test_cropped_video_fields():
+    parsed_name = filename_parser.parse_file_name('R0382_20201216_12-52-39_009_rightmirror_1570-2040-270-920_f100-400.avi')
+    assert parsed_name.view == 'rightmirror'
+    assert parsed_name.crop_window == (1570, 2040, 270, 920)
+    assert parsed_name.frame_range == (100, 400)
+
+
+def test_dlc_output_fields():
+    base_name = 'R0382_box02_20201216_12-52-39_009_direct_700-1350-270-935' + SCORERNAME
+    assert filename_parser.parse_file_name(base_name + '_full.pickle').pickle_type == 'full'
+    assert filename_parser.parse_file_name(base_name + '_meta.pickle').pickle_type == 'meta'
+    parsed_name = filename_parser.parse_file_name(base_name + '.h5')
+    assert parsed_name.scorername == SCORERNAME
+    assert parsed_name.pickle_type is None
+
+
+def test_calibration_fields():
+    parsed_name = filename_parser.parse_file_name('calibration_cam01_20201216_12-52-39.avi')
+    assert parsed_name.cam_num == 1
+    assert parsed_name.triggertime == TRIGGERTIME
+    assert filename_parser.parse_file_name('SR_boxCalibration_box02_20201216.mat').triggertime == datetime(2020, 12, 16)
+
+
+@pytest.mark.parametrize('suffix', ['_labeled.mp4', '_filtered.h5', '_filtered_labeled.mp4', '_skeleton.csv',
+                                    '_assemblies.pickle', '_el.pickle', '_bx.h5', '_sk.h5'])
+def test_dlc_suffixes_kept_out_of_scorername(suffix):
+    parsed_name = filename_parser.parse_file_name('R0382_20201216_12-52-39_009_direct_700-1350-270-935' + SCORERNAME + suffix)
+    assert parsed_name.name_type == 'dlc_output'
+    assert parsed_name.scorername == SCORERNAME
+
+
+@pytest.mark.parametrize('file_name, name_type', [
+    ('R0382_box02_20201216_12-52-39_009_rotated.avi', 'video'),
+    ('R0382_box02_20201216_12-52-39_009_rotated.MP4', 'video'),
+    ('R0382_box02_20201216_12-52-39_009_direct_700-1350-270-935_rotated.avi', 'cropped_video'),
+    ('R0382a_box02_20201216_12-52-39_009.avi', 'video'),
+])
+def test_tolerated_names(file_name, name_type):
+    parsed_name = filename_parser.parse_file_name(file_name)
+    assert parsed_name.name_type == name_type
+    assert parsed_name.rat_num == 382
+
+
+@pytest.mark.parametrize('file_name', [
+    'R0382_box02_20201216_12-52-39_009_3dtrajectory.mat',
+    'R0382_box02_20201216_12-52-39_009_notes.txt',
+    'R0382_box02_20201316_12-52-39_009.avi',
+    'notes.txt',
+])
+def test_unrecognized_names(file_name):
+    assert filename_parser.parse_file_name(file_name) is None
+
+
+def test_parse_folder_name_types(tmp_path):
+    for file_name in ('R0382_box02_20201216_12-52-39_009.avi',
+                      'R0382_box02_20201216_12-52-39_009_rotated.avi',
+                      'R0382_box02_20201216_12-52-39_009_3dtrajectory.mat',
+                      'R0382_box02_20201216_12-52-39_009_dlc-out.mat'):
+        (tmp_path / file_name).touch()
+
+    videos = filename_parser.parse_folder(str(tmp_path), name_types=('video',))
+    assert sorted(parsed_name.ext for parsed_name in videos.values()) == ['.avi', '.avi']
@@ -0,0 +1,84 @@
+import os
+
+import pytest
+
+pipeline_runner = pytest.importorskip('pipeline_runner')
+
+SESSION = {'session_name': 'R0382_20201216c', 'raw_folder': '', 'ratID': 'R0382'}
+
+
+@pytest.fixture
+def stage_files(tmp_path, monkeypatch):
+    """
+    a 'crop' stage whose inputs and outputs are files in tmp_path, with both inputs and the output present
+    """
+    input_names = [str(tmp_path / 'input_1.avi'), str(tmp_path / 'input_2.avi')]
+    output_name = str(tmp_path / 'output.avi')
+    for file_name in input_names + [output_name]:
+        with open(file_name, 'w') as f:
+            f.write('frames')
+
+    stage = dict(pipeline_runner.STAGES['crop'])
+    stage['inputs'] = lambda config, session: sorted(input_names)
+    stage['outputs'] = lambda config, session: [output_name]
+    monkeypatch.setitem(pipeline_runner.STAGES, 'crop', stage)
+
+    config = {'checkpoint_folder': str(tmp_path / 'checkpoints')}
+    return config, input_names, output_name
+
+
+def checkpoint_current_inputs(config):
+    _, fingerprint = pipeline_runner.stage_is_stale(config, 'crop', SESSION)
+    pipeline_runner.write_checkpoint(config, 'crop', SESSION, fingerprint, 0.)
+
+
+def test_stale_without_checkpoint(stage_files):
+    config, _, _ = stage_files
+    is_stale, _ = pipeline_runner.stage_is_stale(config, 'crop', SESSION)
+    assert is_stale
+
+
+def test_current_after_checkpoint(stage_files):
+    config, _, _ = stage_files
+    checkpoint_current_inputs(config)
+    is_stale, _ = pipeline_runner.stage_is_stale(config, 'crop', SESSION)
+    assert not is_stale
+
+
+def test_stale_when_input_changes(stage_files):
+    config, input_names, _ = stage_files
+    checkpoint_current_inputs(config)
+
+    input_stat = os.stat(input_names[0])
+    os.utime(input_names[0], ns=(input_stat.st_atime_ns, input_stat.st_mtime_ns + 10 ** 9))
+    is_stale, _ = pipeline_runner.stage_is_stale(config, 'crop', SESSION)
+    assert is_stale
+
+
+def test_stale_when_input_added(stage_files):
+    config, input_names, _ = stage_files
+    checkpoint_current_inputs(config)
+
+    new_input = os.path.join(os.path.dirname(input_names[0]), 'input_3.avi')
+    open(new_input, 'w').close()
+    input_names.append(new_input)
+    is_stale, _ = pipeline_runner.stage_is_stale(config, 'crop', SESSION)
+    assert is_stale
+
+
+def test_stale_when_output_missing(stage_files):
+    config, _, output_name = stage_files
+    checkpoint_current_inputs(config)
+
+    os.remove(output_name)
+    is_stale, _ = pipeline_runner.stage_is_stale(config, 'crop', SESSION)
+    assert is_stale
+
+
+def test_checkpoints_are_per_session(stage_files):
+    config, _, _ = stage_files
+    checkpoint_current_inputs(config)
+
+    other_session = dict(SESSION, session_name='R0382_20201217a')
+    is_stale, _ = pipeline_runner.stage_is_stale(config, 'crop', other_session)
+    assert is_stale
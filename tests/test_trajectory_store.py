@@ -0,0 +1,87 @@
+import os
+from datetime import datetime
+
+import numpy as np
+import pytest
+import scipy.io as sio
+
+h5py = pytest.importorskip('h5py')
+import trajectory_store
+
+VIDEO_METADATA = {'ratID': 'R0382',
+                  'boxnum': 2,
+                  'triggertime': datetime(2020, 12, 16, 12, 52, 39),
+                  'video_number': 9}
+
+
+def make_mat_data(num_frames, seed=0):
+    rng = np.random.default_rng(seed)
+    return {'points3d': rng.random((num_frames, 16, 3)),
+            'confidence': rng.random((num_frames, 16)).astype(np.float32),
+            'bodyparts': ['leftpaw', 'rightpaw'],
+            'fps': 300.,
+            'scorername': 'DLC_resnet50_skilledJan1shuffle1_1030000'}
+
+
+def test_write_and_read(tmp_path):
+    store_name = str(tmp_path / 'R0382_20201216c_dlc-out.h5')
+    mat_data = make_mat_data(100)
+    trajectory_store.write_trajectory(store_name, VIDEO_METADATA, mat_data)
+
+    assert trajectory_store.stored_video_keys(store_name) == {'R0382_box02_20201216_12-52-39_009'}
+    stored_data = trajectory_store.read_trajectory(store_name, 'R0382', VIDEO_METADATA['triggertime'], 9)
+    np.testing.assert_array_equal(stored_data['points3d'], mat_data['points3d'])
+    np.testing.assert_array_equal(stored_data['confidence'], mat_data['confidence'])
+    assert stored_data['bodyparts'] == mat_data['bodyparts']
+    assert stored_data['fps'] == mat_data['fps']
+    assert stored_data['scorername'] == mat_data['scorername']
+
+    with pytest.raises(KeyError):
+        trajectory_store.read_trajectory(store_name, 'R0382', VIDEO_METADATA['triggertime'], 10)
+
+
+def test_overwrite(tmp_path):
+    store_name = str(tmp_path / 'R0382_20201216c_dlc-out.h5')
+    trajectory_store.write_trajectory(store_name, VIDEO_METADATA, make_mat_data(100, seed=0))
+
+    # same shape (overwritten in place), then a different shape and a field dropped
+    new_data = make_mat_data(100, seed=1)
+    trajectory_store.write_trajectory(store_name, VIDEO_METADATA, new_data)
+    stored_data = trajectory_store.read_trajectory(store_name, 'R0382', VIDEO_METADATA['triggertime'], 9)
+    np.testing.assert_array_equal(stored_data['points3d'], new_data['points3d'])
+
+    new_data = make_mat_data(50, seed=2)
+    del new_data['scorername']
+    trajectory_store.write_trajectory(store_name, VIDEO_METADATA, new_data)
+    stored_data = trajectory_store.read_trajectory(store_name, 'R0382', VIDEO_METADATA['triggertime'], 9)
+    assert stored_data['points3d'].shape == (50, 16, 3)
+    assert 'scorername' not in stored_data
+    assert len(trajectory_store.read_index(store_name)) == 1
+
+
+def test_rewrites_reuse_space(tmp_path):
+    store_name = str(tmp_path / 'R0382_20201216c_dlc-out.h5')
+    trajectory_store.write_trajectory(store_name, VIDEO_METADATA, make_mat_data(500))
+    one_entry_size = os.path.getsize(store_name)
+    for i_write in range(20):
+        trajectory_store.write_trajectory(store_name, VIDEO_METADATA, make_mat_data(450 + i_write, seed=i_write))
+
+    assert os.path.getsize(store_name) < 4 * one_entry_size
+
+    old_size, new_size = trajectory_store.repack_store(store_name)
+    assert new_size <= old_size
+    assert trajectory_store.stored_video_keys(store_name) == {'R0382_box02_20201216_12-52-39_009'}
+
+
+def test_export_mat(tmp_path, monkeypatch):
+    store_name = str(tmp_path / 'R0382_20201216c_dlc-out.h5')
+    mat_data = make_mat_data(20)
+    trajectory_store.write_trajectory(store_name, VIDEO_METADATA, mat_data)
+
+    # a store name without a folder exports next to the store
+    monkeypatch.chdir(tmp_path)
+    mat_names = trajectory_store.export_mat(os.path.basename(store_name))
+    assert mat_names == [str(tmp_path / 'R0382_box02_20201216_12-52-39_009_dlc-out.mat')]
+
+    exported_data = sio.loadmat(mat_names[0])
+    np.testing.assert_allclose(exported_data['points3d'], mat_data['points3d'])
@@ -0,0 +1,224 @@
+"""
+per-session HDF5 store (<session_name>_dlc-out.h5) for triangulated trajectories, as an alternative to one
+_dlc-out.mat file per video. Each video is a group under /videos holding the fields package_data_into_mat produces,
+and export_mat writes the .mat files back out. Only one process should write to a store at a time. Requires h5py
+"""
+import os
+from datetime import datetime
+
+import numpy as np
+import scipy.io as sio
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+INDEX_DTYPE = np.dtype([('ratID', 'S16'),
+                        ('triggertime', 'S19'),
+                        ('video_number', 'i4'),
+                        ('boxnum', 'i4'),
+                        ('key', 'S64')])
+TRIGGERTIME_FORMAT = '%Y%m%d_%H-%M-%S'
+
+
+def check_h5py():
+    if h5py is None:
+        raise ImportError('h5py is needed to use the trajectory store (pip install h5py)')
+
+
+def video_key(video_metadata):
+    """
+    :param video_metadata: dictionary with at least ratID, boxnum, triggertime and video_number
+    :return: name of the video's group in the store, which matches its .mat file name without '_dlc-out.mat'
+    """
+    return '{}_box{:02d}_{}_{:03d}'.format(video_metadata['ratID'],
+                                           video_metadata['boxnum'],
+                                           video_metadata['triggertime'].strftime(TRIGGERTIME_FORMAT),
+                                           video_metadata['video_number'])
+
+
+def write_trajectory(store_name, video_metadata, mat_data):
+    """
+    add a video's trajectory data to a session store, creating the store if needed and replacing any earlier entry
+    for the same video
+    :param store_name: full path to the session's .h5 file
+    :param video_metadata: dictionary with at least ratID, boxnum, triggertime and video_number
+    :param mat_data: dictionary from reconstruct_3d.package_data_into_mat
+    """
+    check_h5py()
+    key = video_key(video_metadata)
+
+    with open_store(store_name) as store:
+        video_group = store.require_group('videos').require_group(key)
+        # drop fields the earlier entry had that this one doesn't
+        for field_name in set(video_group.keys()) - set(mat_data):
+            del video_group[field_name]
+        for field_name in set(video_group.attrs.keys()) - set(mat_data):
+            del video_group.attrs[field_name]
+        for field_name, value in mat_data.items():
+            write_field(video_group, field_name, value)
+
+        if 'index' not in store:
+            store.create_dataset('index', shape=(0,), maxshape=(None,), dtype=INDEX_DTYPE, chunks=True)
+        index = store['index']
+        if key.encode() not in set(index['key']):
+            index.resize((index.shape[0] + 1,))
+            index[-1] = (video_metadata['ratID'],
+                         video_metadata['triggertime'].strftime(TRIGGERTIME_FORMAT),
+                         video_metadata['video_number'],
+                         video_metadata['boxnum'],
+                         key)
+
+
+def open_store(store_name):
+    """
+    :param store_name: full path to the session's .h5 file
+    :return: h5py File open for writing. If the store doesn't exist yet, it is created with persistent free-space
+        tracking (which can only be set when a file is created)
+    """
+    if not os.path.exists(store_name):
+        try:
+            h5py.File(store_name, 'x', fs_strategy='fsm', fs_persist=True).close()
+        except FileExistsError:
+            pass
+
+    return h5py.File(store_name, 'a')
+
+
+def write_field(video_group, field_name, value):
+    """
+    write one mat_data field into a video's group, overwriting an existing dataset in place if it has the same shape
+    and type (otherwise the old dataset is deleted and its space is left for later writes to reuse)
+    """
+    value_array = np.asarray(value)
+    if field_name in video_group:
+        dataset = video_group[field_name]
+        if value_array.dtype.kind not in 'USO' and value_array.ndim > 0 and \
+                dataset.shape == value_array.shape and dataset.dtype == value_array.dtype:
+            dataset[...] = value_array
+            return
+        del video_group[field_name]
+    elif field_name in video_group.attrs and value_array.ndim > 0 and value_array.dtype.kind not in 'USO':
+        del video_group.attrs[field_name]
+
+    if value_array.dtype.kind in 'USO':
+        # strings and lists of names (e.g., bodyparts)
+        if value_array.ndim == 0:
+            video_group.attrs[field_name] = str(value)
+        else:
+            video_group.attrs.create(field_name, [str(v) for v in value_array.ravel()],
+                                     dtype=h5py.string_dtype())
+    elif value_array.ndim == 0:
+        video_group.attrs[field_name] = value_array
+    else:
+        video_group.create_dataset(field_name, data=value_array, compression='gzip', shuffle=True)
+
+
+def read_index(store_name):
+    """
+    :param store_name: full path to the session's .h5 file
+    :return: dictionary mapping (ratID, triggertime, video_number) to video key for every video in the store. Empty if
+        the store doesn't exist
+    """
+    check_h5py()
+    if not os.path.exists(store_name):
+        return {}
+
+    with h5py.File(store_name, 'r') as store:
+        if 'index' not in store:
+            return {}
+        index = store['index'][:]
+
+    return {(row['ratID'].decode(),
+             datetime.strptime(row['triggertime'].decode(), TRIGGERTIME_FORMAT),
+             int(row['video_number'])): row['key'].decode()
+            for row in index}
+
+
+def stored_video_keys(store_name):
+    """
+    :return: set of the keys of the videos in a store. Empty if the store doesn't exist or h5py isn't installed, so
+        it can be used to skip videos that are already done without requiring h5py
+    """
+    if h5py is None or not os.path.exists(store_name):
+        return set()
+
+    return set(read_index(store_name).values())
+
+
+def read_trajectory(store_name, ratID, triggertime, video_number):
+    """
+    :param store_name: full path to the session's .h5 file
+    :param ratID: rat ID string (e.g., 'R0382')
+    :param triggertime: datetime of the video's trigger
+    :param video_number: video number within the session
+    :return: mat_data dictionary as written by write_trajectory
+    """
+    index = read_index(store_name)
+    try:
+        key = index[(ratID, triggertime.replace(microsecond=0), video_number)]
+    except KeyError:
+        raise KeyError('{} video {:03d} at {} is not in {}'.format(ratID, video_number, triggertime, store_name))
+
+    return read_trajectory_by_key(store_name, key)
+
+
+def read_trajectory_by_key(store_name, key):
+
+    check_h5py()
+    with h5py.File(store_name, 'r') as store:
+        video_group = store['videos'][key]
+        mat_data = {field_name: video_group[field_name][()] for field_name in video_group.keys()}
+        for field_name, value in video_group.attrs.items():
+            if isinstance(value, bytes):
+                value = value.decode()
+            elif isinstance(value, np.ndarray) and value.dtype.kind in 'SO':
+                value = [v.decode() if isinstance(v, bytes) else str(v) for v in value]
+            mat_data[field_name] = value
+
+    return mat_data
+
+
+def export_mat(store_name, mat_folder=None, keys=None):
+    """
+    write per-video _dlc-out.mat files from a store, for MATLAB code that reads them
+    :param store_name: full path to the session's .h5 file
+    :param mat_folder: folder to write the .mat files into. Default is the folder the store is in (where
+        triangulate_video would have written them)
+    :param keys: list of video keys to export. Default is every video in the store
+    :return: list of the .mat files written
+    """
+    if mat_folder is None:
+        mat_folder = os.path.dirname(os.path.abspath(store_name))
+    if not os.path.isdir(mat_folder):
+        os.makedirs(mat_folder)
+    if keys is None:
+        keys = sorted(read_index(store_name).values())
+
+    mat_names = []
+    for key in keys:
+        mat_name = os.path.join(mat_folder, key + '_dlc-out.mat')
+        sio.savemat(mat_name, read_trajectory_by_key(store_name, key))
+        mat_names.append(mat_name)
+
+    return mat_names
+
+
+def repack_store(store_name):
+    """
+    rewrite a store into a new file (with persistent free-space tracking) without the space left behind by replaced
+    entries, and swap it in for the old one
+    :param store_name: full path to the session's .h5 file
+    :return: old_size, new_size - sizes of the file in bytes before and after
+    """
+    check_h5py()
+    partial_name = '{}.{:d}.partial'.format(store_name, os.getpid())
+    with h5py.File(store_name, 'r') as store, \
+            h5py.File(partial_name, 'w', fs_strategy='fsm', fs_persist=True) as new_store:
+        for name in store:
+            store.copy(store[name], new_store, name=name)
+
+    old_size = os.path.getsize(store_name)
+    os.replace(partial_name, store_name)
+
+    return old_size, os.path.getsize(store_name)
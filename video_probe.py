@@ -0,0 +1,175 @@
+"""
+cached video properties (frame size, frame count, frame rate, codec), kept in a .video_probe.json file in each folder
+of videos so that each video on the NAS only has to be opened once
+"""
+import json
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import cv2
+
+PROBE_CACHE_NAME = '.video_probe.json'
+VIDEO_TYPES = ('.avi', '.mp4')
+
+# probe caches that have already been read, by folder
+_probe_caches = {}
+_probe_cache_lock = threading.Lock()
+
+
+def probe_video(video_name):
+    """
+    :param video_name: full path to a video
+    :return: video_info - dictionary with keys
+        im_size - (height, width) of the frames in pixels
+        num_frames - number of frames (as reported by the container)
+        fps - frame rate
+        codec - fourcc code (e.g., 'MJPG')
+    """
+    video_object = cv2.VideoCapture(video_name)
+    try:
+        if not video_object.isOpened():
+            raise ValueError('could not open {}'.format(video_name))
+        fourcc = int(video_object.get(cv2.CAP_PROP_FOURCC))
+        video_info = {'im_size': (int(video_object.get(cv2.CAP_PROP_FRAME_HEIGHT)),
+                                  int(video_object.get(cv2.CAP_PROP_FRAME_WIDTH))),
+                      'num_frames': int(video_object.get(cv2.CAP_PROP_FRAME_COUNT)),
+                      'fps': video_object.get(cv2.CAP_PROP_FPS),
+                      'codec': ''.join(chr((fourcc >> 8 * i_byte) & 0xFF) for i_byte in range(4)).strip('\x00')}
+    finally:
+        video_object.release()
+
+    return video_info
+
+
+def probe_cache_name(folder):
+
+    return os.path.join(folder, PROBE_CACHE_NAME)
+
+
+def read_probe_cache(folder):
+    """
+    :return: dictionary from the folder's probe cache file, keyed by video name. Empty if there isn't a (readable) cache
+    """
+    try:
+        with open(probe_cache_name(folder), 'r') as f:
+            probe_cache = json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+    for cache_entry in probe_cache.values():
+        cache_entry['im_size'] = tuple(cache_entry['im_size'])
+
+    return probe_cache
+
+
+def write_probe_cache(folder, probe_cache):
+    """
+    write a folder's probe cache file. Folders that can't be written to (e.g., read-only shares) are skipped, in which
+    case the probes are only kept in memory
+    """
+    cache_name = probe_cache_name(folder)
+    partial_name = '{}.{:d}.partial'.format(cache_name, os.getpid())
+    try:
+        with open(partial_name, 'w') as f:
+            json.dump(probe_cache, f, indent=1)
+        os.replace(partial_name, cache_name)
+    except OSError as e:
+        print('could not write video probe cache for {}: {}'.format(folder, e))
+
+
+def cache_entry_is_current(cache_entry, video_stat):
+
+    return cache_entry is not None and \
+        cache_entry['size'] == video_stat.st_size and cache_entry['mtime_ns'] == video_stat.st_mtime_ns
+
+
+def probe_folder(folder, video_names=None, num_workers=1):
+    """
+    make sure every video in a folder is in the folder's probe cache, probing any that are missing or have changed
+    :param folder: folder of videos
+    :param video_names: names (without the path) of the videos to probe. Default is every video in the folder
+    :param num_workers: number of threads to probe videos with
+    :return: probe_cache - dictionary of video_info dictionaries (see probe_video) keyed by video name
+    """
+    folder = os.path.abspath(folder)
+    with _probe_cache_lock:
+        if folder not in _probe_caches:
+            _probe_caches[folder] = read_probe_cache(folder)
+        probe_cache = dict(_probe_caches[folder])
+
+    if video_names is None:
+        with os.scandir(folder) as entries:
+            video_names = [entry.name for entry in entries
+                           if entry.is_file() and os.path.splitext(entry.name)[1].lower() in VIDEO_TYPES]
+
+    videos_to_probe = {}
+    for video_name in video_names:
+        try:
+            video_stat = os.stat(os.path.join(folder, video_name))
+        except OSError:
+            continue
+        if not cache_entry_is_current(probe_cache.get(video_name), video_stat):
+            videos_to_probe[video_name] = video_stat
+    if not videos_to_probe:
+        return probe_cache
+
+    def probe_job(video_name):
+        try:
+            return probe_video(os.path.join(folder, video_name))
+        except ValueError as e:
+            print(e)
+            return None
+
+    if num_workers <= 1:
+        video_infos = [probe_job(video_name) for video_name in videos_to_probe]
+    else:
+        with ThreadPoolExecutor(max_workers=num_workers) as executor:
+            video_infos = list(executor.map(probe_job, videos_to_probe))
+
+    for (video_name, video_stat), video_info in zip(videos_to_probe.items(), video_infos):
+        if video_info is None:
+            continue
+        video_info['size'] = video_stat.st_size
+        video_info['mtime_ns'] = video_stat.st_mtime_ns
+        probe_cache[video_name] = video_info
+
+    with _probe_cache_lock:
+        # another thread may have probed other videos in the same folder in the meantime
+        probe_cache = dict(_probe_caches[folder], **probe_cache)
+        _probe_caches[folder] = probe_cache
+    write_probe_cache(folder, probe_cache)
+
+    return probe_cache
+
+
+def probe_folders(folders, num_workers=1):
+    """
+    probe every video in a list of folders that isn't already cached (see probe_folder)
+    """
+    for folder in folders:
+        if os.path.isdir(folder):
+            probe_folder(folder, num_workers=num_workers)
+
+
+def get_video_info(video_name):
+    """
+    :param video_name: full path to a video
+    :return: video_info - dictionary with keys im_size, num_frames, fps, codec (see probe_video), or None if the video
+        doesn't exist or can't be opened
+    """
+    try:
+        video_stat = os.stat(video_name)
+    except OSError:
+        return None
+
+    folder, name = os.path.split(os.path.abspath(video_name))
+    with _probe_cache_lock:
+        cache_entry = _probe_caches.get(folder, {}).get(name)
+    if not cache_entry_is_current(cache_entry, video_stat):
+        # first time this folder has been seen (or the video has changed), so bring the whole folder's cache up to date
+        cache_entry = probe_folder(folder).get(name)
+        if not cache_entry_is_current(cache_entry, video_stat):
+            return None
+
+    return cache_entry